@@ -0,0 +1,273 @@
+#!/usr/bin/env python3
+"""
+Measures how dnsupdate scales with the number of configured services.
+
+Local HTTP servers stand in for a Dyn protocol service (``/nic/update``), the
+FreeDNS version 2 API (``/u/<key>/``) and a plain text address echo service
+like icanhazip. For each configuration size, a config file is generated and
+dnsupdate is run three times, each in a new process: once with an empty cache
+(every service is updated), once more with nothing changed by a runner that
+has already finished a run, like a daemon, and then with nothing changed in a
+cold process, like the next run started by a timer (which loads the config
+from the compiled config cache). The wall time, number of requests received
+by the servers, peak RSS of the process measuring the run and the time spent
+in each phase of the run are reported.
+
+Requests for any host are redirected to the local servers over plain HTTP by
+a transport adapter mounted on the dnsupdate session. aiohttp cannot be
+redirected this way, so the asyncio engine sends its requests through the
+session in an executor.
+
+Usage::
+
+    python3 benchmarks/benchmark.py --sizes 1,10,100,1000 --jobs 8
+"""
+
+import argparse
+import contextlib
+import http.server
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from urllib.parse import parse_qs, urlsplit, urlunsplit
+
+import yaml
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import dnsupdate  # noqa: E402
+
+PHASES = ("load", "resolve", "update", "save")
+
+
+class _Handler(http.server.BaseHTTPRequestHandler):
+    # Keep connections alive, like the real services
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        url = urlsplit(self.path)
+        query = parse_qs(url.query)
+        if url.path == "/count":
+            body = str(self.server.request_count)
+        else:
+            with self.server.lock:
+                self.server.request_count += 1
+            if url.path == "/nic/update":
+                # One result line for each host in the request
+                hostnames = query["hostname"][0].split(",")
+                body = "\n".join("good %s" % query["myip"][0] for _ in hostnames)
+            elif url.path.startswith("/u/"):
+                body = json.dumps({"targets": [{"statuscode": 0, "address": query["ip"][0]}]})
+            elif url.path == "/ip":
+                body = self.client_address[0]
+            else:
+                self.send_error(404)
+                return
+        body = body.encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class _Server(http.server.ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 1024
+
+    def __init__(self):
+        super().__init__(("127.0.0.1", 0), _Handler)
+        self.lock = threading.Lock()
+        self.request_count = 0
+
+
+class _RedirectAdapter(dnsupdate._HTTPAdapter):
+    """Sends requests for any URL to the local server."""
+
+    def __init__(self, origin, pool_maxsize):
+        self.origin = origin
+        super().__init__(pool_maxsize=pool_maxsize)
+
+    def send(self, request, **kwargs):
+        url = urlsplit(request.url)
+        request.url = urlunsplit(("http", self.origin, url.path, url.query, ""))
+        return super().send(request, **kwargs)
+
+
+def _generate_config(path, size, origin, cache_backend):
+    services = list()
+    for i in range(size):
+        # Mostly Dyn protocol services, with some FreeDNS entries
+        if i % 5 == 4:
+            services.append({"type": "FreeDNS", "args": {"ipv4_key": "key%d" % i}})
+        else:
+            services.append(
+                {
+                    "type": "StandardService",
+                    "args": {
+                        "service_ipv4": "dyn.example",
+                        "service_ipv6": "dyn.example",
+                        "username": "user",
+                        "password": "password",
+                        "hostname": "host%d.example.com" % i,
+                    },
+                }
+            )
+    config = {
+        "cache_file": os.path.join(os.path.dirname(path), "dnsupdate.cache"),
+        "cache_backend": cache_backend,
+        "address_provider": {
+            "ipv4": {"type": "Web", "args": {"ipv4_url": "http://%s/ip" % origin}}
+        },
+        "dns_services": services,
+    }
+    with open(path, "w") as f:
+        yaml.dump(config, f, Dumper=getattr(yaml, "CSafeDumper", yaml.SafeDumper))
+
+
+def _request_count(origin):
+    return int(dnsupdate.session.get("http://%s/count" % origin).text)
+
+
+def _worker(config_file, origin, name, jobs, engine):
+    """Run dnsupdate in this process, and print the result of the run as JSON."""
+    adapter = _RedirectAdapter(origin, max(jobs, 10))
+    dnsupdate.session.mount("http://", adapter)
+    dnsupdate.session.mount("https://", adapter)
+    # Don't use aiohttp, which would bypass the adapter
+    dnsupdate._async_http_context = lambda limit: contextlib.nullcontext()
+
+    args = dnsupdate._get_arg_parser().parse_args(
+        [config_file, "--jobs", str(jobs), "--engine", engine]
+    )
+    runner = dnsupdate._Runner(args)
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        if name == "unchanged":
+            # Warm up the runner with a run that is not measured
+            runner.load()
+            runner.run()
+            runner.timings.clear()
+        requests_before = _request_count(origin)
+        start = time.perf_counter()
+        if runner.config_file is None:
+            runner.load()
+        exit_code = runner.run()
+        wall = time.perf_counter() - start
+    json.dump(
+        {
+            "run": name,
+            "exit_code": int(exit_code),
+            "wall": wall,
+            "requests": _request_count(origin) - requests_before,
+            "phases": dict(runner.timings),
+            # Kilobytes on Linux
+            "maxrss": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        },
+        sys.stdout,
+    )
+
+
+def _benchmark(size, server, jobs, engine, cache_backend):
+    origin = "127.0.0.1:%d" % server.server_port
+    with tempfile.TemporaryDirectory() as tmp:
+        config_file = os.path.join(tmp, "dnsupdate.conf")
+        _generate_config(config_file, size, origin, cache_backend)
+        runs = list()
+        # Each run is measured in a new process, so the peak RSS belongs to
+        # that run and nothing is warm for the restart
+        for name in ("initial", "unchanged", "restart"):
+            output = subprocess.run(
+                [
+                    sys.executable,
+                    os.path.abspath(__file__),
+                    "--worker",
+                    config_file,
+                    origin,
+                    name,
+                    "--jobs",
+                    str(jobs),
+                    "--engine",
+                    engine,
+                ],
+                check=True,
+                stdout=subprocess.PIPE,
+                env={**os.environ, "XDG_CACHE_HOME": tmp},
+            ).stdout
+            run = json.loads(output)
+            run.update(services=size, jobs=jobs, engine=engine, cache_backend=cache_backend)
+            runs.append(run)
+    return runs
+
+
+def _print_table(runs):
+    header = ["services", "run", "exit", "wall (s)", "requests", "peak rss (MiB)"]
+    header += ["%s (s)" % phase for phase in PHASES]
+    rows = [header]
+    for run in runs:
+        row = [
+            str(run["services"]),
+            run["run"],
+            str(run["exit_code"]),
+            "%.3f" % run["wall"],
+            str(run["requests"]),
+            "%.1f" % (run["maxrss"] / 1024),
+        ]
+        row += ["%.3f" % run["phases"].get(phase, 0) for phase in PHASES]
+        rows.append(row)
+    widths = [max(len(row[i]) for row in rows) for i in range(len(header))]
+    for row in rows:
+        print("  ".join(cell.rjust(width) for cell, width in zip(row, widths)))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument(
+        "--sizes",
+        default="1,10,100,1000,10000",
+        help="comma separated numbers of services to benchmark",
+    )
+    parser.add_argument("--jobs", type=int, default=1, help="value of the jobs option")
+    parser.add_argument("--engine", default="threads", choices=dnsupdate._ENGINES)
+    parser.add_argument(
+        "--cache-backend", default="yaml", choices=sorted(dnsupdate._CACHE_BACKENDS)
+    )
+    parser.add_argument("--json", action="store_true", help="print results as JSON")
+    parser.add_argument(
+        "--worker", nargs=3, metavar=("CONFIG", "ORIGIN", "RUN"), help=argparse.SUPPRESS
+    )
+    args = parser.parse_args()
+
+    if args.worker:
+        _worker(*args.worker, args.jobs, args.engine)
+        return
+
+    server = _Server()
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    try:
+        runs = list()
+        for size in (int(s) for s in args.sizes.split(",")):
+            runs.extend(_benchmark(size, server, args.jobs, args.engine, args.cache_backend))
+            if not args.json:
+                print("Finished %d services" % size, file=sys.stderr)
+    finally:
+        server.shutdown()
+        server.server_close()
+
+    if args.json:
+        json.dump(runs, sys.stdout, indent=2)
+        print()
+    else:
+        _print_table(runs)
+
+
+if __name__ == "__main__":
+    main()
+
+# vim: ts=4:ps=4:et
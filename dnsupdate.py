@@ -3,17 +3,39 @@
 __version__ = "0.4.1"
 
 import argparse
+import base64
+import builtins
+import contextlib
+import contextvars
+import copy
+import errno
+import functools
+import hashlib
+import hmac
 import ipaddress
+import json
 import os.path
+import queue
+import random
+import selectors
+import signal
 import socket
+import struct
 import sys
+import tempfile
+import threading
+import time
+import weakref
+from concurrent.futures import FIRST_COMPLETED, Future
+from concurrent.futures import TimeoutError as FutureTimeoutError
+from concurrent.futures import wait
 from enum import IntEnum
 from ipaddress import IPv4Address, IPv6Address
-from typing import IO, Any
+from typing import IO, TYPE_CHECKING, Any
+from urllib.parse import urlsplit
 
-import requests
-import requests.packages.urllib3.util.connection as urllib3_conn
-import yaml
+if TYPE_CHECKING:
+    import yaml
 
 
 class ExitCode(IntEnum):
@@ -23,49 +45,6 @@ class ExitCode(IntEnum):
     OTHER_ERROR = 3
 
 
-# Initialize requests session using custom user agent
-session = requests.Session()
-session.headers.update({"User-Agent": "dnsupdate/%s" % __version__})
-
-
-# Allows passwords to be stored outside of the main configuration file
-# See https://gist.github.com/joshbode/569627ced3076931b02f
-class _ConfigLoader(yaml.SafeLoader):
-    """YAML Loader with `!include` constructor."""
-
-    def __init__(self, stream: IO) -> None:
-        """Initialise Loader."""
-
-        try:
-            self._root = os.path.split(stream.name)[0]
-        except AttributeError:
-            self._root = os.path.curdir
-
-        super().__init__(stream)
-
-
-def construct_include(loader: _ConfigLoader, node: yaml.Node) -> Any:
-    """Include YAML file referenced at node."""
-
-    filename = os.path.abspath(os.path.join(loader._root, loader.construct_scalar(node)))
-
-    with open(filename, "r") as f:
-        return yaml.load(f, _ConfigLoader)
-
-
-def construct_include_text(loader: _ConfigLoader, node: yaml.Node) -> Any:
-    """Include text file referenced at node."""
-
-    filename = os.path.abspath(os.path.join(loader._root, loader.construct_scalar(node)))
-
-    with open(filename, "r") as f:
-        return f.read()
-
-
-yaml.add_constructor("!include", construct_include, _ConfigLoader)
-yaml.add_constructor("!include_text", construct_include_text, _ConfigLoader)
-
-
 class UpdateException(Exception):
     """
     Signals that an error has occurred while attempting to perform an address
@@ -112,607 +91,5027 @@ class AddressProviderException(Exception):
     pass
 
 
-class AddressProvider:
-    """
-    Provides a standard interface for retrieving IP addresses. Any information
-    needed to obtain the addresses (such as authentication information) should
-    be specified in the constructor. Constructor arguments will become options
-    that can be specified in the config file.
+class _DeadlineExceeded(UpdateServiceException):
+    def __init__(self):
+        super().__init__("Run deadline exceeded")
 
-    Implementations must use the requests library for all HTTP requests. This
-    should be done by calling methods of the ``session`` variable in this
-    module, rather than calling the global ``requests`` functions. This makes
-    sure all requests have the correct user agent.
+
+class _Timeouts:
+    """
+    Default timeouts for HTTP requests, and the deadline of the current run.
+    Requests are never allowed to wait past the deadline.
     """
 
-    def ipv4(self):
-        """
-        Return an IPv4 address to assign to a dynamic DNS domain. Only implement
-        this method if your address provider supports IPv4.
+    DEFAULT_CONNECT = 10
+    DEFAULT_READ = 30
 
-        :rtype: :class:`ipaddress.IPv4Address`
-        """
-        return None
+    def __init__(self):
+        self.connect = self.DEFAULT_CONNECT
+        self.read = self.DEFAULT_READ
+        self.deadline = None
 
-    def ipv6(self):
+    def remaining(self):
         """
-        Return an IPv6 address to assign to a dynamic DNS domain. Only implement
-        this method if your address provider supports IPv6.
+        Get the number of seconds remaining until the deadline, or ``None`` if
+        there is no deadline.
+        """
+        if self.deadline is None:
+            return None
+        return max(self.deadline - time.monotonic(), 0)
 
-        :rtype: :class:`ipaddress.IPv6Address`
+    def for_request(self, timeout=None):
         """
-        return None
+        Get the ``(connect, read)`` timeout for a request, given the timeout
+        requested by the caller, if any. Raises :class:`_DeadlineExceeded` if
+        the deadline has already passed.
+        """
+        if timeout is None:
+            connect, read = self.connect, self.read
+        elif isinstance(timeout, tuple):
+            connect, read = timeout
+        else:
+            connect = read = timeout
+        remaining = self.remaining()
+        if remaining is not None:
+            if remaining <= 0:
+                raise _DeadlineExceeded()
+            connect = remaining if connect is None else min(connect, remaining)
+            read = remaining if read is None else min(read, remaining)
+        return connect, read
 
 
-class DNSService:
-    """
-    Provides a standard interface for updating dynamic DNS services. Any
-    information needed to perform an update (such as the domain name and
-    password) should be specified in the constructor. Constructor arguments
-    will become options that can be specified in the config file.
+_timeouts = _Timeouts()
 
-    If possible, implementations should send the `address` parameter of the
-    update methods to the service, rather than letting the service
-    automatically detect the client's address. This makes it possible (with a
-    custom address provider) for a client to point a domain at another device.
+# Objects whose locks must be re-created in forked worker processes, because
+# another thread could have been holding one of them when the process forked.
+# Each of them has an _after_fork() method.
+_fork_safe = weakref.WeakSet()
 
-    Implementations must use the requests library for all HTTP requests. This
-    should be done by calling methods of the ``session`` variable in this
-    module, rather than calling the global ``requests`` functions. This makes
-    sure all requests have the correct user agent.
 
-    To indicate errors during the update process, implementations of the update
-    methods can raise one of three special exceptions:
-    :class:`UpdateException`, :class:`UpdateServiceException` or
-    :class:`UpdateClientException`. See the documentation for these classes for
-    information on when they should be raised.
+class _HostLimit:
+    """
+    Limits the HTTP requests sent to a single host. Requests are allowed at
+    ``rate`` per second on average, with bursts of up to ``burst`` requests,
+    using the generic cell rate algorithm (an equivalent of a token bucket
+    that only needs to store one time). At most ``concurrency`` requests may
+    be in flight at once. Requests that would have to wait past the run
+    deadline fail immediately.
     """
 
-    def update_ipv4(self, address):
-        """
-        Update the IPv4 address of a dynamic DNS domain.
+    def __init__(self, host, rate=None, burst=1, concurrency=None):
+        self.host = host
+        self.rate = rate
+        self.burst = burst
+        self.concurrency = concurrency
+        self._lock = threading.Lock()
+        # Theoretical arrival time of the next request if there were no bursts
+        self._next_time = 0
+        self._semaphore = threading.Semaphore(concurrency) if concurrency is not None else None
+        # asyncio semaphores can only be used on a single event loop
+        self._async_semaphore = (None, None)
+        _fork_safe.add(self)
+
+    def _after_fork(self):
+        self._lock = threading.Lock()
+        # Requests in flight in the parent are not in flight in the child
+        if self.concurrency is not None:
+            self._semaphore = threading.Semaphore(self.concurrency)
+        self._async_semaphore = (None, None)
+
+    def _reserve(self):
+        """Reserve a slot for a request, returning how long to wait before sending it."""
+        if self.rate is None:
+            return 0
+        interval = 1 / self.rate
+        with self._lock:
+            now = time.monotonic()
+            next_time = max(self._next_time, now)
+            delay = max(next_time - (self.burst - 1) * interval - now, 0)
+            remaining = _timeouts.remaining()
+            if remaining is not None and delay >= remaining:
+                raise _DeadlineExceeded()
+            self._next_time = next_time + interval
+        _metrics.observe("dnsupdate_rate_limit_delay_seconds", delay, host=self.host)
+        return delay
+
+    @contextlib.contextmanager
+    def acquire(self):
+        """Wait until a request may be sent, for the duration of a ``with`` statement."""
+        if self._semaphore is not None:
+            if not self._semaphore.acquire(timeout=_timeouts.remaining()):
+                raise _DeadlineExceeded()
+        try:
+            delay = self._reserve()
+            if delay > 0:
+                time.sleep(delay)
+            yield
+        finally:
+            if self._semaphore is not None:
+                self._semaphore.release()
+
+    def _get_async_semaphore(self):
+        import asyncio
+
+        if self.concurrency is None:
+            return None
+        loop = asyncio.get_running_loop()
+        with self._lock:
+            semaphore_loop, semaphore = self._async_semaphore
+            if semaphore_loop is not loop:
+                semaphore = asyncio.Semaphore(self.concurrency)
+                self._async_semaphore = (loop, semaphore)
+            return semaphore
+
+    @contextlib.asynccontextmanager
+    async def async_acquire(self):
+        """Asynchronous version of :meth:`acquire`."""
+        import asyncio
+
+        semaphore = self._get_async_semaphore()
+        if semaphore is not None:
+            try:
+                await asyncio.wait_for(semaphore.acquire(), _timeouts.remaining())
+            except asyncio.TimeoutError:
+                raise _DeadlineExceeded() from None
+        try:
+            delay = self._reserve()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            yield
+        finally:
+            if semaphore is not None:
+                semaphore.release()
 
-        :param address: the new IPv4 address
-        :type address: :class:`ipaddress.IPv4Address`
-        """
-        raise NotImplementedError("%s does not support IPv4" % self.__class__.__name__)
 
-    def update_ipv6(self, address):
-        """
-        Update the IPv6 address of a dynamic DNS domain.
+class _RateLimits:
+    """
+    Limits on the HTTP requests sent to each host, so that many services
+    using the same provider do not send a burst of requests that it could
+    treat as abuse. Hosts without limits of their own use the default limits.
+    Each limit is a dict of :class:`_HostLimit` arguments.
+    """
 
-        :param address: the new IPv6 address
-        :type address: :class:`ipaddress.IPv6Address`
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._default = None
+        self._hosts = dict()
+        self._limits = dict()
+        _fork_safe.add(self)
+
+    def _after_fork(self):
+        self._lock = threading.Lock()
+
+    def configure(self, default=None, hosts=None):
+        """Replace the limits, forgetting the requests sent so far."""
+        with self._lock:
+            self._default = default
+            self._hosts = {host.lower(): limit for host, limit in (hosts or dict()).items()}
+            self._limits = dict()
+
+    def get(self, host):
+        """Get the :class:`_HostLimit` of a host, or ``None`` if it is not limited."""
+        if self._default is None and not self._hosts:
+            return None
+        host = (host or "").lower()
+        with self._lock:
+            limit = self._limits.get(host, None)
+            if limit is None:
+                kwargs = self._hosts.get(host, self._default)
+                if kwargs is None:
+                    return None
+                limit = self._limits[host] = _HostLimit(host, **kwargs)
+            return limit
+
+    def max_shards(self):
         """
-        raise NotImplementedError("%s does not support IPv6" % self.__class__.__name__)
+        Get the largest number of shards that the limits can be shared by,
+        which is the lowest concurrency limit, or ``None`` if there is none.
+        """
+        limits = [self._default, *self._hosts.values()]
+        return min(
+            (limit["concurrency"] for limit in limits if limit and limit["concurrency"]),
+            default=None,
+        )
 
-    def __str__(self):
+    def share(self, shard, shards):
         """
-        If possible, implement this function to provide more information about
-        the service, such as the hostname. The recommended format is
-        ``ClassName [hostname, etc]``. Use ``self.__class__.__name__`` for the
-        class name rather than hard-coding it.
+        Get the share of these limits applied by shard number ``shard`` of
+        ``shards``, which are updated by separate worker processes, so that
+        together they send no more requests than these limits allow. The rate
+        is divided evenly, and the burst and concurrency are split as evenly
+        as they can be.
         """
-        return self.__class__.__name__
 
+        def split(total):
+            return total * (shard + 1) // shards - total * shard // shards
+
+        def share_limit(limit):
+            if limit is None:
+                return None
+            return {
+                "rate": limit["rate"] / shards if limit["rate"] is not None else None,
+                # Shards without a share of the burst wait for their first request
+                "burst": split(limit["burst"]),
+                "concurrency": (
+                    split(limit["concurrency"]) if limit["concurrency"] is not None else None
+                ),
+            }
 
-class ComcastRouter(AddressProvider):
+        limits = _RateLimits()
+        limits.configure(
+            share_limit(self._default),
+            {host: share_limit(limit) for host, limit in self._hosts.items()},
+        )
+        return limits
+
+
+_rate_limits = _RateLimits()
+
+# Type and help text of each metric
+_METRICS = {
+    "dnsupdate_updates_total": (
+        "counter",
+        "Updates of a service address, by outcome (good, nochg, verified, "
+        "client_error, service_error, disabled or error)",
+    ),
+    "dnsupdate_update_duration_seconds": (
+        "histogram",
+        "Time taken to send an update to a DNS service",
+    ),
+    "dnsupdate_lookup_duration_seconds": (
+        "histogram",
+        "Time taken to get an address from an address provider",
+    ),
+    "dnsupdate_address_cache_hits_total": (
+        "counter",
+        "Addresses reused from an earlier lookup in the same run, or from the address cache file",
+    ),
+    "dnsupdate_address_cache_misses_total": (
+        "counter",
+        "Addresses that had to be looked up from an address provider",
+    ),
+    "dnsupdate_rate_limit_delay_seconds": (
+        "histogram",
+        "Time HTTP requests waited for the rate limit of their host",
+    ),
+    "dnsupdate_last_run_duration_seconds": ("gauge", "Duration of the last update run"),
+    "dnsupdate_last_run_timestamp_seconds": ("gauge", "Time the last update run finished"),
+    "dnsupdate_last_run_exit_code": ("gauge", "Exit code of the last update run"),
+}
+
+
+class _Metrics:
+    """
+    Thread-safe registry of the metrics listed in ``_METRICS``, which can be
+    rendered in the Prometheus text exposition format.
     """
-    Scrapes the external IPv4 address from a Comcast/XFINITY router. This
-    address provider does not support IPv6 because it doesn't usually make
-    sense to submit the router's IPv6 address to a dynamic DNS service.
 
-    This has been tested with an Arris TG1682G, but may work with other routers
-    using Comcast's firmware.
+    # Upper bounds of the histogram buckets, in seconds
+    BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, float("inf"))
 
-    :param ip: internal IP address of the router
-    :param username: username for the web interface (usually 'admin')
-    :param password: password for the web interface (router default is 'password')
-    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        # Metric name -> {label items: value}
+        self._series = dict()
+        _fork_safe.add(self)
 
-    def __init__(self, ip, username="admin", password="password"):
-        self.ip = ip
-        self.username = username
-        self.password = password
+    def _after_fork(self):
+        self._lock = threading.Lock()
 
-    def ipv4(self):
-        from bs4 import BeautifulSoup
+    def _update(self, metric, labels, update, initial=0):
+        key = tuple(labels.items())
+        with self._lock:
+            series = self._series.setdefault(metric, dict())
+            series[key] = update(series.get(key, initial))
 
-        login = session.post(
-            "http://%s/check.php" % self.ip, {"username": self.username, "password": self.password}
-        )
-        auth = login.cookies
+    def inc(self, metric, value=1, **labels):
+        self._update(metric, labels, lambda total: total + value)
 
-        ip_page = session.get("http://%s/comcast_network.php" % self.ip, cookies=auth)
+    def set(self, metric, value, **labels):
+        self._update(metric, labels, lambda _: value)
 
-        ip_page = BeautifulSoup(ip_page.text, "html.parser")
+    def observe(self, metric, value, **labels):
+        def update(histogram):
+            buckets, total = histogram
+            buckets = [n + (value <= bound) for n, bound in zip(buckets, self.BUCKETS)]
+            return buckets, total + value
 
-        elem = ip_page.find(text="WAN IP Address (IPv4):")
-        return ipaddress.IPv4Address(elem.parent.find_next("span", class_="value").text)
+        self._update(metric, labels, update, ([0] * len(self.BUCKETS), 0))
 
+    @contextlib.contextmanager
+    def timer(self, metric, **labels):
+        """Observe the time taken by the body of a ``with`` statement."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(metric, time.perf_counter() - start, **labels)
 
-class Web(AddressProvider):
-    """
-    Retrieves addresses from a web service (by default: icanhazip). This
-    provider expects the response to contain only the address in plain text
-    (no HTML).
+    def clear(self):
+        with self._lock:
+            self._series.clear()
 
-    :param ipv4_url: URL of the service that retrieves an IPv4 address
-    :param ipv6_url: URL of the service that retrieves an IPv6 address
-    """
+    def series(self):
+        """Get a copy of the recorded series, which can be passed to :meth:`merge`."""
+        with self._lock:
+            return {name: dict(series) for name, series in self._series.items()}
 
-    def __init__(
-        self, ipv4_url="https://ipv4.icanhazip.com/", ipv6_url="https://ipv6.icanhazip.com/"
-    ):
-        self.ipv4_url = ipv4_url
-        self.ipv6_url = ipv6_url
+    def merge(self, series):
+        """
+        Add the series recorded by another registry, such as one in a worker
+        process. Counters and histograms are added, and gauges are replaced.
+        """
+        for name, values in series.items():
+            kind = _METRICS[name][0]
+            for key, value in values.items():
+                if kind == "counter":
+                    self.inc(name, value, **dict(key))
+                elif kind == "histogram":
+                    self._update(
+                        name,
+                        dict(key),
+                        lambda histogram: (
+                            [a + b for a, b in zip(histogram[0], value[0])],
+                            histogram[1] + value[1],
+                        ),
+                        ([0] * len(self.BUCKETS), 0),
+                    )
+                else:
+                    self.set(name, value, **dict(key))
+
+    def render(self):
+        lines = list()
+        with self._lock:
+            for name, (kind, help) in _METRICS.items():
+                series = self._series.get(name, None)
+                if not series:
+                    continue
+                lines.append("# HELP %s %s" % (name, help))
+                lines.append("# TYPE %s %s" % (name, kind))
+                for labels, value in series.items():
+                    if kind == "histogram":
+                        buckets, total = value
+                        for bound, count in zip(self.BUCKETS, buckets):
+                            lines.append(_metric_sample(name + "_bucket", labels, count, le=bound))
+                        lines.append(_metric_sample(name + "_sum", labels, total))
+                        lines.append(_metric_sample(name + "_count", labels, buckets[-1]))
+                    else:
+                        lines.append(_metric_sample(name, labels, value))
+        return "".join(line + "\n" for line in lines)
 
-    def ipv4(self):
-        # Monkey patch urllib3 to only allow IPv4 connections. requests lacks
-        # a better way of doing this.
-        orig_allowed_gai_family = urllib3_conn.allowed_gai_family
-        urllib3_conn.allowed_gai_family = lambda: socket.AF_INET
-        try:
-            return IPv4Address(session.get(self.ipv4_url).text.rstrip())
-        finally:
-            urllib3_conn.allowed_gai_family = orig_allowed_gai_family
+    def write(self, metrics_file):
+        """
+        Write the metrics to a file for the node_exporter textfile collector.
+        The file is replaced atomically, so the collector never reads a
+        partially written file.
+        """
+        _atomic_write(metrics_file, self.render())
 
-    def ipv6(self):
-        # Monkey patch urllib3 to only allow IPv6 connections. requests lacks
-        # a better way of doing this.
-        orig_allowed_gai_family = urllib3_conn.allowed_gai_family
-        urllib3_conn.allowed_gai_family = lambda: socket.AF_INET6
-        try:
-            return IPv6Address(session.get(self.ipv6_url).text.rstrip())
-        finally:
-            urllib3_conn.allowed_gai_family = orig_allowed_gai_family
 
+def _metric_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(value) if isinstance(value, float) else str(int(value))
 
-class Local(AddressProvider):
-    """
-    Retrieves addresses from a local network interface. If you are behind NAT
-    (which is often the case if you are using dynamic DNS), this provider will
-    return not return any IPv4 address, unless you enable the ``allow_private``
-    option. Normally, you will want to use a different provider for IPv4 if you
-    are behind NAT.
 
-    :param interface: name of the interface to use
-    :param allow_private: consider a private address to be valid
-    """
+def _metric_sample(name, labels, value, **extra_labels):
+    labels = labels + tuple((k, _metric_value(v)) for k, v in extra_labels.items())
+    if not labels:
+        return "%s %s" % (name, _metric_value(value))
+    label_text = ",".join(
+        '%s="%s"' % (k, str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"))
+        for k, v in labels
+    )
+    return "%s{%s} %s" % (name, label_text, _metric_value(value))
 
-    def __init__(self, interface, allow_private=False):
-        import netifaces
 
-        self.interface = interface
-        self.allow_private = allow_private
-        self.addresses = netifaces.ifaddresses(interface)
+_metrics = _Metrics()
 
-    def ipv4(self):
-        import netifaces
 
-        try:
-            addr = next(
-                filter(
-                    lambda a: self.__is_valid_address(a),
-                    map(
-                        lambda addr_string: IPv4Address(addr_string["addr"]),
-                        self.addresses[netifaces.AF_INET],
-                    ),
-                )
-            )
+def _serve_metrics(address, port):
+    """
+    Serve the metrics over HTTP from a background thread, returning the
+    server.
+    """
+    import http.server
 
-            return addr
-        except (KeyError, StopIteration):
-            raise AddressProviderException(
-                "Interface %s has no valid IPv4 address" % self.interface
-            )
+    class Handler(http.server.BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split("?")[0] not in ("/", "/metrics"):
+                self.send_error(404)
+                return
+            body = _metrics.render().encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
 
-    def ipv6(self):
-        import netifaces
+        def log_message(self, *args):
+            pass
 
-        try:
-            addr = next(
-                filter(
-                    lambda a: self.__is_valid_address(a),
-                    map(
-                        lambda addr_string: IPv6Address(addr_string["addr"].split("%", 1)[0]),
-                        self.addresses[netifaces.AF_INET6],
-                    ),
-                ),
-                None,
-            )
-            return addr
-        except (KeyError, StopIteration):
-            raise AddressProviderException(
-                "Interface %s has no valid IPv6 address" % self.interface
-            )
+    class Server(http.server.ThreadingHTTPServer):
+        address_family = socket.AF_INET6 if ":" in address else socket.AF_INET
+        daemon_threads = True
 
-    def __is_valid_address(self, addr):
-        return addr.is_global or (self.allow_private and addr.is_private)
+    server = Server((address, port), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
 
 
-class StaticURL(DNSService):
+class Span:
+    """
+    A timed operation, such as a service update or an HTTP request. Spans
+    started while another span is active become its children, and share its
+    trace ID.
+
+    :ivar name: name of the operation
+    :ivar attributes: dictionary describing the operation
+    :ivar trace_id: hexadecimal ID shared by all spans of a run
+    :ivar span_id: hexadecimal ID of this span
+    :ivar parent_id: ID of the parent span, or ``None``
+    :ivar start_time: Unix time at which the span started
+    :ivar duration: duration of the span in seconds, or ``None`` until it has
+        finished
+    :ivar error: description of the exception that ended the span, if any
     """
-    Updates addresses by sending an HTTP GET request to statically configured
-    URLs. When using this type of service, the remote server will automatically
-    detect your IP and therefore the address provided by the configured address
-    provider will not be used. In most cases, the result will be the same as if
-    the :class:`Web` provider had been used.
 
-    :param ipv4_url: URL used to update the IPv4 address
-    :param ipv6_url: URL used to update the IPv6 address
+    def __init__(self, name, parent=None, attributes=None):
+        self.name = name
+        self.attributes = attributes if attributes is not None else dict()
+        self.trace_id = parent.trace_id if parent is not None else "%032x" % random.getrandbits(128)
+        self.span_id = "%016x" % random.getrandbits(64)
+        self.parent_id = parent.span_id if parent is not None else None
+        self.start_time = time.time()
+        self.duration = None
+        self.error = None
+
+    def to_dict(self):
+        return {
+            "name": self.name,
+            "trace_id": self.trace_id,
+            "span_id": self.span_id,
+            "parent_id": self.parent_id,
+            "start_time": self.start_time,
+            "duration": self.duration,
+            "attributes": self.attributes,
+            "error": self.error,
+        }
+
+
+class SpanHook:
+    """
+    Receives spans as they start and finish, to export them to a tracing
+    system. Hooks are registered using :func:`add_span_hook`. The methods may
+    be called concurrently from multiple threads.
     """
 
-    def __init__(self, ipv4_url, ipv6_url=None):
-        self.ipv4_url = ipv4_url
-        self.ipv6_url = ipv6_url
+    def span_started(self, span):
+        """
+        Called when a span starts.
 
-    def update_ipv4(self, address=None):
-        session.get(self.ipv4_url)
+        :type span: :class:`Span`
+        """
 
-    def update_ipv6(self, address=None):
-        session.get(self.ipv6_url)
+    def span_finished(self, span):
+        """
+        Called when a span finishes, after its duration and error have been
+        set.
+
+        :type span: :class:`Span`
+        """
 
 
-class FreeDNS(DNSService):
+_span_hooks = list()
+_current_span = contextvars.ContextVar("_current_span", default=None)
+
+
+def add_span_hook(hook):
     """
-    Updates a domain on FreeDNS_ using the version 2 interface. This API uses a
-    single key for each entry (separate ones for IPv4 and IPv6) instead of
-    separately passing the domain, username and password. The keys are the last
-    part of the given update URL, not including the trailing slash.
+    Register a :class:`SpanHook` to receive every span.
+    """
+    _span_hooks.append(hook)
 
-    For example, the update key for the URL
-    ``http://sync.afraid.org/u/VWZIcQnBScVv8yv8DhJxDbnt/`` is
-    ``VWZIcQnBScVv8yv8DhJxDbnt``
 
-    .. _FreeDNS: http://freedns.afraid.org
+def remove_span_hook(hook):
+    """
+    Unregister a :class:`SpanHook`.
+    """
+    _span_hooks.remove(hook)
 
-    :param ipv4_key: update key for IPv4
-    :param ipv6_key: update key for IPv6
+
+def _call_span_hooks(method, span):
+    for hook in list(_span_hooks):
+        try:
+            getattr(hook, method)(span)
+        except Exception as e:
+            print("Warning: span hook failed: %s" % e, file=sys.stderr)
+
+
+@contextlib.contextmanager
+def span(name, **attributes):
+    """
+    Trace the body of a ``with`` statement as a :class:`Span`, which becomes
+    the current span. The keyword arguments are the attributes of the span.
+    Address lookups, service updates and HTTP requests are traced
+    automatically; this is only needed to trace operations within them in more
+    detail.
     """
+    current = Span(name, _current_span.get(), attributes)
+    token = _current_span.set(current)
+    _call_span_hooks("span_started", current)
+    start = time.perf_counter()
+    try:
+        yield current
+    except Exception as e:
+        current.error = "%s: %s" % (e.__class__.__name__, e)
+        raise
+    finally:
+        current.duration = time.perf_counter() - start
+        _current_span.reset(token)
+        _call_span_hooks("span_finished", current)
 
-    def __init__(self, ipv4_key, ipv6_key=None):
-        self.ipv4_key = ipv4_key
-        self.ipv6_key = ipv6_key
 
-    @staticmethod
-    def __update(update_url, address):
-        # Ask for json response
-        r = session.get(update_url, params={"content-type": "json", "ip": address})
-        if r.status_code == requests.codes.ok:
-            r = r.json()
-            # Check for error
-            if "errorno" in r:
+def _with_context(func, *args):
+    """
+    Bind a call to a copy of the current context, so that it has the same
+    current span when run in another thread.
+    """
+    return functools.partial(contextvars.copy_context().run, func, *args)
+
+
+class _DaemonExecutor:
+    """
+    Runs functions on up to ``max_workers`` daemon threads, returning a
+    :class:`Future` for each like :class:`ThreadPoolExecutor`, whose threads
+    are joined when the interpreter exits. Calls that are abandoned at a
+    deadline therefore do not keep the process from exiting.
+    """
+
+    def __init__(self, max_workers):
+        self._max_workers = max_workers
+        self._lock = threading.Lock()
+        self._queue = queue.SimpleQueue()
+        self._threads = 0
+        _fork_safe.add(self)
+
+    def _after_fork(self):
+        # The worker threads do not exist in the child
+        self._lock = threading.Lock()
+        self._queue = queue.SimpleQueue()
+        self._threads = 0
+
+    def _work(self, work_queue):
+        while True:
+            item = work_queue.get()
+            if item is None:
+                return
+            future, fn, args = item
+            if not future.set_running_or_notify_cancel():
+                continue
+            try:
+                result = fn(*args)
+            except BaseException as e:
+                future.set_exception(e)
+            else:
+                future.set_result(result)
+
+    def submit(self, fn, *args):
+        future = Future()
+        with self._lock:
+            self._queue.put((future, fn, args))
+            if self._threads < self._max_workers:
+                self._threads += 1
+                threading.Thread(target=self._work, args=(self._queue,), daemon=True).start()
+        return future
+
+    def shutdown(self):
+        """
+        Stop the worker threads once they have run the functions already
+        submitted, skipping those whose futures were cancelled, without
+        waiting for them.
+        """
+        with self._lock:
+            for _ in range(self._threads):
+                self._queue.put(None)
+            self._threads = 0
+
+
+class _JSONLinesSpanWriter(SpanHook):
+    """Appends each finished span to a file as a line of JSON."""
+
+    def __init__(self, trace_file):
+        self.trace_file = trace_file
+        self._lock = threading.Lock()
+        self._file = open(trace_file, "a")
+        _fork_safe.add(self)
+
+    def _after_fork(self):
+        self._lock = threading.Lock()
+
+    def span_finished(self, span):
+        line = json.dumps(span.to_dict(), default=str)
+        with self._lock:
+            self._file.write(line + "\n")
+            # Write out the spans of a run once it has finished
+            if span.parent_id is None:
+                self._file.flush()
+
+    def close(self):
+        with self._lock:
+            self._file.close()
+
+
+_USER_AGENT = "dnsupdate/%s" % __version__
+
+# Requests sessions for each address family, created when first used
+_http_sessions = None
+_http_sessions_lock = threading.Lock()
+
+
+def _create_http_sessions():
+    """
+    Import requests and create the HTTP sessions. This is deferred until the
+    first request, so runs that do not need to send any requests do not pay
+    for importing requests.
+    """
+    global _HTTPAdapter, _FamilyHTTPAdapter
+    import requests
+    import requests.adapters
+
+    class _HTTPAdapter(requests.adapters.HTTPAdapter):
+        """
+        Transport adapter that applies the default timeouts and the run
+        deadline to every request.
+        """
+
+        def send(self, request, timeout=None, **kwargs):
+            host = urlsplit(request.url).hostname
+            with span("http", method=request.method, host=host):
+                limit = _rate_limits.get(host)
+                with limit.acquire() if limit is not None else contextlib.nullcontext():
+                    return super().send(request, timeout=_timeouts.for_request(timeout), **kwargs)
+
+    class _FamilyHTTPAdapter(_HTTPAdapter):
+        """
+        Transport adapter whose connection pools only connect using a single
+        address family. Connections are bound to the wildcard address of the
+        family, so urllib3 skips any resolved addresses of the other family.
+        This is safe to use from multiple threads, unlike patching
+        ``urllib3.util.connection.allowed_gai_family``.
+        """
+
+        __attrs__ = requests.adapters.HTTPAdapter.__attrs__ + ["family"]
+
+        _WILDCARD_ADDRESSES = {socket.AF_INET: "0.0.0.0", socket.AF_INET6: "::"}
+
+        def __init__(self, family, **kwargs):
+            self.family = family
+            super().__init__(**kwargs)
+
+        def init_poolmanager(self, *args, **kwargs):
+            kwargs["source_address"] = (self._WILDCARD_ADDRESSES[self.family], 0)
+            super().init_poolmanager(*args, **kwargs)
+
+    # Initialize requests session using custom user agent
+    default_session = requests.Session()
+    default_session.headers.update({"User-Agent": _USER_AGENT})
+    default_session.mount("http://", _HTTPAdapter())
+    default_session.mount("https://", _HTTPAdapter())
+    sessions = {socket.AF_UNSPEC: default_session}
+
+    # Sessions that only connect using a single address family, each with its
+    # own keep-alive connection pools
+    for family in (socket.AF_INET, socket.AF_INET6):
+        family_session = requests.Session()
+        # Share headers with the module session, so changes apply to both
+        family_session.headers = default_session.headers
+        adapter = _FamilyHTTPAdapter(family)
+        family_session.mount("http://", adapter)
+        family_session.mount("https://", adapter)
+        sessions[family] = family_session
+    return sessions
+
+
+def _http_session(family=socket.AF_UNSPEC):
+    global _http_sessions
+    if _http_sessions is None:
+        with _http_sessions_lock:
+            if _http_sessions is None:
+                _http_sessions = _create_http_sessions()
+    return _http_sessions[family]
+
+
+class _LazySession:
+    """
+    Stands in for the requests session of the module, which is only created
+    when one of its attributes is first used.
+    """
+
+    def __getattr__(self, name):
+        return getattr(_http_session(), name)
+
+    def __setattr__(self, name, value):
+        setattr(_http_session(), name, value)
+
+
+session = _LazySession()
+
+
+def _timeout_errors():
+    """
+    Get the exceptions raised when a request times out. Only modules that
+    have already been imported can have raised them.
+    """
+    errors = list()
+    if "requests" in sys.modules:
+        errors.append(sys.modules["requests"].Timeout)
+    if "asyncio" in sys.modules:
+        errors.append(sys.modules["asyncio"].TimeoutError)
+    return tuple(errors)
+
+
+def _config_loader():
+    """
+    Get the YAML loader class for config files, importing yaml the first time
+    a config file is parsed.
+    """
+    global _ConfigLoader, _ConfigComposer
+    if "_ConfigLoader" in globals():
+        return _ConfigLoader
+    import yaml
+
+    # Allows passwords to be stored outside of the main configuration file
+    # See https://gist.github.com/joshbode/569627ced3076931b02f
+    class _ConfigLoader(getattr(yaml, "CSafeLoader", yaml.SafeLoader)):
+        """YAML Loader with `!include` constructor, using libyaml if available."""
+
+        def __init__(self, stream: IO, root: str = None) -> None:
+            """Initialise Loader."""
+
+            if root is not None:
+                self._root = root
+            else:
+                try:
+                    self._root = os.path.split(stream.name)[0]
+                except AttributeError:
+                    self._root = os.path.curdir
+
+            super().__init__(stream)
+
+    class _ConfigComposer(
+        yaml.composer.Composer, yaml.constructor.SafeConstructor, yaml.resolver.Resolver
+    ):
+        """
+        Builds values one node at a time from the events of a
+        :class:`_ConfigLoader`, so a large document never needs to be held in
+        memory all at once.
+        """
+
+        def __init__(self, loader: _ConfigLoader) -> None:
+            yaml.composer.Composer.__init__(self)
+            yaml.constructor.SafeConstructor.__init__(self)
+            yaml.resolver.Resolver.__init__(self)
+            self._root = loader._root
+            self.check_event = loader.check_event
+            self.peek_event = loader.peek_event
+            self.get_event = loader.get_event
+
+        def construct_item(self) -> Any:
+            """Construct the value starting at the next event."""
+            return self.construct_document(self.compose_node(None, None))
+
+    for loader_class in (_ConfigLoader, _ConfigComposer):
+        yaml.add_constructor("!include", construct_include, loader_class)
+        yaml.add_constructor("!include_text", construct_include_text, loader_class)
+    return _ConfigLoader
+
+
+# Dict of the files read while parsing the current config file, mapping each
+# path to its (mtime, size, SHA-256 digest)
+_config_files = contextvars.ContextVar("_config_files", default=None)
+
+
+def _text_digest(text):
+    return hashlib.sha256(text.encode()).hexdigest()
+
+
+def _read_config_file(filename):
+    """Read a config file or an included file, recording it if parsing a config."""
+    with open(filename, "r") as f:
+        st = os.fstat(f.fileno())
+        text = f.read()
+    files = _config_files.get()
+    if files is not None:
+        files[os.path.abspath(filename)] = (st.st_mtime, st.st_size, _text_digest(text))
+    return text
+
+
+def _load_yaml(text, root):
+    loader = _config_loader()(text, root)
+    try:
+        return loader.get_single_data()
+    finally:
+        loader.dispose()
+
+
+def _stream_yaml(text, root, on_service):
+    """
+    Parse a config file, calling ``on_service`` with each item of its
+    ``dns_services`` sequence as soon as it has been constructed, instead of
+    building the whole document first. Returns the rest of the config and
+    whether it contained ``dns_services``.
+    """
+    import yaml
+
+    loader = _config_loader()(text, root)
+    try:
+        composer = _ConfigComposer(loader)
+        loader.get_event()
+        if loader.check_event(yaml.StreamEndEvent):
+            return None, False
+        loader.get_event()
+        if not loader.check_event(yaml.MappingStartEvent):
+            config = composer.construct_item()
+            has_services = isinstance(config, dict) and "dns_services" in config
+            if has_services:
+                for service_root in config.pop("dns_services"):
+                    on_service(service_root)
+        else:
+            config = dict()
+            has_services = False
+            # Keys from merge keys (<<), which don't replace keys of the
+            # mapping itself wherever they appear in it
+            merged = dict()
+            loader.get_event()
+            while not loader.check_event(yaml.MappingEndEvent):
+                key_node = composer.compose_node(None, None)
+                if key_node.tag == "tag:yaml.org,2002:merge":
+                    value_node = composer.compose_node(None, None)
+                    node = yaml.MappingNode("tag:yaml.org,2002:map", [(key_node, value_node)])
+                    for key, value in composer.construct_document(node).items():
+                        merged.setdefault(key, value)
+                    continue
+                key = composer.construct_document(key_node)
+                if key != "dns_services":
+                    config[key] = composer.construct_item()
+                    continue
+                has_services = True
+                if loader.check_event(yaml.SequenceStartEvent):
+                    loader.get_event()
+                    while not loader.check_event(yaml.SequenceEndEvent):
+                        on_service(composer.construct_item())
+                    loader.get_event()
+                else:
+                    # Such as an !include
+                    for service_root in composer.construct_item():
+                        on_service(service_root)
+            loader.get_event()
+            for key, value in merged.items():
+                if key != "dns_services":
+                    config.setdefault(key, value)
+                elif not has_services:
+                    has_services = True
+                    for service_root in value:
+                        on_service(service_root)
+        loader.get_event()
+        if not loader.check_event(yaml.StreamEndEvent):
+            event = loader.get_event()
+            raise yaml.composer.ComposerError(
+                "expected a single document in the stream",
+                None,
+                "but found another document",
+                event.start_mark,
+            )
+        return config, has_services
+    finally:
+        loader.dispose()
+
+
+def construct_include(loader: "_ConfigLoader", node: "yaml.Node") -> Any:
+    """Include YAML file referenced at node."""
+
+    filename = os.path.abspath(os.path.join(loader._root, loader.construct_scalar(node)))
+
+    with span("include", file=filename):
+        return _load_yaml(_read_config_file(filename), os.path.dirname(filename))
+
+
+def construct_include_text(loader: "_ConfigLoader", node: "yaml.Node") -> Any:
+    """Include text file referenced at node."""
+
+    filename = os.path.abspath(os.path.join(loader._root, loader.construct_scalar(node)))
+
+    with span("include", file=filename):
+        return _read_config_file(filename)
+
+
+def __getattr__(name):
+    # Classes that are defined when their dependencies are first imported
+    if name in ("_ConfigLoader", "_ConfigComposer"):
+        _config_loader()
+        return globals()[name]
+    if name in ("_HTTPAdapter", "_FamilyHTTPAdapter"):
+        _http_session()
+        return globals()[name]
+    raise AttributeError("module %r has no attribute %r" % (__name__, name))
+
+
+def _request(method, url, family=socket.AF_UNSPEC, **kwargs):
+    """
+    Send an HTTP request using the module session, optionally restricting the
+    connection to a single address family.
+    """
+    return _http_session(family).request(method, url, **kwargs)
+
+
+# Executor of _run_blocking(), which is used instead of the default executor
+# of the event loop because asyncio.run() waits for its threads to finish, so
+# blocking calls abandoned at the run deadline would delay the end of the run
+_blocking_executor = _DaemonExecutor(min(32, (os.cpu_count() or 1) + 4))
+
+
+async def _run_blocking(func, *args):
+    """Run a blocking function in a daemon thread, without blocking the event loop."""
+    import asyncio
+
+    return await asyncio.get_running_loop().run_in_executor(
+        _blocking_executor, _with_context(func, *args)
+    )
+
+
+class _AsyncResponse:
+    """
+    The subset of :class:`requests.Response` used by the built-in address
+    providers and DNS services, returned by :func:`async_request`.
+    """
+
+    def __init__(self, status_code, text, url):
+        self.status_code = status_code
+        self.text = text
+        self.url = url
+
+    def json(self):
+        return json.loads(self.text)
+
+    def raise_for_status(self):
+        if 400 <= self.status_code < 600:
+            import requests
+
+            raise requests.HTTPError("%d Error for url: %s" % (self.status_code, self.url))
+
+
+class _AsyncHTTP:
+    """
+    aiohttp client sessions used by the asyncio engine, with a separate
+    connection pool for each address family.
+    """
+
+    def __init__(self, aiohttp, limit):
+        self._aiohttp = aiohttp
+        self._limit = limit
+        self._sessions = dict()
+
+    def _session(self, family):
+        client_session = self._sessions.get(family, None)
+        if client_session is None:
+            client_session = self._sessions[family] = self._aiohttp.ClientSession(
+                connector=self._aiohttp.TCPConnector(family=family, limit=self._limit),
+                headers={"User-Agent": _USER_AGENT},
+            )
+        return client_session
+
+    async def request(
+        self, method, url, family=socket.AF_UNSPEC, auth=None, params=None, data=None
+    ):
+        if auth is not None:
+            auth = self._aiohttp.BasicAuth(*auth)
+        if params is not None:
+            # Match the way requests encodes parameters
+            params = {k: str(v) for k, v in params.items() if v is not None}
+        host = urlsplit(url).hostname
+        with span("http", method=method, host=host):
+            limit = _rate_limits.get(host)
+            if limit is None:
+                return await self._send(method, url, family, auth, params, data)
+            async with limit.async_acquire():
+                return await self._send(method, url, family, auth, params, data)
+
+    async def _send(self, method, url, family, auth, params, data):
+        connect, read = _timeouts.for_request()
+        timeout = self._aiohttp.ClientTimeout(
+            total=_timeouts.remaining(), sock_connect=connect, sock_read=read
+        )
+        async with self._session(family).request(
+            method, url, auth=auth, params=params, data=data, timeout=timeout
+        ) as r:
+            return _AsyncResponse(r.status, await r.text(), str(r.url))
+
+    async def close(self):
+        for client_session in self._sessions.values():
+            await client_session.close()
+
+
+# HTTP client used by async_request(), if aiohttp is available
+_async_http = contextvars.ContextVar("_async_http", default=None)
+
+
+async def async_request(method, url, family=socket.AF_UNSPEC, **kwargs):
+    """
+    Send an HTTP request without blocking the event loop. Requests are sent
+    natively using aiohttp when running in the asyncio engine and aiohttp is
+    installed, or otherwise using the module ``session`` in an executor.
+
+    :param method: HTTP method
+    :param url: URL to request
+    :param family: address family to connect with (default: any)
+    :param kwargs: ``auth``, ``params`` or ``data``, as accepted by requests
+    :return: an object with ``status_code`` and ``text`` attributes, and
+             ``json()`` and ``raise_for_status()`` methods
+    """
+    http = _async_http.get()
+    if http is None:
+        return await _run_blocking(functools.partial(_request, method, url, family, **kwargs))
+    return await http.request(method, url, family, **kwargs)
+
+
+class AddressProvider:
+    """
+    Provides a standard interface for retrieving IP addresses. Any information
+    needed to obtain the addresses (such as authentication information) should
+    be specified in the constructor. Constructor arguments will become options
+    that can be specified in the config file.
+
+    Addresses returned by a provider can be reused by later runs for
+    ``cache_ttl`` seconds. Implementations can change the default of 0
+    (disabled), and users can override it with the ``cache_ttl`` config
+    option.
+
+    Implementations must use the requests library for all HTTP requests. This
+    should be done by calling methods of the ``session`` variable in this
+    module, rather than calling the global ``requests`` functions. This makes
+    sure all requests have the correct user agent.
+    """
+
+    cache_ttl = 0
+
+    def ipv4(self):
+        """
+        Return an IPv4 address to assign to a dynamic DNS domain. Only implement
+        this method if your address provider supports IPv4.
+
+        :rtype: :class:`ipaddress.IPv4Address`
+        """
+        return None
+
+    def ipv6(self):
+        """
+        Return an IPv6 address to assign to a dynamic DNS domain. Only implement
+        this method if your address provider supports IPv6.
+
+        :rtype: :class:`ipaddress.IPv6Address`
+        """
+        return None
+
+    async def async_ipv4(self):
+        """
+        Asynchronous version of :meth:`ipv4`, used by the asyncio engine. The
+        default implementation runs :meth:`ipv4` in an executor. Only
+        implement this method if your address provider can retrieve the
+        address without blocking.
+
+        :rtype: :class:`ipaddress.IPv4Address`
+        """
+        return await _run_blocking(self.ipv4)
+
+    async def async_ipv6(self):
+        """
+        Asynchronous version of :meth:`ipv6`, used by the asyncio engine. The
+        default implementation runs :meth:`ipv6` in an executor. Only
+        implement this method if your address provider can retrieve the
+        address without blocking.
+
+        :rtype: :class:`ipaddress.IPv6Address`
+        """
+        return await _run_blocking(self.ipv6)
+
+    def watch(self):
+        """
+        Return an object with a ``fileno()`` method (such as a socket) that
+        becomes readable when the addresses of this provider may have changed,
+        or ``None`` if change notifications are not supported (the default).
+        In daemon mode, this allows an update run to start as soon as an
+        address changes, rather than waiting for the next interval.
+        """
+        return None
+
+    def changed(self):
+        """
+        Called in daemon mode when the object returned by :meth:`watch` is
+        readable. Implementations must consume the pending notifications, and
+        return ``True`` if an update run should be started.
+        """
+        return True
+
+
+class DNSService:
+    """
+    Provides a standard interface for updating dynamic DNS services. Any
+    information needed to perform an update (such as the domain name and
+    password) should be specified in the constructor. Constructor arguments
+    will become options that can be specified in the config file.
+
+    If possible, implementations should send the `address` parameter of the
+    update methods to the service, rather than letting the service
+    automatically detect the client's address. This makes it possible (with a
+    custom address provider) for a client to point a domain at another device.
+
+    Implementations must use the requests library for all HTTP requests. This
+    should be done by calling methods of the ``session`` variable in this
+    module, rather than calling the global ``requests`` functions. This makes
+    sure all requests have the correct user agent.
+
+    To indicate errors during the update process, implementations of the update
+    methods can raise one of three special exceptions:
+    :class:`UpdateException`, :class:`UpdateServiceException` or
+    :class:`UpdateClientException`. See the documentation for these classes for
+    information on when they should be raised.
+    """
+
+    def update_ipv4(self, address):
+        """
+        Update the IPv4 address of a dynamic DNS domain. Implementations may
+        return ``False`` if the service reports that it already had the
+        address.
+
+        :param address: the new IPv4 address
+        :type address: :class:`ipaddress.IPv4Address`
+        """
+        raise NotImplementedError("%s does not support IPv4" % self.__class__.__name__)
+
+    def update_ipv6(self, address):
+        """
+        Update the IPv6 address of a dynamic DNS domain. Implementations may
+        return ``False`` if the service reports that it already had the
+        address.
+
+        :param address: the new IPv6 address
+        :type address: :class:`ipaddress.IPv6Address`
+        """
+        raise NotImplementedError("%s does not support IPv6" % self.__class__.__name__)
+
+    async def async_update_ipv4(self, address):
+        """
+        Asynchronous version of :meth:`update_ipv4`, used by the asyncio
+        engine. The default implementation runs :meth:`update_ipv4` in an
+        executor. Only implement this method if your service can perform the
+        update without blocking.
+
+        :param address: the new IPv4 address
+        :type address: :class:`ipaddress.IPv4Address`
+        """
+        return await _run_blocking(self.update_ipv4, address)
+
+    async def async_update_ipv6(self, address):
+        """
+        Asynchronous version of :meth:`update_ipv6`, used by the asyncio
+        engine. The default implementation runs :meth:`update_ipv6` in an
+        executor. Only implement this method if your service can perform the
+        update without blocking.
+
+        :param address: the new IPv6 address
+        :type address: :class:`ipaddress.IPv6Address`
+        """
+        return await _run_blocking(self.update_ipv6, address)
+
+    def hostnames(self):
+        """
+        Get the fully qualified domain names updated by this service, which
+        are resolved to check whether DNS already holds a new address when
+        ``verify_server`` is configured. The default is an empty list, which
+        means the service is always updated.
+        """
+        return list()
+
+    #: Maximum number of services updated by a single call to
+    #: :meth:`update_batch`, or ``None`` if there is no limit
+    max_batch_size = None
+
+    #: Names of the constructor arguments that identify the domain being
+    #: updated, which keep the cached state of the service when other services
+    #: are added, removed or reordered. Arguments holding secrets must not be
+    #: listed. Services with none are identified by their position among
+    #: services of the same class.
+    identity_args = ()
+
+    def batch_key(self, proto):
+        """
+        Get a key identifying the services that can be updated together with
+        this one in a single request, or ``None`` (the default) if this
+        service must be updated on its own. Services of the same class with
+        equal keys that are being updated to the same address are updated by
+        a single call to :meth:`update_batch`.
+
+        :param proto: ``ipv4`` or ``ipv6``
+        """
+        return None
+
+    def update_batch(self, proto, address, services):
+        """
+        Update the address of several services with equal :meth:`batch_key`,
+        including this one. Returns a list with the result of updating each
+        service, which is either the value returned by its update method or
+        the exception it would have raised. The default implementation
+        updates each service separately.
+
+        :param proto: ``ipv4`` or ``ipv6``
+        :param address: the new address
+        :param services: list of the services to update
+        """
+        results = list()
+        for service in services:
+            try:
+                results.append(getattr(service, "update_" + proto)(address))
+            except Exception as e:
+                results.append(e)
+        return results
+
+    async def async_update_batch(self, proto, address, services):
+        """
+        Asynchronous version of :meth:`update_batch`, used by the asyncio
+        engine. The default implementation runs :meth:`update_batch` in an
+        executor.
+        """
+        return await _run_blocking(self.update_batch, proto, address, services)
+
+    def __str__(self):
+        """
+        If possible, implement this function to provide more information about
+        the service, such as the hostname. The recommended format is
+        ``ClassName [hostname, etc]``. Use ``self.__class__.__name__`` for the
+        class name rather than hard-coding it.
+        """
+        return self.__class__.__name__
+
+
+class ComcastRouter(AddressProvider):
+    """
+    Scrapes the external IPv4 address from a Comcast/XFINITY router. This
+    address provider does not support IPv6 because it doesn't usually make
+    sense to submit the router's IPv6 address to a dynamic DNS service.
+
+    This has been tested with an Arris TG1682G, but may work with other routers
+    using Comcast's firmware.
+
+    :param ip: internal IP address of the router
+    :param username: username for the web interface (usually 'admin')
+    :param password: password for the web interface (router default is 'password')
+    """
+
+    def __init__(self, ip, username="admin", password="password"):
+        self.ip = ip
+        self.username = username
+        self.password = password
+
+    def ipv4(self):
+        from bs4 import BeautifulSoup
+
+        login = session.post(
+            "http://%s/check.php" % self.ip, {"username": self.username, "password": self.password}
+        )
+        auth = login.cookies
+
+        ip_page = session.get("http://%s/comcast_network.php" % self.ip, cookies=auth)
+
+        ip_page = BeautifulSoup(ip_page.text, "html.parser")
+
+        elem = ip_page.find(text="WAN IP Address (IPv4):")
+        return ipaddress.IPv4Address(elem.parent.find_next("span", class_="value").text)
+
+
+class Web(AddressProvider):
+    """
+    Retrieves addresses from a web service (by default: icanhazip). This
+    provider expects the response to contain only the address in plain text
+    (no HTML).
+
+    A list of URLs can be given for each protocol, in which case the services
+    are queried in parallel, starting with those that have responded fastest in
+    the past. In ``first`` mode, the first valid address is used and the
+    remaining requests are abandoned. In ``quorum:N`` mode, an address is only
+    used once N services agree on it.
+
+    :param ipv4_url: URL (or list of URLs) of the service that retrieves an
+                     IPv4 address
+    :param ipv6_url: URL (or list of URLs) of the service that retrieves an
+                     IPv6 address
+    :param mode: ``first`` or ``quorum:N`` (default: ``first``)
+    :param parallel: maximum number of services to query at once (default:
+                     all of them)
+    """
+
+    # Moving average of the response time of each URL, in seconds, keyed by a
+    # hash of the URL so it can be persisted without any tokens it contains
+    _latencies = dict()
+    _latencies_lock = threading.Lock()
+    # Response time recorded for a failed request
+    _FAILURE_LATENCY = 60
+
+    def __init__(
+        self,
+        ipv4_url="https://ipv4.icanhazip.com/",
+        ipv6_url="https://ipv6.icanhazip.com/",
+        mode="first",
+        parallel=None,
+    ):
+        self.ipv4_url = ipv4_url
+        self.ipv6_url = ipv6_url
+        self.mode = mode
+        quorum = mode[7:] if isinstance(mode, str) and mode.startswith("quorum:") else ""
+        if mode == "first":
+            self.quorum = 1
+        elif quorum.isdigit() and int(quorum) > 0:
+            self.quorum = int(quorum)
+        else:
+            raise ConfigException("Invalid mode: %s" % mode)
+        if parallel is not None and (not isinstance(parallel, int) or parallel < 1):
+            raise ConfigException("parallel must be a positive integer")
+        self.parallel = parallel
+
+    def ipv4(self):
+        return self.__lookup(self.ipv4_url, socket.AF_INET, IPv4Address)
+
+    def ipv6(self):
+        return self.__lookup(self.ipv6_url, socket.AF_INET6, IPv6Address)
+
+    async def async_ipv4(self):
+        return await self.__async_lookup(self.ipv4_url, socket.AF_INET, IPv4Address)
+
+    async def async_ipv6(self):
+        return await self.__async_lookup(self.ipv6_url, socket.AF_INET6, IPv6Address)
+
+    @staticmethod
+    def __latency_key(url):
+        return hashlib.sha256(url.encode()).hexdigest()
+
+    @classmethod
+    def __record_latency(cls, url, latency):
+        key = cls.__latency_key(url)
+        with cls._latencies_lock:
+            previous = cls._latencies.get(key, None)
+            cls._latencies[key] = latency if previous is None else (previous + latency) / 2
+
+    @classmethod
+    def _export_latencies(cls):
+        """Get the recorded response times, to be saved in an :class:`_AddressStore`."""
+        with cls._latencies_lock:
+            return dict(cls._latencies)
+
+    @classmethod
+    def _import_latencies(cls, latencies):
+        """Use response times saved by an earlier run, unless more recent ones are known."""
+        with cls._latencies_lock:
+            for key, latency in latencies.items():
+                cls._latencies.setdefault(key, latency)
+
+    def __fastest_first(self, urls):
+        # URLs that have never been queried are tried first
+        with Web._latencies_lock:
+            return sorted(urls, key=lambda url: Web._latencies.get(Web.__latency_key(url), 0))
+
+    def __width(self, urls):
+        # Number of requests in flight at once
+        return max(self.quorum, min(self.parallel or len(urls), len(urls)))
+
+    def __count(self, votes, address):
+        """Count a valid response, returning whether the quorum was reached."""
+        votes[address] = votes.get(address, 0) + 1
+        return votes[address] >= self.quorum
+
+    def __no_result(self, urls, votes, errors):
+        if votes:
+            return AddressProviderException(
+                "Fewer than %d of %d services agreed on an address" % (self.quorum, len(urls))
+            )
+        return AddressProviderException(
+            "All %d services failed: %s" % (len(urls), "; ".join(str(e) for e in errors))
+        )
+
+    def __fetch(self, url, family, address_class):
+        start = time.monotonic()
+        try:
+            address = address_class(_request("GET", url, family).text.rstrip())
+        except Exception:
+            Web.__record_latency(url, Web._FAILURE_LATENCY)
+            raise
+        Web.__record_latency(url, time.monotonic() - start)
+        return address
+
+    async def __async_fetch(self, url, family, address_class):
+        start = time.monotonic()
+        try:
+            r = await async_request("GET", url, family)
+            address = address_class(r.text.rstrip())
+        except Exception:
+            Web.__record_latency(url, Web._FAILURE_LATENCY)
+            raise
+        Web.__record_latency(url, time.monotonic() - start)
+        return address
+
+    def __lookup(self, urls, family, address_class):
+        if isinstance(urls, str):
+            return address_class(_request("GET", urls, family).text.rstrip())
+
+        remaining = iter(self.__fastest_first(urls))
+        votes, errors = dict(), list()
+        # Not a ThreadPoolExecutor, so that slow requests do not keep the
+        # process from exiting once they are abandoned
+        executor = _DaemonExecutor(self.__width(urls))
+        in_flight = set()
+
+        def start_next():
+            url = next(remaining, None)
+            if url is not None:
+                in_flight.add(
+                    executor.submit(_with_context(self.__fetch, url, family, address_class))
+                )
+
+        try:
+            for _ in range(self.__width(urls)):
+                start_next()
+            while in_flight:
+                done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+                for future in done:
+                    in_flight.remove(future)
+                    try:
+                        if self.__count(votes, future.result()):
+                            return future.result()
+                    except Exception as e:
+                        errors.append(e)
+                    start_next()
+        finally:
+            # Requests that have already started cannot be interrupted, but
+            # their results are ignored
+            for future in in_flight:
+                future.cancel()
+            executor.shutdown()
+        raise self.__no_result(urls, votes, errors)
+
+    async def __async_lookup(self, urls, family, address_class):
+        import asyncio
+
+        if isinstance(urls, str):
+            r = await async_request("GET", urls, family)
+            return address_class(r.text.rstrip())
+
+        remaining = iter(self.__fastest_first(urls))
+        votes, errors = dict(), list()
+        in_flight = set()
+
+        def start_next():
+            url = next(remaining, None)
+            if url is not None:
+                in_flight.add(asyncio.ensure_future(self.__async_fetch(url, family, address_class)))
+
+        try:
+            for _ in range(self.__width(urls)):
+                start_next()
+            while in_flight:
+                done, _ = await asyncio.wait(in_flight, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    in_flight.remove(task)
+                    try:
+                        if self.__count(votes, task.result()):
+                            return task.result()
+                    except Exception as e:
+                        errors.append(e)
+                    start_next()
+        finally:
+            for task in in_flight:
+                task.cancel()
+        raise self.__no_result(urls, votes, errors)
+
+
+class Local(AddressProvider):
+    """
+    Retrieves addresses from a local network interface. If you are behind NAT
+    (which is often the case if you are using dynamic DNS), this provider will
+    return not return any IPv4 address, unless you enable the ``allow_private``
+    option. Normally, you will want to use a different provider for IPv4 if you
+    are behind NAT.
+
+    On Linux, this provider listens for address changes using rtnetlink when
+    running in daemon mode, so that updates happen as soon as an address is
+    assigned or removed.
+
+    :param interface: name of the interface to use
+    :param allow_private: consider a private address to be valid
+    """
+
+    def __init__(self, interface, allow_private=False):
+        import netifaces
+
+        self.interface = interface
+        self.allow_private = allow_private
+        self.addresses = netifaces.ifaddresses(interface)
+        self.__netlink = None
+
+    def __refresh(self):
+        import netifaces
+
+        # Addresses may have changed since the last lookup in daemon mode
+        self.addresses = netifaces.ifaddresses(self.interface)
+
+    def ipv4(self):
+        import netifaces
+
+        self.__refresh()
+        try:
+            addr = next(
+                filter(
+                    lambda a: self.__is_valid_address(a),
+                    map(
+                        lambda addr_string: IPv4Address(addr_string["addr"]),
+                        self.addresses[netifaces.AF_INET],
+                    ),
+                )
+            )
+
+            return addr
+        except (KeyError, StopIteration):
+            raise AddressProviderException(
+                "Interface %s has no valid IPv4 address" % self.interface
+            )
+
+    def ipv6(self):
+        import netifaces
+
+        self.__refresh()
+        try:
+            addr = next(
+                filter(
+                    lambda a: self.__is_valid_address(a),
+                    map(
+                        lambda addr_string: IPv6Address(addr_string["addr"].split("%", 1)[0]),
+                        self.addresses[netifaces.AF_INET6],
+                    ),
+                ),
+                None,
+            )
+            return addr
+        except (KeyError, StopIteration):
+            raise AddressProviderException(
+                "Interface %s has no valid IPv6 address" % self.interface
+            )
+
+    def __is_valid_address(self, addr):
+        return addr.is_global or (self.allow_private and addr.is_private)
+
+    def watch(self):
+        # Subscribe to address change events using rtnetlink (Linux only)
+        if self.__netlink is None and hasattr(socket, "AF_NETLINK"):
+            netlink = socket.socket(socket.AF_NETLINK, socket.SOCK_RAW, socket.NETLINK_ROUTE)
+            netlink.setblocking(False)
+            netlink.bind((0, _RTMGRP_IPV4_IFADDR | _RTMGRP_IPV6_IFADDR))
+            self.__netlink = netlink
+        return self.__netlink
+
+    def changed(self):
+        if self.__netlink is None:
+            # Not watching, so changes cannot be ruled out
+            return True
+        try:
+            index = socket.if_nametoindex(self.interface)
+        except OSError:
+            # Interface has been removed
+            index = None
+        changed = False
+        while True:
+            try:
+                data = self.__netlink.recv(65536)
+            except BlockingIOError:
+                break
+            except OSError as e:
+                if e.errno != errno.ENOBUFS:
+                    raise
+                # The receive buffer overflowed and events were lost
+                changed = True
+                continue
+            for msg_type, _, flags, msg_index in _parse_rtnetlink_addr_events(data):
+                # Wait for duplicate address detection to finish before using
+                # a new IPv6 address
+                tentative = msg_type == _RTM_NEWADDR and flags & _IFA_F_TENTATIVE
+                if msg_index == index and not tentative:
+                    changed = True
+        return changed
+
+
+# rtnetlink constants, see rtnetlink(7)
+_RTM_NEWADDR = 20
+_RTM_DELADDR = 21
+_RTMGRP_IPV4_IFADDR = 0x10
+_RTMGRP_IPV6_IFADDR = 0x100
+_IFA_F_TENTATIVE = 0x40
+_NLMSGHDR = struct.Struct("=IHHII")
+_IFADDRMSG = struct.Struct("=BBBBI")
+
+
+def _parse_rtnetlink_addr_events(data):
+    """
+    Parse a datagram received from an rtnetlink socket, yielding
+    ``(type, family, flags, interface index)`` for each RTM_NEWADDR and
+    RTM_DELADDR message.
+    """
+    offset = 0
+    while offset + _NLMSGHDR.size <= len(data):
+        length, msg_type = _NLMSGHDR.unpack_from(data, offset)[:2]
+        if length < _NLMSGHDR.size:
+            break
+        if msg_type in (_RTM_NEWADDR, _RTM_DELADDR) and length >= _NLMSGHDR.size + _IFADDRMSG.size:
+            family, _, flags, _, index = _IFADDRMSG.unpack_from(data, offset + _NLMSGHDR.size)
+            yield msg_type, family, flags, index
+        # Messages are aligned to 4 bytes
+        offset += (length + 3) & ~3
+
+
+# DNS constants, see RFC 1035, RFC 2136 and RFC 8945
+_DNS_HEADER = struct.Struct("!HHHHHH")
+_DNS_RR = struct.Struct("!HHIH")
+# 48-bit time signed and fudge of a TSIG record
+_TSIG_TIME = struct.Struct("!HIH")
+_DNS_OPCODE_UPDATE = 5
+_DNS_FLAG_QR = 0x8000
+_DNS_FLAG_TC = 0x0200
+_DNS_FLAG_RD = 0x0100
+_DNS_TYPE_A = 1
+_DNS_TYPE_SOA = 6
+_DNS_TYPE_TXT = 16
+_DNS_TYPE_AAAA = 28
+_DNS_TYPE_TSIG = 250
+_DNS_CLASS_IN = 1
+_DNS_CLASS_ANY = 255
+# Largest message that can be sent over UDP without EDNS
+_DNS_MAX_UDP_SIZE = 512
+# Allowed difference between the clocks of the client and the server
+_TSIG_FUDGE = 300
+
+# Maps the name of each TSIG algorithm to its name in messages and its digest
+_TSIG_ALGORITHMS = {
+    "hmac-md5": ("hmac-md5.sig-alg.reg.int", "md5"),
+    "hmac-sha1": ("hmac-sha1", "sha1"),
+    "hmac-sha224": ("hmac-sha224", "sha224"),
+    "hmac-sha256": ("hmac-sha256", "sha256"),
+    "hmac-sha384": ("hmac-sha384", "sha384"),
+    "hmac-sha512": ("hmac-sha512", "sha512"),
+}
+
+# Exception and message for each response code, see RFC 2136 section 2.2
+_DNS_RCODES = {
+    1: (UpdateException, "Server could not interpret the update (FORMERR)"),
+    2: (UpdateServiceException, "Server failed to process the update (SERVFAIL)"),
+    3: (UpdateException, "Prerequisite name does not exist (NXDOMAIN)"),
+    4: (UpdateClientException, "Server does not support dynamic updates (NOTIMP)"),
+    5: (UpdateClientException, "Update was refused by the server (REFUSED)"),
+    6: (UpdateException, "Prerequisite name exists (YXDOMAIN)"),
+    7: (UpdateException, "Prerequisite record set exists (YXRRSET)"),
+    8: (UpdateException, "Prerequisite record set does not exist (NXRRSET)"),
+    9: (UpdateClientException, "Server is not authoritative for the zone (NOTAUTH)"),
+    10: (UpdateClientException, "Hostname is not in the zone (NOTZONE)"),
+}
+_TSIG_ERRORS = {
+    16: "TSIG signature was rejected by the server (BADSIG)",
+    17: "TSIG key is not known by the server (BADKEY)",
+    18: "TSIG signature has expired, check the clock (BADTIME)",
+}
+
+
+def _dns_name(name):
+    """Encode a domain name in canonical DNS wire format."""
+    name = name.rstrip(".").lower()
+    labels = name.encode("idna").split(b".") if name else list()
+    return b"".join(bytes((len(label),)) + label for label in labels) + b"\0"
+
+
+def _dns_skip_name(data, offset):
+    """Get the offset of the end of the (possibly compressed) name at ``offset``."""
+    while True:
+        length = data[offset]
+        if length >= 0xC0:
+            # Compression pointer
+            return offset + 2
+        offset += length + 1
+        if length == 0:
+            return offset
+
+
+def _tsig_variables(key_name, algorithm, time_signed, fudge, error=0, other=b""):
+    """Encode the TSIG variables that are included in the MAC of a message."""
+    return b"".join(
+        [
+            _dns_name(key_name),
+            struct.pack("!HI", _DNS_CLASS_ANY, 0),
+            _dns_name(algorithm),
+            _TSIG_TIME.pack(time_signed >> 32, time_signed & 0xFFFFFFFF, fudge),
+            struct.pack("!HH", error, len(other)),
+            other,
+        ]
+    )
+
+
+def _recv_exactly(sock, size):
+    data = b""
+    while len(data) < size:
+        chunk = sock.recv(size - len(data))
+        if not chunk:
+            raise UpdateServiceException("DNS server closed the connection")
+        data += chunk
+    return data
+
+
+def _dns_query(message_id, name, record_type):
+    """Encode a recursive query for the records of a type."""
+    header = _DNS_HEADER.pack(message_id, _DNS_FLAG_RD, 1, 0, 0, 0)
+    return header + _dns_name(name) + struct.pack("!HH", record_type, _DNS_CLASS_IN)
+
+
+def _dns_answers(response, record_type):
+    """
+    Parse the response to a query, returning its response code and the data
+    of its answers of a type. Raises :class:`ValueError` if the message is not
+    a response.
+    """
+    _, flags, questions, answers = _DNS_HEADER.unpack_from(response)[:4]
+    if not flags & _DNS_FLAG_QR:
+        raise ValueError("Message is not a response")
+    offset = _DNS_HEADER.size
+    for _ in range(questions):
+        offset = _dns_skip_name(response, offset) + 4
+    data = list()
+    for _ in range(answers):
+        offset = _dns_skip_name(response, offset)
+        answer_type, _, _, size = _DNS_RR.unpack_from(response, offset)
+        offset += _DNS_RR.size
+        if answer_type == record_type:
+            data.append(response[offset : offset + size])
+        offset += size
+    return flags & 0xF, data
+
+
+def _dns_exchange_udp(server, port, message, timeout, family=socket.AF_UNSPEC):
+    """Send a DNS message over UDP, returning the response with the same ID."""
+    family, sock_type, proto, _, address = socket.getaddrinfo(
+        server, port, family, socket.SOCK_DGRAM
+    )[0]
+    with socket.socket(family, sock_type, proto) as sock:
+        sock.settimeout(timeout)
+        sock.connect(address)
+        sock.send(message)
+        while True:
+            response = sock.recv(65535)
+            # Ignore responses to other messages
+            if response[:2] == message[:2]:
+                return response
+
+
+def _dns_query_many(server, port, questions, timeout, window=100):
+    """
+    Send queries for many ``(name, record type)`` questions to a DNS server
+    over a single UDP socket, with up to ``window`` queries in flight at
+    once. Returns a dict mapping each question that was answered within
+    ``timeout`` seconds of being sent to its response code and answers.
+    """
+    family, sock_type, proto, _, address = socket.getaddrinfo(server, port, type=socket.SOCK_DGRAM)[
+        0
+    ]
+    pending = list(reversed(questions))
+    # Maps the ID of each query in flight to its question and deadline
+    in_flight = dict()
+    results = dict()
+    with socket.socket(family, sock_type, proto) as sock:
+        sock.connect(address)
+        while pending or in_flight:
+            while pending and len(in_flight) < window:
+                question = pending.pop()
+                message_id = random.getrandbits(16)
+                while message_id in in_flight:
+                    message_id = random.getrandbits(16)
+                sock.send(_dns_query(message_id, *question))
+                in_flight[message_id] = (question, time.monotonic() + timeout)
+
+            now = time.monotonic()
+            for message_id, (_, deadline) in list(in_flight.items()):
+                if deadline <= now:
+                    del in_flight[message_id]
+            if not in_flight:
+                continue
+            sock.settimeout(min(deadline for _, deadline in in_flight.values()) - now)
+            try:
+                response = sock.recv(65535)
+            except socket.timeout:
+                continue
+
+            try:
+                (message_id,) = struct.unpack_from("!H", response)
+                if message_id in in_flight:
+                    question = in_flight[message_id][0]
+                    results[question] = _dns_answers(response, question[1])
+                    del in_flight[message_id]
+            except (ValueError, IndexError, struct.error):
+                # Ignore invalid responses
+                pass
+    return results
+
+
+class DNSQuery(AddressProvider):
+    """
+    Retrieves addresses with a single DNS query to a resolver that answers
+    with the address the query came from, which is much cheaper than an HTTPS
+    request. By default, OpenDNS is asked for the A or AAAA record of
+    ``myip.opendns.com``. Google can be used instead by querying the TXT
+    record of ``o-o.myaddr.l.google.com`` from ``ns1.google.com``.
+
+    The query for each protocol is sent over that protocol, so the resolver
+    must be reachable using it. If a resolver does not respond, the query is
+    retried, trying each of the resolvers in turn.
+
+    :param ipv4_resolver: address (or list of addresses) of the resolver used
+                          to get the IPv4 address
+    :param ipv6_resolver: address (or list of addresses) of the resolver used
+                          to get the IPv6 address
+    :param name: domain name to query (default: ``myip.opendns.com``)
+    :param record_type: ``address`` to query A or AAAA records (the default),
+                        or ``TXT`` to query TXT records containing the address
+    :param timeout: seconds to wait for each response (default: 2)
+    :param retries: number of times the query is retried (default: 2)
+    :param port: port of the resolvers (default: 53)
+    """
+
+    def __init__(
+        self,
+        ipv4_resolver="208.67.222.222",
+        ipv6_resolver="2620:119:35::35",
+        name="myip.opendns.com",
+        record_type="address",
+        timeout=2,
+        retries=2,
+        port=53,
+    ):
+        if record_type not in ("address", "TXT"):
+            raise ValueError("Invalid record type: %s" % record_type)
+        self.ipv4_resolver = ipv4_resolver
+        self.ipv6_resolver = ipv6_resolver
+        self.name = name
+        self.record_type = record_type
+        self.timeout = timeout
+        self.retries = retries
+        self.port = port
+        # Check that the name is valid
+        _dns_name(name)
+
+    def ipv4(self):
+        return self.__lookup(self.ipv4_resolver, socket.AF_INET, _DNS_TYPE_A, IPv4Address)
+
+    def ipv6(self):
+        return self.__lookup(self.ipv6_resolver, socket.AF_INET6, _DNS_TYPE_AAAA, IPv6Address)
+
+    @staticmethod
+    def __answers(response, record_type):
+        rcode, answers = _dns_answers(response, record_type)
+        if rcode != 0:
+            raise AddressProviderException("DNS resolver returned error code %d" % rcode)
+        return answers
+
+    def __parse(self, response, record_type, address_class):
+        if self.record_type == "TXT":
+            for data in self.__answers(response, _DNS_TYPE_TXT):
+                # TXT records contain a list of length prefixed strings
+                offset = 0
+                while offset < len(data):
+                    text = data[offset + 1 : offset + 1 + data[offset]]
+                    offset += data[offset] + 1
+                    try:
+                        return address_class(text.decode())
+                    except ValueError:
+                        pass
+        else:
+            for data in self.__answers(response, record_type):
+                return address_class(data)
+        raise AddressProviderException("DNS resolver did not return an address")
+
+    def __lookup(self, resolvers, family, record_type, address_class):
+        if isinstance(resolvers, str):
+            resolvers = [resolvers]
+        query_type = _DNS_TYPE_TXT if self.record_type == "TXT" else record_type
+        error = None
+        for attempt in range(self.retries + 1):
+            resolver = resolvers[attempt % len(resolvers)]
+            timeout = _timeouts.for_request(self.timeout)[1]
+            try:
+                with span("dns", server=resolver, transport="udp"):
+                    query = _dns_query(random.getrandbits(16), self.name, query_type)
+                    response = _dns_exchange_udp(resolver, self.port, query, timeout, family)
+            except OSError as e:
+                # Includes timeouts
+                error = e
+                continue
+            try:
+                return self.__parse(response, record_type, address_class)
+            except (ValueError, IndexError, struct.error):
+                raise AddressProviderException("Invalid response from DNS resolver")
+        raise AddressProviderException(
+            "No response from DNS resolver for %s: %s" % (self.name, str(error) or "timed out")
+        )
+
+
+class StaticURL(DNSService):
+    """
+    Updates addresses by sending an HTTP GET request to statically configured
+    URLs. When using this type of service, the remote server will automatically
+    detect your IP and therefore the address provided by the configured address
+    provider will not be used. In most cases, the result will be the same as if
+    the :class:`Web` provider had been used.
+
+    :param ipv4_url: URL used to update the IPv4 address
+    :param ipv6_url: URL used to update the IPv6 address
+    """
+
+    def __init__(self, ipv4_url, ipv6_url=None):
+        self.ipv4_url = ipv4_url
+        self.ipv6_url = ipv6_url
+
+    def update_ipv4(self, address=None):
+        session.get(self.ipv4_url)
+
+    def update_ipv6(self, address=None):
+        session.get(self.ipv6_url)
+
+    async def async_update_ipv4(self, address=None):
+        await async_request("GET", self.ipv4_url)
+
+    async def async_update_ipv6(self, address=None):
+        await async_request("GET", self.ipv6_url)
+
+
+class FreeDNS(DNSService):
+    """
+    Updates a domain on FreeDNS_ using the version 2 interface. This API uses a
+    single key for each entry (separate ones for IPv4 and IPv6) instead of
+    separately passing the domain, username and password. The keys are the last
+    part of the given update URL, not including the trailing slash.
+
+    For example, the update key for the URL
+    ``http://sync.afraid.org/u/VWZIcQnBScVv8yv8DhJxDbnt/`` is
+    ``VWZIcQnBScVv8yv8DhJxDbnt``
+
+    .. _FreeDNS: http://freedns.afraid.org
+
+    :param ipv4_key: update key for IPv4
+    :param ipv6_key: update key for IPv6
+    """
+
+    def __init__(self, ipv4_key, ipv6_key=None):
+        self.ipv4_key = ipv4_key
+        self.ipv6_key = ipv6_key
+
+    IPV4_URL = "https://sync.afraid.org/u/%s/"
+    IPV6_URL = "https://v6.sync.afraid.org/u/%s/"
+
+    @staticmethod
+    def __params(address):
+        # Ask for json response
+        return {"content-type": "json", "ip": address}
+
+    @staticmethod
+    def __update(update_url, address):
+        return FreeDNS.__check_response(session.get(update_url, params=FreeDNS.__params(address)))
+
+    @staticmethod
+    async def __async_update(update_url, address):
+        r = await async_request("GET", update_url, params=FreeDNS.__params(address))
+        return FreeDNS.__check_response(r)
+
+    @staticmethod
+    def __check_response(r):
+        if r.status_code == 200:
+            r = r.json()
+            # Check for error
+            if "errorno" in r:
                 # Throw exception using message from response
                 raise UpdateException(r.get("summary", "Unknown error"))
             else:
-                # List of domains that were updated
-                targets = r.get("targets", None)
-                if targets is not None or len(r["targets"]) == 0:
-                    # Return True if ip was updated (status 0). Status 100 means no change.
-                    return targets[0].get("statuscode", None) == 0
-                else:
-                    raise UpdateException("Response did not include status.")
+                # List of domains that were updated
+                targets = r.get("targets", None)
+                if targets is not None or len(r["targets"]) == 0:
+                    # Return True if ip was updated (status 0). Status 100 means no change.
+                    return targets[0].get("statuscode", None) == 0
+                else:
+                    raise UpdateException("Response did not include status.")
+        else:
+            r.raise_for_status()
+            return False
+
+    def update_ipv4(self, address):
+        return FreeDNS.__update(FreeDNS.IPV4_URL % self.ipv4_key, address)
+
+    def update_ipv6(self, address):
+        return FreeDNS.__update(FreeDNS.IPV6_URL % self.ipv6_key, address)
+
+    async def async_update_ipv4(self, address):
+        return await FreeDNS.__async_update(FreeDNS.IPV4_URL % self.ipv4_key, address)
+
+    async def async_update_ipv6(self, address):
+        return await FreeDNS.__async_update(FreeDNS.IPV6_URL % self.ipv6_key, address)
+
+
+class StandardService(DNSService):
+    """
+    Updates a DNS service that uses the `defacto standard protocol`_ that has
+    been defined by Dyn. All the standard return codes are handled. Client
+    configuration errors will cause the service to be disabled.
+
+    .. _defacto standard protocol: https://help.dyn.com/remote-access-api/
+
+    :param service_ipv4: domain name of the IPv4 update service
+    :param service_ipv6: domain name of the IPv6 update service
+    :param username: service username (some services use the your (sub)domain
+                     name as the username)
+    :param password: service password (sometimes this is a unique password for
+                     a specific (sub)domain rather than your actual password)
+    :param hostname: fully qualified domain name to update
+    :param extra_params: other keyword arguments that will be appended to the
+                         request URL
+
+    Services with the same update service, credentials and extra parameters
+    that are being updated to the same address are updated together, using a
+    single request with a comma separated list of hostnames.
+    """
+
+    # Dyn allows up to 20 hostnames to be updated by each request
+    max_batch_size = 20
+
+    identity_args = ("service_ipv4", "service_ipv6", "username", "hostname")
+
+    def __init__(self, service_ipv4, service_ipv6, username, password, hostname, **extra_params):
+        self.service_ipv4 = service_ipv4
+        self.service_ipv6 = service_ipv6
+        self.username = username
+        self.password = password
+        self.hostname = hostname
+        self.extra_params = extra_params
+
+    def __params(self, address, hostname):
+        return {**{"myip": address, "hostname": hostname}, **self.extra_params}
+
+    def __update(self, service_host, address, hostname):
+        return session.get(
+            "https://%s/nic/update" % service_host,
+            auth=(self.username, self.password),
+            params=self.__params(address, hostname),
+        )
+
+    async def __async_update(self, service_host, address, hostname):
+        return await async_request(
+            "GET",
+            "https://%s/nic/update" % service_host,
+            auth=(self.username, self.password),
+            params=self.__params(address, hostname),
+        )
+
+    @staticmethod
+    def __check_response(r, text=None):
+        status = (r.text if text is None else text).split(" ", 1)[0]
+        if status == "good":
+            return True
+        elif status == "nochg":
+            return False
+        elif status == "badauth" or r.status_code == 401:
+            raise UpdateClientException("Incorrect login credentials")
+        elif status == "!donator":
+            raise UpdateClientException("Feature is only available to paying users")
+        elif status == "notfqdn":
+            raise UpdateClientException("Incorrect hostname format")
+        elif status == "nohost":
+            raise UpdateClientException("Hostname does not belong to this account")
+        elif status == "abuse":
+            raise UpdateClientException("Hostname has been blocked for abuse")
+        elif status == "badagent":
+            raise UpdateClientException("User agent or HTTP method was rejected")
+        elif status == "dnserr":
+            raise UpdateServiceException("Server DNS error encountered")
+        elif status == "911":
+            raise UpdateServiceException("Server is not currently functioning correctly")
+        else:
+            raise UpdateException("Unknown response")
+
+    @staticmethod
+    def __check_batch_response(r, services):
+        # The service returns one line for each hostname, in order
+        counts = [len(service.hostname.split(",")) for service in services]
+        lines = r.text.splitlines()
+        if len(lines) != sum(counts):
+            if len(lines) > 1:
+                e = UpdateServiceException(
+                    "Expected %d response lines, got %d" % (sum(counts), len(lines))
+                )
+                return [e] * len(services)
+            # The response applies to the whole request, such as an
+            # authentication error
+            lines = [r.text] * sum(counts)
+        results = list()
+        start = 0
+        for count in counts:
+            try:
+                changed = [
+                    StandardService.__check_response(r, line)
+                    for line in lines[start : start + count]
+                ]
+                results.append(any(changed))
+            except UpdateException as e:
+                results.append(e)
+            start += count
+        return results
+
+    def update_ipv4(self, address):
+        r = self.__update(self.service_ipv4, address, self.hostname)
+        return self.__check_response(r)
+
+    def update_ipv6(self, address):
+        r = self.__update(self.service_ipv6, address, self.hostname)
+        return self.__check_response(r)
+
+    async def async_update_ipv4(self, address):
+        r = await self.__async_update(self.service_ipv4, address, self.hostname)
+        return self.__check_response(r)
+
+    async def async_update_ipv6(self, address):
+        r = await self.__async_update(self.service_ipv6, address, self.hostname)
+        return self.__check_response(r)
+
+    def batch_key(self, proto):
+        # Subclasses that change how updates are performed are not batched
+        method = "update_" + proto
+        if getattr(type(self), method) is not getattr(StandardService, method):
+            return None
+        service_host = getattr(self, "service_" + proto)
+        if service_host is None:
+            return None
+        extra_params = tuple(sorted(self.extra_params.items()))
+        try:
+            hash(extra_params)
+        except TypeError:
+            return None
+        return service_host, self.username, self.password, extra_params
+
+    def hostnames(self):
+        return self.hostname.split(",")
+
+    def __batch_hostname(self, services):
+        return ",".join(service.hostname for service in services)
+
+    def update_batch(self, proto, address, services):
+        service_host = getattr(self, "service_" + proto)
+        r = self.__update(service_host, address, self.__batch_hostname(services))
+        return self.__check_batch_response(r, services)
+
+    async def async_update_batch(self, proto, address, services):
+        service_host = getattr(self, "service_" + proto)
+        r = await self.__async_update(service_host, address, self.__batch_hostname(services))
+        return self.__check_batch_response(r, services)
+
+    def __str__(self):
+        return "%s [%s]" % (self.__class__.__name__, self.hostname)
+
+
+class NSUpdate(StandardService):
+    """
+    Updates a domain on nsupdate.info_. nsupdate.info
+    uses the Dyn protocol.
+
+    .. _nsupdate.info: http://nsupdate.info
+
+    :param hostname: fqdn to update
+    :param secret_key: update key
+    """
+
+    identity_args = ("hostname",)
+
+    def __init__(self, hostname, secret_key):
+        super().__init__("ipv4.nsupdate.info", "ipv6.nsupdate.info", hostname, secret_key, hostname)
+
+
+class OVHDynDNS(StandardService):
+    """
+    Updates a domain using `OVH's DynDNS`_ service. This service uses the
+    standard Dyn protocol, with an extra ``system`` parameter. This service
+    only supports IPv4.
+
+    .. _OVH's DynDNS: http://help.ovh.com/DynDNS
+
+    :param username: account username
+    :param password: account password
+    :param hostname: the hostname to update
+    :param system: the type of update (default: ``dyndns``)
+    """
+
+    identity_args = ("username", "hostname", "system")
+
+    def __init__(self, username, password, hostname, system="dyndns"):
+        super().__init__("www.ovh.com", None, username, password, hostname, system=system)
+
+    def update_ipv6(self, address):
+        # OVH DynDNS does not support IPv6
+        return DNSService.update_ipv6(self, address)
+
+
+class GoogleDomains(StandardService):
+    """
+    Updates a domain registered through `Google Domains`_. This service uses
+    the standard Dyn protocol. This service only supports IPv4.
+
+    .. _Google Domains: https://support.google.com/domains/answer/6147083
+
+    :param username: account username
+    :param password: account password
+    :param hostname: the hostname to update
+    """
+
+    identity_args = ("username", "hostname")
+
+    def __init__(self, username, password, hostname):
+        super().__init__("domains.google.com", None, username, password, hostname)
+
+    def update_ipv6(self, address):
+        # Google Domains does not support IPv6
+        return DNSService.update_ipv6(self, address)
+
+
+class RFC2136(DNSService):
+    """
+    Updates the A or AAAA records of a domain by sending `RFC 2136`_ DNS UPDATE
+    messages directly to the primary server of its zone, such as BIND or
+    Knot. Messages can be signed with a TSIG_ key. Any existing records of the
+    type being updated are replaced.
+
+    Services with the same server, zone, key and TTL that are being updated to
+    the same address are updated together, with up to 100 services in each
+    message. Messages are sent over UDP, or over TCP if they are too large or
+    the response was truncated.
+
+    .. _RFC 2136: https://tools.ietf.org/html/rfc2136
+    .. _TSIG: https://tools.ietf.org/html/rfc8945
+
+    :param server: hostname or address of the DNS server
+    :param zone: name of the zone containing the domain
+    :param hostname: fully qualified domain name to update
+    :param key_name: name of the TSIG key (default: messages are not signed)
+    :param key_secret: base64 encoded secret of the TSIG key
+    :param key_algorithm: TSIG algorithm (default: ``hmac-sha256``), one of
+                          ``hmac-sha256``, ``hmac-sha512``, ``hmac-sha384``,
+                          ``hmac-sha224``, ``hmac-sha1`` or ``hmac-md5``
+    :param ttl: TTL of the records (default: 300)
+    :param port: port of the DNS server (default: 53)
+    """
+
+    # Each service adds two records of at most 281 bytes, so 100 services keep
+    # a message well below the 65535 bytes that can be sent over TCP
+    max_batch_size = 100
+
+    identity_args = ("server", "zone", "hostname", "key_name", "port")
+
+    def __init__(
+        self,
+        server,
+        zone,
+        hostname,
+        key_name=None,
+        key_secret=None,
+        key_algorithm="hmac-sha256",
+        ttl=300,
+        port=53,
+    ):
+        if (key_name is None) != (key_secret is None):
+            raise ValueError("key_name and key_secret must be specified together")
+        if key_algorithm not in _TSIG_ALGORITHMS:
+            raise ValueError("Unsupported TSIG algorithm: %s" % key_algorithm)
+        self.server = server
+        self.zone = zone
+        self.hostname = hostname
+        self.key_name = key_name
+        self.key_secret = key_secret
+        self.key_algorithm = key_algorithm
+        self.ttl = ttl
+        self.port = port
+        # Check that the names and the secret are valid
+        _dns_name(zone)
+        _dns_name(hostname)
+        if key_name is not None:
+            _dns_name(key_name)
+            base64.b64decode(key_secret, validate=True)
+
+    def __message(self, message_id, proto, address, services):
+        record_type = _DNS_TYPE_A if proto == "ipv4" else _DNS_TYPE_AAAA
+        rdata = ipaddress.ip_address(str(address)).packed
+        updates = list()
+        for service in services:
+            name = _dns_name(service.hostname)
+            # Delete the existing records, then add the new one
+            updates.append(name + _DNS_RR.pack(record_type, _DNS_CLASS_ANY, 0, 0))
+            updates.append(
+                name + _DNS_RR.pack(record_type, _DNS_CLASS_IN, self.ttl, len(rdata)) + rdata
+            )
+        header = _DNS_HEADER.pack(message_id, _DNS_OPCODE_UPDATE << 11, 1, 0, len(updates), 0)
+        zone = _dns_name(self.zone) + struct.pack("!HH", _DNS_TYPE_SOA, _DNS_CLASS_IN)
+        return header + zone + b"".join(updates)
+
+    def __sign(self, message):
+        """Add a TSIG record to a message, returning the message and its MAC."""
+        algorithm, digest = _TSIG_ALGORITHMS[self.key_algorithm]
+        time_signed = int(time.time())
+        mac = hmac.new(
+            base64.b64decode(self.key_secret),
+            message + _tsig_variables(self.key_name, algorithm, time_signed, _TSIG_FUDGE),
+            digest,
+        ).digest()
+        rdata = b"".join(
+            [
+                _dns_name(algorithm),
+                _TSIG_TIME.pack(time_signed >> 32, time_signed & 0xFFFFFFFF, _TSIG_FUDGE),
+                struct.pack("!H", len(mac)),
+                mac,
+                # Original message ID, error and other data length
+                struct.pack("!HHH", _DNS_HEADER.unpack_from(message)[0], 0, 0),
+            ]
+        )
+        tsig = _dns_name(self.key_name) + _DNS_RR.pack(
+            _DNS_TYPE_TSIG, _DNS_CLASS_ANY, 0, len(rdata)
+        )
+        additional = _DNS_HEADER.unpack_from(message)[5] + 1
+        return message[:10] + struct.pack("!H", additional) + message[12:] + tsig + rdata, mac
+
+    def __verify(self, response, request_mac):
+        """Check the TSIG record of a response, raising an exception if it is invalid."""
+        counts = _DNS_HEADER.unpack_from(response)[2:]
+        offset = _DNS_HEADER.size
+        # Find the start of the last record, which must be the TSIG record
+        for _ in range(counts[0]):
+            offset = _dns_skip_name(response, offset) + 4
+        start = None
+        for _ in range(sum(counts[1:])):
+            start = offset
+            offset = _dns_skip_name(response, offset)
+            record_type = _DNS_RR.unpack_from(response, offset)[0]
+            offset += _DNS_RR.size + _DNS_RR.unpack_from(response, offset)[3]
+        if start is None or counts[3] == 0 or record_type != _DNS_TYPE_TSIG:
+            raise UpdateServiceException("Response from DNS server is not signed")
+
+        rdata = _dns_skip_name(response, start) + _DNS_RR.size
+        algorithm_end = _dns_skip_name(response, rdata)
+        time_high, time_low, fudge = _TSIG_TIME.unpack_from(response, algorithm_end)
+        (mac_size,) = struct.unpack_from("!H", response, algorithm_end + _TSIG_TIME.size)
+        mac_start = algorithm_end + _TSIG_TIME.size + 2
+        mac = response[mac_start : mac_start + mac_size]
+        original_id, error, other_size = struct.unpack_from("!HHH", response, mac_start + mac_size)
+        other = response[mac_start + mac_size + 6 :][:other_size]
+        if error in _TSIG_ERRORS:
+            raise UpdateClientException(_TSIG_ERRORS[error])
+
+        algorithm, digest = _TSIG_ALGORITHMS[self.key_algorithm]
+        time_signed = (time_high << 32) | time_low
+        # The MAC covers the response as it was before the TSIG record was added
+        signed = b"".join(
+            [
+                struct.pack("!H", len(request_mac)),
+                request_mac,
+                struct.pack("!H", original_id),
+                response[2:10],
+                struct.pack("!H", counts[3] - 1),
+                response[12:start],
+                _tsig_variables(self.key_name, algorithm, time_signed, fudge, error, other),
+            ]
+        )
+        expected = hmac.new(base64.b64decode(self.key_secret), signed, digest).digest()
+        if not hmac.compare_digest(mac, expected):
+            raise UpdateServiceException("Response from DNS server has an invalid signature")
+        if abs(time.time() - time_signed) > fudge:
+            raise UpdateServiceException("Response from DNS server has expired")
+
+    def __exchange_tcp(self, message, connect_timeout, read_timeout):
+        with socket.create_connection((self.server, self.port), connect_timeout) as sock:
+            sock.settimeout(read_timeout)
+            sock.sendall(struct.pack("!H", len(message)) + message)
+            (size,) = struct.unpack("!H", _recv_exactly(sock, 2))
+            return _recv_exactly(sock, size)
+
+    def __exchange(self, message):
+        connect_timeout, read_timeout = _timeouts.for_request()
+        try:
+            if len(message) <= _DNS_MAX_UDP_SIZE:
+                with span("dns", server=self.server, transport="udp"):
+                    response = _dns_exchange_udp(self.server, self.port, message, read_timeout)
+                if not _DNS_HEADER.unpack_from(response)[1] & _DNS_FLAG_TC:
+                    return response
+            with span("dns", server=self.server, transport="tcp"):
+                return self.__exchange_tcp(message, connect_timeout, read_timeout)
+        except socket.timeout:
+            raise UpdateServiceException("Timed out waiting for DNS server")
+
+    def update_batch(self, proto, address, services):
+        message = self.__message(random.getrandbits(16), proto, address, services)
+        request_mac = None
+        if self.key_name is not None:
+            message, request_mac = self.__sign(message)
+        response = self.__exchange(message)
+        try:
+            flags = _DNS_HEADER.unpack_from(response)[1]
+            if not flags & _DNS_FLAG_QR:
+                raise UpdateServiceException("Invalid response from DNS server")
+            if request_mac is not None:
+                self.__verify(response, request_mac)
+        except (IndexError, struct.error):
+            raise UpdateServiceException("Invalid response from DNS server")
+        rcode = flags & 0xF
+        if rcode in _DNS_RCODES:
+            exception_class, message = _DNS_RCODES[rcode]
+            raise exception_class(message)
+        if rcode != 0:
+            raise UpdateException("Unknown response code: %d" % rcode)
+        return [True] * len(services)
+
+    def update_ipv4(self, address):
+        return self.update_batch("ipv4", address, [self])[0]
+
+    def update_ipv6(self, address):
+        return self.update_batch("ipv6", address, [self])[0]
+
+    def hostnames(self):
+        return [self.hostname]
+
+    def batch_key(self, proto):
+        return (
+            self.server,
+            self.port,
+            _dns_name(self.zone),
+            self.key_name,
+            self.key_secret,
+            self.key_algorithm,
+            self.ttl,
+        )
+
+    def __str__(self):
+        return "%s [%s]" % (self.__class__.__name__, self.hostname)
+
+
+def _compiled_config_file(config_file):
+    """Get the path where the parsed contents of a config file are cached."""
+    cache_dir = os.environ.get("XDG_CACHE_HOME", None) or os.path.expanduser("~/.cache")
+    name = hashlib.sha256(os.path.abspath(config_file).encode()).hexdigest()[:32]
+    return os.path.join(cache_dir, "dnsupdate", "config-%s.json" % name)
+
+
+# Offset of the header of a compiled config, stored at the end of the file
+_COMPILED_CONFIG_TRAILER = struct.Struct("!Q")
+
+
+def _compiled_line(value):
+    """
+    Serialize part of a compiled config as a line of JSON. Raises
+    :class:`ValueError` if the value would not be loaded back unchanged, such
+    as timestamps or mappings with keys that are not strings.
+    """
+    try:
+        text = json.dumps(value, separators=(",", ":"))
+    except TypeError as e:
+        raise ValueError(e)
+    if json.loads(text) != value:
+        raise ValueError("Config cannot be stored as JSON")
+    return text.encode() + b"\n"
+
+
+def _write_compiled_header(f, files, config, has_services, chunks):
+    offset = f.tell()
+    files = {filename: list(info) for filename, info in files.items()}
+    f.write(_compiled_line([__version__, files, config, has_services, chunks]))
+    f.write(_COMPILED_CONFIG_TRAILER.pack(offset))
+
+
+def _load_compiled_config(config_file, on_service, on_discard, start=0, stop=None):
+    """
+    Load the cached contents of a config file, calling ``on_service`` with
+    services ``start`` to ``stop`` (or the last one) and returning ``(config,
+    files, has_services)``, or ``None`` if it was not cached or any of the
+    files it was parsed from has changed since. Chunks of services outside
+    that range are not decoded. If the cache turns out to be corrupted after
+    some services were passed to ``on_service``, ``on_discard`` is called to
+    forget them.
+    """
+    compiled_config_file = _compiled_config_file(config_file)
+    try:
+        f = open(compiled_config_file, "rb")
+    except OSError:
+        return None
+    with f:
+        try:
+            f.seek(-_COMPILED_CONFIG_TRAILER.size, os.SEEK_END)
+            (offset,) = _COMPILED_CONFIG_TRAILER.unpack(f.read(_COMPILED_CONFIG_TRAILER.size))
+            f.seek(offset)
+            version, files, config, has_services, chunks = json.loads(f.readline())
+            # Find the chunk holding the first service needed
+            position, chunk_offset = 0, offset
+            for chunk_offset, count in chunks:
+                if position + count > start:
+                    break
+                position += count
+            else:
+                chunk_offset = offset
+        except Exception:
+            return None
+        if version != __version__:
+            return None
+        touched = False
+        for filename, (mtime, size, digest) in files.items():
+            try:
+                st = os.stat(filename)
+            except OSError:
+                return None
+            if (st.st_mtime, st.st_size) != (mtime, size):
+                # Compare the contents if the file has been touched
+                try:
+                    with open(filename, "r") as g:
+                        if _text_digest(g.read()) != digest:
+                            return None
+                except OSError:
+                    return None
+                files[filename] = (st.st_mtime, st.st_size, digest)
+                touched = True
+        if touched:
+            _rewrite_compiled_header(
+                f, offset, compiled_config_file, files, config, has_services, chunks
+            )
+        f.seek(chunk_offset)
+        while f.tell() < offset and (stop is None or position < stop):
+            try:
+                chunk = json.loads(f.readline())
+                if not isinstance(chunk, list):
+                    raise ValueError("Chunk is not a list")
+            except ValueError:
+                on_discard()
+                return None
+            for service_root in chunk:
+                if start <= position and (stop is None or position < stop):
+                    on_service(service_root)
+                position += 1
+    return config, files, has_services
+
+
+def _rewrite_compiled_header(f, offset, compiled_config_file, files, config, has_services, chunks):
+    """Replace the header of a compiled config, copying its services unchanged."""
+    try:
+        new = _AtomicFile(compiled_config_file, binary=True, mode=0o600)
+    except OSError:
+        return
+    try:
+        f.seek(0)
+        remaining = offset
+        while remaining > 0:
+            data = f.read(min(remaining, 1 << 20))
+            if not data:
+                raise OSError("Compiled config is truncated")
+            new.file.write(data)
+            remaining -= len(data)
+        _write_compiled_header(new.file, files, config, has_services, chunks)
+        new.commit()
+    except (OSError, ValueError):
+        # The cache is only an optimization
+        new.discard()
+
+
+class _CompiledConfigWriter:
+    """
+    Writes the compiled cache of a config file while it is being parsed, so
+    its services never need to be held in memory all at once. The services
+    are stored as a series of chunks, each a line of JSON, followed by a line
+    holding the rest of the config (and the offset and size of each chunk,
+    so a range of services can be loaded without decoding the others) and
+    the trailer giving the offset of that line. JSON is used rather than
+    pickle, so a file planted in the cache directory cannot run code. Configs
+    that JSON cannot represent are not cached.
+    """
+
+    CHUNK_SIZE = 500
+
+    def __init__(self, config_file):
+        compiled_config_file = _compiled_config_file(config_file)
+        self._chunk = list()
+        # Offset and number of services of each chunk
+        self._chunks = list()
+        try:
+            os.makedirs(os.path.dirname(compiled_config_file), mode=0o700, exist_ok=True)
+            # The config may contain passwords
+            self._file = _AtomicFile(compiled_config_file, binary=True, mode=0o600)
+        except OSError:
+            self._file = None
+
+    def add(self, service_root):
+        self._chunk.append(service_root)
+        if len(self._chunk) >= self.CHUNK_SIZE:
+            self._flush()
+
+    def _flush(self):
+        chunk, self._chunk = self._chunk, list()
+        if self._file is not None and chunk:
+            try:
+                self._chunks.append([self._file.file.tell(), len(chunk)])
+                self._file.file.write(_compiled_line(chunk))
+            except (OSError, ValueError):
+                # The cache is only an optimization
+                self.discard()
+
+    def commit(self, files, config, has_services):
+        """Finish writing the compiled config, returning whether it was written."""
+        self._flush()
+        if self._file is None:
+            return False
+        try:
+            _write_compiled_header(self._file.file, files, config, has_services, self._chunks)
+            self._file.commit()
+        except (OSError, ValueError):
+            self.discard()
+            return False
+        return True
+
+    def discard(self):
+        if self._file is not None:
+            self._file.discard()
+            self._file = None
+
+
+def _stream_config(arg_file, on_service, on_discard, start=0, stop=None):
+    """
+    Load the first config file that exists, calling ``on_service`` with each
+    item of its ``dns_services`` from ``start`` to ``stop`` (or the last one)
+    in turn, so they never all need to be held in memory. Returns the rest of
+    its contents, its path, a dict describing every file that was read (see
+    ``_config_files``) and whether it contained ``dns_services``. The
+    contents are cached, so the config is only parsed again if it or any of
+    the files it includes have changed, and services outside the range are
+    not decoded. If the cache turns out to be corrupted, ``on_discard`` is
+    called to forget the services that were passed to ``on_service`` from it
+    before the config is parsed. If the cache cannot be written, the list of
+    every service is also returned, so that the caller can keep them instead
+    of parsing the config again; otherwise the last item returned is
+    ``None``.
+    """
+    config_files = [arg_file, "~/.config/dnsupdate.conf", "/etc/dnsupdate.conf"]
+    for config_file in config_files:
+        if config_file is not None:
+            config_file = os.path.expanduser(config_file)
+            compiled = _load_compiled_config(config_file, on_service, on_discard, start, stop)
+            if compiled is not None:
+                config, files, has_services = compiled
+                return config, config_file, files, has_services, None
+
+            files = dict()
+            token = _config_files.set(files)
+            try:
+                try:
+                    text = _read_config_file(config_file)
+                except FileNotFoundError:
+                    # All other exceptions should be propagated up so badly
+                    # formatted config files are not silently ignored
+                    continue
+                writer = _CompiledConfigWriter(config_file)
+                service_roots = list()
+
+                def add_service(service_root):
+                    writer.add(service_root)
+                    service_roots.append(service_root)
+                    if start < len(service_roots) and (stop is None or len(service_roots) <= stop):
+                        on_service(service_root)
+
+                try:
+                    config, has_services = _stream_yaml(
+                        text, os.path.dirname(config_file), add_service
+                    )
+                except BaseException:
+                    writer.discard()
+                    raise
+            finally:
+                _config_files.reset(token)
+            if writer.commit(files, config, has_services):
+                service_roots = None
+            return config, config_file, files, has_services, service_roots
+    raise FileNotFoundError("Config file not found")
+
+
+def _load_config(arg_file):
+    """
+    Load the first config file that exists like :func:`_stream_config`,
+    returning its contents including ``dns_services``, its path and the dict
+    describing the files that were read.
+    """
+    service_roots = list()
+    config, config_file, files, has_services, _ = _stream_config(
+        arg_file, service_roots.append, service_roots.clear
+    )
+    if has_services:
+        config["dns_services"] = service_roots
+    return config, config_file, files
+
+
+class _AtomicFile:
+    """
+    Temporary file whose contents replace those of ``path`` when committed,
+    such that the path contains either the old or the new contents even if
+    the system crashes during the write. Unless a mode is given, the file
+    keeps its permissions, or is created with the permissions allowed by the
+    umask.
+    """
+
+    def __init__(self, path, binary=False, mode=None):
+        self.path = path
+        self._directory = os.path.dirname(os.path.abspath(path))
+        if mode is None:
+            try:
+                mode = os.stat(path).st_mode & 0o777
+            except FileNotFoundError:
+                mode = 0o666 & ~_umask()
+        self._mode = mode
+        fd, self._tmp_path = tempfile.mkstemp(
+            dir=self._directory, prefix=os.path.basename(path) + "."
+        )
+        self.file = os.fdopen(fd, "wb" if binary else "w")
+
+    def commit(self):
+        try:
+            self.file.flush()
+            os.fsync(self.file.fileno())
+            self.file.close()
+            os.chmod(self._tmp_path, self._mode)
+            os.replace(self._tmp_path, self.path)
+        except BaseException:
+            self.discard()
+            raise
+        # Make sure the rename itself is persisted
+        try:
+            dir_fd = os.open(self._directory, os.O_RDONLY)
+        except OSError:
+            return
+        try:
+            os.fsync(dir_fd)
+        except OSError:
+            pass
+        finally:
+            os.close(dir_fd)
+
+    def discard(self):
+        self.file.close()
+        with contextlib.suppress(OSError):
+            os.unlink(self._tmp_path)
+
+
+def _umask():
+    # The umask can only be read by setting it
+    umask = os.umask(0o022)
+    os.umask(umask)
+    return umask
+
+
+def _atomic_write(path, data, mode=None):
+    """
+    Replace the contents of a file with a string or bytes, using an
+    :class:`_AtomicFile`.
+    """
+    f = _AtomicFile(path, isinstance(data, bytes), mode)
+    try:
+        f.file.write(data)
+    except BaseException:
+        f.discard()
+        raise
+    f.commit()
+
+
+def _dump_cache(cache):
+    return json.dumps(cache, sort_keys=True, separators=(",", ":"))
+
+
+def _save_cache(cache_file, cache, mode=None):
+    _atomic_write(cache_file, _dump_cache(cache), mode)
+
+
+def _read_cache(cache_file):
+    """
+    Load a cache file, returning its data and its text, or an empty dict and
+    ``None`` if it does not exist.
+    """
+    try:
+        with open(cache_file, "r") as fd:
+            text = fd.read()
+    except IOError:
+        return dict(), None
+    except UnicodeDecodeError:
+        # Such as an SQLite database, if the cache backend was changed
+        print("Warning: ignoring unreadable cache file %s" % cache_file, file=sys.stderr)
+        return dict(), None
+    try:
+        return json.loads(text), text
+    except ValueError:
+        # Older versions wrote caches as YAML
+        import yaml
+
+        try:
+            return yaml.load(text, Loader=getattr(yaml, "CSafeLoader", yaml.SafeLoader)), text
+        except yaml.YAMLError:
+            print("Warning: ignoring unreadable cache file %s" % cache_file, file=sys.stderr)
+            return dict(), None
+
+
+def _load_cache(cache_file):
+    return _read_cache(cache_file)[0]
+
+
+# Entry point groups through which other packages can provide classes
+_PLUGIN_GROUPS = {
+    AddressProvider: "dnsupdate.address_providers",
+    DNSService: "dnsupdate.dns_services",
+}
+# Classes loaded from entry points, by group and name
+_plugins = dict()
+
+
+def _entry_points(group):
+    # Only imported when a class that is not built in is used
+    try:
+        from importlib.metadata import entry_points
+    except ImportError:
+        # Python 3.7
+        try:
+            from importlib_metadata import entry_points
+        except ImportError:
+            return list()
+    eps = entry_points()
+    if hasattr(eps, "select"):
+        return eps.select(group=group)
+    return eps.get(group, list())
+
+
+def _plugin_class(base, name):
+    """
+    Get the address provider or DNS service class (depending on ``base``)
+    with a name. Built-in classes are defined in this module, and other
+    classes are loaded from the entry points of installed packages the first
+    time they are used. Raises :class:`KeyError` if there is no such class.
+    """
+    cls = globals().get(name, None)
+    if isinstance(cls, type) and issubclass(cls, base):
+        return cls
+    group = _PLUGIN_GROUPS[base]
+    if (group, name) not in _plugins:
+        for entry_point in _entry_points(group):
+            if entry_point.name == name:
+                cls = entry_point.load()
+                break
+        else:
+            raise KeyError(name)
+        if not (isinstance(cls, type) and issubclass(cls, base)):
+            raise ConfigException(
+                "Entry point %s in %s is not a subclass of %s" % (name, group, base.__name__)
+            )
+        _plugins[(group, name)] = cls
+    return _plugins[(group, name)]
+
+
+class _PluginNamespace:
+    """
+    Local namespace for evaluating shorthand configurations, which finds
+    classes provided by other packages.
+    """
+
+    def __init__(self, base):
+        self.base = base
+
+    def __getitem__(self, name):
+        # Let names in the module or builtins be found normally
+        if name in globals() or hasattr(builtins, name):
+            raise KeyError(name)
+        return _plugin_class(self.base, name)
+
+
+def _parse_dns_service(service_root, provider_registry=None):
+    if not isinstance(service_root, str):
+        class_name = service_root["type"]
+        service_class = _plugin_class(DNSService, class_name)
+        if "address_provider" in service_root:
+            providers = _parse_address_provider_protos(
+                service_root["address_provider"], provider_registry
+            )
+        else:
+            providers = dict()
+        return service_class(**service_root.get("args", {})), providers
+    else:
+        return eval(service_root, globals(), _PluginNamespace(DNSService)), dict()
+
+
+def _config_key(root):
+    """
+    Get a canonical string identifying the configuration of an address
+    provider or DNS service.
+    """
+    if isinstance(root, str):
+        return root.strip()
+    return json.dumps(
+        {"type": root["type"], "args": root.get("args", {})}, sort_keys=True, default=str
+    )
+
+
+def _parse_address_provider(provider_root, provider_registry=None):
+    """
+    Create an address provider from its configuration. If a registry dict is
+    given, identical configurations share a single provider instance, so its
+    addresses are only looked up once per run.
+    """
+    key = _config_key(provider_root)
+    if provider_registry is not None:
+        registry_key = (
+            key,
+            None if isinstance(provider_root, str) else provider_root.get("cache_ttl"),
+        )
+        if registry_key in provider_registry:
+            return provider_registry[registry_key]
+
+    if not isinstance(provider_root, str):
+        class_name = provider_root["type"]
+        provider_class = _plugin_class(AddressProvider, class_name)
+        provider = provider_class(**provider_root.get("args", {}))
+        if "cache_ttl" in provider_root:
+            cache_ttl = provider_root["cache_ttl"]
+            if not isinstance(cache_ttl, (int, float)) or cache_ttl < 0:
+                raise ConfigException("cache_ttl must be a non-negative number")
+            provider.cache_ttl = cache_ttl
+    else:
+        provider = eval(provider_root, globals(), _PluginNamespace(AddressProvider))
+    if isinstance(provider, AddressProvider):
+        provider._config_key = key
+    if provider_registry is not None:
+        provider_registry[registry_key] = provider
+    return provider
+
+
+def _parse_address_provider_protos(provider_root, provider_registry=None):
+    providers = dict()
+    for proto in ("ipv4", "ipv6"):
+        if proto in provider_root:
+            providers[proto] = _parse_address_provider(provider_root[proto], provider_registry)
+    if not ("ipv4" in providers or "ipv6" in providers):
+        providers["ipv4"] = providers["ipv6"] = _parse_address_provider(
+            provider_root, provider_registry
+        )
+    return providers
+
+
+_ENGINES = ("threads", "asyncio")
+
+
+def _optional_positive_number(config, key, default=None):
+    value = config.get(key, default)
+    if value is not None and (not isinstance(value, (int, float)) or value <= 0):
+        raise ConfigException("%s must be a positive number" % key)
+    return value
+
+
+def _parse_rate_limit(limit_root, default_root=None):
+    """
+    Get the :class:`_HostLimit` arguments of a ``rate_limit`` config option,
+    with options that are not specified taken from ``default_root``, or
+    ``None`` if it sets no limits.
+    """
+    if not isinstance(limit_root, dict):
+        raise ConfigException("rate_limit must be a mapping")
+    options = {
+        key: root[key]
+        for root in (default_root or dict(), limit_root)
+        for key in ("rate", "burst", "concurrency")
+        if key in root
+    }
+    rate = _optional_positive_number(options, "rate")
+    burst = options.get("burst", 1)
+    if not isinstance(burst, int) or burst < 1:
+        raise ConfigException("burst must be a positive integer")
+    concurrency = options.get("concurrency", None)
+    if concurrency is not None and (not isinstance(concurrency, int) or concurrency < 1):
+        raise ConfigException("concurrency must be a positive integer")
+    if rate is None and concurrency is None:
+        return None
+    return {"rate": rate, "burst": burst, "concurrency": concurrency}
+
+
+def _positive_int(value):
+    number = int(value)
+    if number < 1:
+        raise argparse.ArgumentTypeError("%s is not a positive integer" % value)
+    return number
+
+
+def _get_arg_parser():
+    parser = argparse.ArgumentParser(description="Dynamic DNS update client")
+    parser.add_argument("config", help="the config file to use", nargs="?")
+    parser.add_argument(
+        "-f",
+        "--force-update",
+        help="""force an update to occur even if the address has not changed
+                                 or a service has been disabled""",
+        action="store_true",
+        dest="force_update",
+    )
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        help="""number of services to update concurrently (default: the
+                                 'jobs' config option, or 1)""",
+        type=_positive_int,
+        metavar="N",
+    )
+    parser.add_argument(
+        "--processes",
+        help="""number of worker processes to shard the services across
+                                 (default: the 'processes' config option, or 1)""",
+        type=_positive_int,
+        metavar="N",
+    )
+    parser.add_argument(
+        "--engine",
+        help="""method used to perform concurrent updates (default: the
+                                 'engine' config option, or 'threads')""",
+        choices=_ENGINES,
+    )
+    parser.add_argument(
+        "-d",
+        "--daemon",
+        help="""keep running and check for address changes every 'interval'
+                                 seconds, rather than exiting after one run""",
+        action="store_true",
+    )
+    parser.add_argument("-V", "--version", action="version", version="%(prog)s " + __version__)
+    return parser
+
+
+def _parse_args():
+    return _get_arg_parser().parse_args()
+
+
+class _YAMLServiceState:
+    """
+    Data of the configured services (such as their addresses and whether they
+    are enabled), stored in a JSON cache file by position in the config. The
+    file is only rewritten if the data changed.
+    """
+
+    DEFAULT_FILE = "~/.cache/dnsupdate.cache"
+
+    def __init__(self, cache_file):
+        self.cache_file = cache_file
+        self._cache, self._saved = _read_cache(cache_file)
+
+    def load(self, identities):
+        """
+        Get the mtime of the config file when the data was last saved, and a
+        list of data dicts, one for each service identity, which may be
+        modified and then passed to :meth:`save`.
+        """
+        # Check and fix cache data format
+        try:
+            service_data_list = self._cache["dns_services"]
+        except (KeyError, TypeError):
+            service_data_list = list()
+            self._cache = {"dns_services": service_data_list}
+
+        # Get data for each service from saved data, or create it, and delete
+        # any extra services from the cache
+        del service_data_list[len(identities) :]
+        service_data_list.extend(dict() for _ in range(len(identities) - len(service_data_list)))
+        return self._cache.get("mtime", None), service_data_list
+
+    def save(self, mtime, identities, service_data_list):
+        self._cache["mtime"] = mtime
+        self._cache["dns_services"] = service_data_list
+        data = _dump_cache(self._cache)
+        if data != self._saved:
+            _atomic_write(self.cache_file, data, 0o600)
+            self._saved = data
+
+    def close(self):
+        pass
+
+
+class _SQLiteServiceState:
+    """
+    Data of the configured services stored in an SQLite database, keyed by
+    service identity, so adding, removing or reordering services does not
+    affect the others. Only the services whose data changed are written, in a
+    single transaction.
+    """
+
+    DEFAULT_FILE = "~/.cache/dnsupdate.sqlite"
+
+    # Maximum number of parameters in a query supported by old SQLite versions
+    _MAX_PARAMS = 999
+
+    # Start of every SQLite database file
+    _HEADER = b"SQLite format 3\0"
+
+    def __init__(self, cache_file):
+        import sqlite3
+
+        self.cache_file = cache_file
+        # Mtime and service data list of a cache file written by
+        # _YAMLServiceState, which are converted when the data is loaded
+        self._imported = None
+        try:
+            with open(cache_file, "rb") as f:
+                header = f.read(len(self._HEADER))
+        except OSError:
+            header = b""
+        if header and header != self._HEADER:
+            print(
+                "Warning: converting cache file %s to an SQLite database" % cache_file,
+                file=sys.stderr,
+            )
+            cache = _load_cache(cache_file)
+            if isinstance(cache, dict) and isinstance(cache.get("dns_services", None), list):
+                self._imported = (cache.get("mtime", None), cache["dns_services"])
+            os.unlink(cache_file)
+        # Create the database only readable by the owner, which SQLite also
+        # uses for its journal files
+        os.close(os.open(cache_file, os.O_WRONLY | os.O_CREAT, 0o600))
+        self._db = sqlite3.connect(cache_file)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        with self._db:
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS services "
+                "(identity TEXT PRIMARY KEY, data TEXT NOT NULL) WITHOUT ROWID"
+            )
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT NOT NULL)"
+            )
+        self._identities = None
+        # Identity -> JSON data as last loaded or saved
+        self._saved = dict()
+
+    def load(self, identities):
+        """See :meth:`_YAMLServiceState.load`."""
+        row = self._db.execute("SELECT value FROM meta WHERE key = 'mtime'").fetchone()
+        mtime = json.loads(row[0]) if row is not None else None
+        imported = list()
+        if self._imported is not None:
+            mtime, imported = self._imported
+        if identities != self._identities:
+            saved = dict()
+            for start in range(0, len(identities), self._MAX_PARAMS):
+                chunk = identities[start : start + self._MAX_PARAMS]
+                saved.update(
+                    self._db.execute(
+                        "SELECT identity, data FROM services WHERE identity IN (%s)"
+                        % ",".join("?" * len(chunk)),
+                        chunk,
+                    )
+                )
+            self._saved = saved
+            # Converted services keep the data at their position
+            imported = [
+                data if isinstance(data, dict) else dict() for data in imported[: len(identities)]
+            ]
+            imported.extend(dict() for _ in range(len(identities) - len(imported)))
+            self._service_data_list = [
+                json.loads(saved[identity]) if identity in saved else data
+                for identity, data in zip(identities, imported)
+            ]
+        return mtime, self._service_data_list
+
+    def save(self, mtime, identities, service_data_list):
+        changed = list()
+        for identity, service_data in zip(identities, service_data_list):
+            data = json.dumps(service_data, sort_keys=True)
+            if self._saved.get(identity, None) != data:
+                changed.append((identity, data))
+        with self._db:
+            self._db.executemany(
+                "INSERT OR REPLACE INTO services (identity, data) VALUES (?, ?)", changed
+            )
+            self._db.execute(
+                "INSERT OR REPLACE INTO meta (key, value) VALUES ('mtime', ?)", (json.dumps(mtime),)
+            )
+            if identities != self._identities:
+                # Delete the data of services that are no longer configured
+                self._db.execute("CREATE TEMP TABLE IF NOT EXISTS configured (identity TEXT)")
+                self._db.execute("DELETE FROM configured")
+                self._db.executemany(
+                    "INSERT INTO configured (identity) VALUES (?)", ((i,) for i in identities)
+                )
+                self._db.execute(
+                    "DELETE FROM services WHERE identity NOT IN (SELECT identity FROM configured)"
+                )
+        self._saved.update(changed)
+        self._identities = identities
+        self._service_data_list = service_data_list
+        self._imported = None
+
+    def close(self):
+        self._db.close()
+
+
+_CACHE_BACKENDS = {"yaml": _YAMLServiceState, "sqlite": _SQLiteServiceState}
+
+
+def _service_identities(service_roots):
+    """
+    Get a stable identity for each service configuration, made of the class
+    name and a hash of its :attr:`DNSService.identity_args`. Services with
+    equal identities are numbered to keep them distinct.
+    """
+    counts = dict()
+    return [_service_identity(service_root, counts) for service_root in service_roots]
+
+
+def _service_identity(service_root, counts):
+    """
+    Get the identity of one service configuration, counting identical
+    configurations seen so far in ``counts`` (see :func:`_service_identities`).
+    """
+    class_name, args = _service_args(service_root)
+    try:
+        names = _plugin_class(DNSService, class_name).identity_args
+    except (KeyError, ConfigException):
+        # The error is reported when the service is parsed
+        names = ()
+    key = json.dumps(
+        {"type": class_name, "args": {name: args[name] for name in names if name in args}},
+        sort_keys=True,
+        default=str,
+    )
+    identity = "%s:%s" % (class_name, hashlib.sha256(key.encode()).hexdigest())
+    counts[identity] = count = counts.get(identity, 0) + 1
+    return identity if count == 1 else "%s#%d" % (identity, count)
+
+
+def _service_args(service_root):
+    """
+    Get the class name and the arguments of a service configuration. The
+    arguments of a shorthand configuration are only known if they are
+    literals.
+    """
+    if not isinstance(service_root, str):
+        return service_root["type"], service_root.get("args", {})
+    import ast
+    import inspect
+
+    try:
+        call = ast.parse(service_root.strip(), mode="eval").body
+        class_name = call.func.id
+    except (SyntaxError, AttributeError):
+        return service_root.split("(")[0].strip(), dict()
+    try:
+        cls = _plugin_class(DNSService, class_name)
+        arguments = (
+            inspect.signature(cls)
+            .bind(
+                *(ast.literal_eval(arg) for arg in call.args),
+                **{keyword.arg: ast.literal_eval(keyword.value) for keyword in call.keywords},
+            )
+            .arguments
+        )
+    except (KeyError, ConfigException, TypeError, ValueError):
+        return class_name, dict()
+    return class_name, dict(arguments)
+
+
+def _is_sha256(text):
+    return len(text) == 64 and all(c in "0123456789abcdef" for c in text)
+
+
+class _AddressStore:
+    """
+    Persistent cache of addresses returned by address providers that have a
+    ``cache_ttl``. Entries are keyed by a hash of the provider configuration,
+    so they are shared by every run (and config file) using the same store
+    without writing any credentials from the configuration to the file. The
+    store also keeps the response times of the :class:`Web` URLs, so that
+    runs of a timer query the fastest services first.
+    """
+
+    # Key of the response times, which cannot be mistaken for a hash
+    LATENCIES = "latencies"
+
+    def __init__(self, store_file):
+        self.store_file = store_file
+        self._lock = threading.Lock()
+        self._entries = self._load()
+        self._dirty = False
+        _fork_safe.add(self)
+
+    def _after_fork(self):
+        self._lock = threading.Lock()
+
+    def _load(self):
+        entries = _load_cache(self.store_file)
+        if not isinstance(entries, dict):
+            return dict()
+        # Drop entries written by older versions, which were keyed by the
+        # configuration itself
+        return {
+            key: value
+            for key, value in entries.items()
+            if _is_sha256(key) or (key == self.LATENCIES and isinstance(value, dict))
+        }
+
+    @staticmethod
+    def _key(config_key):
+        return hashlib.sha256(config_key.encode()).hexdigest()
+
+    def get(self, key, proto, ttl):
+        """
+        Get an address that was stored less than ``ttl`` seconds ago. Raises
+        :class:`KeyError` if there is no such address.
+        """
+        key = self._key(key)
+        with self._lock:
+            entry = self._entries[key][proto]
+        if not 0 <= time.time() - entry["time"] < ttl:
+            raise KeyError(key)
+        address = entry["address"]
+        return ipaddress.ip_address(address) if address is not None else None
+
+    def put(self, key, proto, address):
+        key = self._key(key)
+        with self._lock:
+            self._entries.setdefault(key, dict())[proto] = {
+                "address": str(address) if address is not None else None,
+                "time": time.time(),
+            }
+            self._dirty = True
+
+    def latencies(self):
+        with self._lock:
+            return dict(self._entries.get(self.LATENCIES, dict()))
+
+    def put_latencies(self, latencies):
+        with self._lock:
+            if latencies != self._entries.get(self.LATENCIES, dict()):
+                self._entries[self.LATENCIES] = dict(latencies)
+                self._dirty = True
+
+    def save(self):
+        with self._lock:
+            if not self._dirty:
+                return
+            # Merge with entries written by other processes in the meantime
+            entries = self._load()
+            for key, protos in self._entries.items():
+                if key == self.LATENCIES:
+                    entries[key] = {**entries.get(key, dict()), **protos}
+                    continue
+                for proto, entry in protos.items():
+                    saved_entry = entries.get(key, dict()).get(proto, None)
+                    if saved_entry is None or saved_entry["time"] < entry["time"]:
+                        entries.setdefault(key, dict())[proto] = entry
+            _save_cache(self.store_file, entries, 0o600)
+            self._entries = entries
+            self._dirty = False
+
+
+class _AddressCache:
+    """
+    Thread-safe table of addresses obtained from address providers during a
+    run, used to prevent duplicate lookups when multiple services share a
+    provider. Concurrent requests for the same address wait for a single
+    lookup, and failed lookups are not retried during the same run.
+
+    Results of providers with a ``cache_ttl`` are also read from and written
+    to an :class:`_AddressStore`, unless ``refresh`` is set.
+    """
+
+    def __init__(self, store=None, refresh=False):
+        self._store = store
+        self._refresh = refresh
+        self._lock = threading.Lock()
+        self._addresses = dict()
+        _fork_safe.add(self)
+
+    def _after_fork(self):
+        self._lock = threading.Lock()
+
+    def _claim(self, provider, proto):
+        """
+        Get the future for an address, and whether the caller is responsible
+        for performing the lookup.
+        """
+        with self._lock:
+            future = self._addresses.get((provider, proto), None)
+            if future is None:
+                future = self._addresses[(provider, proto)] = Future()
+                return future, True
+            return future, False
+
+    def _finish(self, future, address=None, exception=None):
+        with self._lock:
+            # The lookup may have already timed out
+            if future.done():
+                return
+            if exception is not None:
+                future.set_exception(exception)
+            else:
+                future.set_result(address)
+
+    def _stored(self, provider, proto):
+        key = getattr(provider, "_config_key", None)
+        if self._store is None or self._refresh or key is None or provider.cache_ttl <= 0:
+            raise KeyError(key)
+        return self._store.get(key, proto, provider.cache_ttl)
+
+    def _store_address(self, provider, proto, address):
+        key = getattr(provider, "_config_key", None)
+        if self._store is not None and key is not None and provider.cache_ttl > 0:
+            self._store.put(key, proto, address)
+
+    @contextlib.contextmanager
+    def _lookup(self, provider, proto):
+        """Trace and time a lookup from an address provider."""
+        _metrics.inc("dnsupdate_address_cache_misses_total")
+        name = provider.__class__.__name__
+        with span("lookup", provider=name, proto=proto), _metrics.timer(
+            "dnsupdate_lookup_duration_seconds", provider=name, proto=proto
+        ):
+            yield
+
+    def get(self, provider, proto):
+        future, owner = self._claim(provider, proto)
+        if owner:
+            try:
+                try:
+                    address = self._stored(provider, proto)
+                    _metrics.inc("dnsupdate_address_cache_hits_total", cache="file")
+                except KeyError:
+                    # Call ipv4() or ipv6() method
+                    with self._lookup(provider, proto):
+                        address = getattr(provider, proto)()
+                    self._store_address(provider, proto, address)
+                self._finish(future, address)
+            except Exception as e:
+                self._finish(future, exception=e)
         else:
-            r.raise_for_status()
-            return False
+            _metrics.inc("dnsupdate_address_cache_hits_total", cache="run")
+        return future.result()
+
+    async def async_get(self, provider, proto):
+        import asyncio
+
+        future, owner = self._claim(provider, proto)
+        if owner:
+            try:
+                try:
+                    address = self._stored(provider, proto)
+                    _metrics.inc("dnsupdate_address_cache_hits_total", cache="file")
+                except KeyError:
+                    # Call async_ipv4() or async_ipv6() method
+                    with self._lookup(provider, proto):
+                        address = await _async_method(provider, proto)()
+                    self._store_address(provider, proto, address)
+                self._finish(future, address)
+            except Exception as e:
+                self._finish(future, exception=e)
+            except BaseException:
+                # Don't leave other lookups of the same address waiting
+                self._finish(
+                    future, exception=AddressProviderException("Address lookup was cancelled")
+                )
+                raise
+        else:
+            _metrics.inc("dnsupdate_address_cache_hits_total", cache="run")
+        return await asyncio.wrap_future(future)
+
+    def peek(self, provider, proto):
+        """Get an address that has already been looked up, or ``None``."""
+        with self._lock:
+            future = self._addresses.get((provider, proto), None)
+        if future is None or not future.done() or future.exception() is not None:
+            return None
+        return future.result()
+
+    def _resolve_stored(self, lookups):
+        """
+        Resolve lookups that can be answered by the store without starting
+        any threads or tasks, returning the remaining lookups.
+        """
+        remaining = list()
+        for provider, proto in lookups:
+            try:
+                address = self._stored(provider, proto)
+            except KeyError:
+                remaining.append((provider, proto))
+                continue
+            future, owner = self._claim(provider, proto)
+            if owner:
+                _metrics.inc("dnsupdate_address_cache_hits_total", cache="file")
+                self._finish(future, address)
+        return remaining
+
+    def _time_out(self, lookups, timeout):
+        if timeout is None:
+            return
+        for provider, proto in lookups:
+            future, _ = self._claim(provider, proto)
+            self._finish(
+                future,
+                exception=AddressProviderException(
+                    "Timed out after %g seconds getting %s address from %s"
+                    % (timeout, "IP" + proto[2:], provider.__class__.__name__)
+                ),
+            )
+
+    def resolve(self, lookups, timeout=None, max_workers=32):
+        """
+        Concurrently look up the addresses for a list of ``(provider, proto)``
+        pairs using up to ``max_workers`` threads, waiting at most ``timeout``
+        seconds in total. Lookups that have not finished by then fail with an
+        :class:`AddressProviderException`. Their threads are abandoned, and do
+        not keep the process from exiting.
+        """
+        lookups = self._resolve_stored(lookups)
+        if not lookups:
+            return
+        pending = iter(lookups)
+        pending_lock = threading.Lock()
+
+        def worker():
+            while True:
+                with pending_lock:
+                    lookup = next(pending, None)
+                if lookup is None:
+                    return
+                # Errors are reported to the services using the address
+                with contextlib.suppress(Exception):
+                    self.get(*lookup)
+
+        # Not a ThreadPoolExecutor, because its threads are joined when the
+        # interpreter exits
+        threads = [
+            threading.Thread(target=_with_context(worker), daemon=True)
+            for _ in range(min(len(lookups), max_workers))
+        ]
+        for thread in threads:
+            thread.start()
+        deadline = time.monotonic() + timeout if timeout is not None else None
+        for thread in threads:
+            thread.join(max(deadline - time.monotonic(), 0) if deadline is not None else None)
+        self._time_out(lookups, timeout)
+
+    async def async_resolve(self, lookups, timeout=None):
+        """Asynchronous version of :meth:`resolve`."""
+        import asyncio
+
+        lookups = self._resolve_stored(lookups)
+        if not lookups:
+            return
+        tasks = [asyncio.ensure_future(self.async_get(*lookup)) for lookup in lookups]
+        _, pending = await asyncio.wait(tasks, timeout=timeout)
+        for task in pending:
+            task.cancel()
+        self._time_out(lookups, timeout)
+
+
+class _ServiceWindow:
+    """
+    Consecutive ``(service, providers)`` pairs of a config, indexed by their
+    position in the whole config, which can be passed to the update functions
+    in place of the list of every service along with its :attr:`indices`.
+    """
+
+    def __init__(self, start):
+        self.start = start
+        self._services = list()
+
+    @property
+    def stop(self):
+        return self.start + len(self._services)
+
+    @property
+    def indices(self):
+        return range(self.start, self.stop)
+
+    def append(self, service):
+        self._services.append(service)
+
+    def __len__(self):
+        return len(self._services)
+
+    def __getitem__(self, i):
+        if not self.start <= i < self.stop:
+            raise IndexError(i)
+        return self._services[i - self.start]
+
+
+def _address_lookups(services, service_data_list, force_enable, indices=None):
+    """
+    Get the distinct ``(provider, proto)`` pairs whose addresses are needed to
+    update the enabled services (or those in ``indices``).
+    """
+    if indices is None:
+        indices = range(len(services))
+    lookups = dict()
+    for i in indices:
+        _, providers = services[i]
+        service_data = service_data_list[i]
+        for proto, provider in providers.items():
+            if provider is None:
+                continue
+            if force_enable or service_data.get(proto, dict()).get("enabled", True):
+                lookups[(provider, proto)] = None
+    return list(lookups)
+
+
+def _pending_updates(
+    services, service_data_list, addresses, force_enable, force_update, indices=None
+):
+    """
+    Get the ``(index, service, proto, address)`` of each update that will be
+    needed by the enabled services whose addresses have changed, based on the
+    addresses that have already been looked up. If ``indices`` is given, only
+    those services are considered.
+    """
+    if indices is None:
+        indices = range(len(services))
+    for i in indices:
+        service, providers = services[i]
+        service_data = service_data_list[i]
+        for proto, provider in providers.items():
+            if provider is None:
+                continue
+            service_proto_data = service_data.get(proto, dict())
+            if not (force_enable or service_proto_data.get("enabled", True)):
+                continue
+            address = addresses.peek(provider, proto)
+            if address is None or (
+                str(address) == service_proto_data.get("address", None) and not force_update
+            ):
+                continue
+            yield i, service, proto, address
+
+
+def _verify_updates(
+    services, service_data_list, addresses, force_enable, server, port, timeout, indices=None
+):
+    """
+    Resolve the hostnames of the services (or those in ``indices``) that need
+    to be updated using a DNS server, returning a set of the ``(index, proto,
+    address)`` updates whose hostnames already only resolve to the new
+    address, which can be skipped.
+    """
+    updates = list()
+    questions = set()
+    for i, service, proto, address in _pending_updates(
+        services, service_data_list, addresses, force_enable, False, indices
+    ):
+        record_type = _DNS_TYPE_A if proto == "ipv4" else _DNS_TYPE_AAAA
+        names = [(name, record_type) for name in service.hostnames()]
+        if names:
+            updates.append((i, proto, address, names))
+            questions.update(names)
+    if not updates:
+        return set()
+
+    remaining = _timeouts.remaining()
+    if remaining is not None:
+        timeout = min(timeout, remaining)
+    try:
+        results = _dns_query_many(server, port, sorted(questions), timeout)
+    except OSError as e:
+        print("Warning: cannot verify addresses using %s: %s" % (server, e), file=sys.stderr)
+        return set()
+
+    verified = set()
+    for i, proto, address, names in updates:
+        expected = [ipaddress.ip_address(str(address)).packed]
+        if all(results.get(name) == (0, expected) for name in names):
+            verified.add((i, proto, str(address)))
+    return verified
+
+
+class _UpdateBatch:
+    def __init__(self, proto, address):
+        self.proto = proto
+        self.address = address
+        # Maps the index of each service to its position in the batch
+        self.positions = dict()
+        self.services = list()
+        self.future = Future()
+        self.started = False
+
+
+class _UpdateBatches:
+    """
+    Table of the services whose updates are sent together, as determined by
+    :meth:`DNSService.batch_key`. The first service of a batch to be updated
+    performs the update for the whole batch, and the others wait for its
+    result, like concurrent lookups in an :class:`_AddressCache`. Updates of
+    services that are not part of a batch are performed directly.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._batches = dict()
+        _fork_safe.add(self)
+
+    def _after_fork(self):
+        self._lock = threading.Lock()
+
+    @classmethod
+    def plan(
+        cls,
+        services,
+        service_data_list,
+        addresses,
+        force_enable,
+        force_update,
+        verified=frozenset(),
+        indices=None,
+    ):
+        """
+        Group the updates that will be needed by the enabled services (or
+        those in ``indices``) whose addresses have changed, based on the
+        addresses that have already been looked up.
+        """
+        # Maps each group of services to its last batch
+        groups = dict()
+        all_batches = list()
+        for i, service, proto, address in _pending_updates(
+            services, service_data_list, addresses, force_enable, force_update, indices
+        ):
+            key = service.batch_key(proto)
+            if key is None or (i, proto, str(address)) in verified:
+                continue
+            group_key = (type(service), proto, key, str(address))
+            batch = groups.get(group_key, None)
+            if batch is None or len(batch.services) == service.max_batch_size:
+                batch = groups[group_key] = _UpdateBatch(proto, address)
+                all_batches.append(batch)
+            batch.positions[i] = len(batch.services)
+            batch.services.append(service)
+
+        batches = cls()
+        for batch in all_batches:
+            if len(batch.services) > 1:
+                for i in batch.positions:
+                    batches._batches[(i, batch.proto)] = batch
+        return batches
+
+    def _claim(self, i, proto, address):
+        """
+        Get the batch that service ``i`` belongs to, and whether the caller is
+        responsible for performing the update.
+        """
+        with self._lock:
+            batch = self._batches.get((i, proto), None)
+            if batch is None or str(batch.address) != str(address):
+                return None, False
+            owner = not batch.started
+            batch.started = True
+            return batch, owner
+
+    @staticmethod
+    def _result(batch, i):
+        result = batch.future.result()[batch.positions[i]]
+        if isinstance(result, Exception):
+            raise result
+        return result
+
+    def update(self, i, service, proto, address):
+        batch, owner = self._claim(i, proto, address)
+        if batch is None:
+            # Call update_ipv4() or update_ipv6() method
+            return getattr(service, "update_%s" % proto)(address)
+        if owner:
+            try:
+                with span("batch", proto=proto, size=len(batch.services)):
+                    results = batch.services[0].update_batch(proto, address, batch.services)
+                batch.future.set_result(results)
+            except Exception as e:
+                batch.future.set_exception(e)
+        return self._result(batch, i)
+
+    async def async_update(self, i, service, proto, address):
+        """Asynchronous version of :meth:`update`."""
+        import asyncio
+
+        batch, owner = self._claim(i, proto, address)
+        if batch is None:
+            # Call async_update_ipv4() or async_update_ipv6() method
+            return await _async_method(service, "update_%s" % proto)(address)
+        if owner:
+            try:
+                with span("batch", proto=proto, size=len(batch.services)):
+                    results = await _async_method(batch.services[0], "update_batch")(
+                        proto, address, batch.services
+                    )
+                batch.future.set_result(results)
+            except Exception as e:
+                batch.future.set_exception(e)
+            except BaseException:
+                # Don't leave the other services of the batch waiting
+                batch.future.set_exception(UpdateServiceException("Update was cancelled"))
+                raise
+        await asyncio.wrap_future(batch.future)
+        return self._result(batch, i)
+
+
+class _OutputBuffer:
+    """
+    Records calls to :func:`print` so that the output of a service updated in
+    a worker thread can be written in one piece, without interleaving.
+    """
+
+    def __init__(self):
+        self._calls = list()
+
+    def print(self, *args, **kwargs):
+        self._calls.append((args, kwargs))
+
+    def flush(self):
+        for args, kwargs in self._calls:
+            print(*args, **kwargs)
+        self._calls.clear()
+
+
+def _async_method(obj, name):
+    """
+    Get the asynchronous version of a provider or service method. If a class
+    overrides the blocking method without also overriding the asynchronous
+    one, the blocking method is run in an executor instead, so that
+    asynchronous implementations inherited from a base class are not used in
+    place of the subclass's own behavior.
+    """
+    for cls in type(obj).__mro__:
+        if "async_" + name in cls.__dict__:
+            return getattr(obj, "async_" + name)
+        if name in cls.__dict__:
+            break
+    return functools.partial(_run_blocking, getattr(obj, name))
+
+
+# Steps yielded by _update_service_steps() to request work from the engine
+_LOOKUP = "lookup"
+_UPDATE = "update"
+
+
+def _update_service_steps(
+    i, service, providers, service_data, force_enable, force_update, log, verified=frozenset()
+):
+    """
+    Generator that updates every address protocol of a single service,
+    mutating its cache data. It performs no I/O itself; address lookups and
+    updates are yielded as ``(_LOOKUP, provider, proto)`` and
+    ``(_UPDATE, service, proto, address)`` steps, which the engine performs
+    before sending back the result (or throwing in the exception). Updates in
+    the ``verified`` set of ``(i, proto, address)`` are skipped for this run,
+    because DNS already holds the address. Returns the exit code of the last error that
+    occurred, or ``None`` if all updates succeeded.
+    """
+    exit_code = None
+
+    for proto, provider in providers.items():
+        if provider is not None:
+            log("Updating %s address of service %d (%s)..." % ("IP" + proto[2:], i, str(service)))
+
+            labels = {"service": str(i), "name": str(service), "proto": proto}
+            try:
+                service_proto_data = service_data.setdefault(proto, dict())
+                if force_enable or service_proto_data.setdefault("enabled", True):
+                    # Get updated address
+                    new_address = yield _LOOKUP, provider, proto
+                    # Get old address
+                    old_address = service_proto_data.get("address", None)
+                    if (i, proto, str(new_address)) in verified:
+                        # The address is not stored, so it is checked again by
+                        # the next run, in case DNS returned a stale record
+                        service_proto_data["enabled"] = True
+                        outcome = "verified"
+                        log("DNS already holds the address, no update needed.")
+                    elif str(new_address) != old_address or force_update:
+                        try:
+                            with span("update", proto=proto), _metrics.timer(
+                                "dnsupdate_update_duration_seconds", **labels
+                            ):
+                                changed = yield _UPDATE, service, proto, new_address
+                            service_proto_data["address"] = str(new_address)
+                            service_proto_data["enabled"] = True
+                            if changed is False:
+                                outcome = "nochg"
+                                log("Service already had the address, no change made.")
+                            else:
+                                outcome = "good"
+                                log("Update successful.")
+                        except UpdateClientException as e:
+                            log("Error: %s" % e, file=sys.stderr)
+                            log(
+                                "Update failed due to a configuration error. "
+                                "Service will be disabled until the configuration "
+                                "has been fixed.",
+                                file=sys.stderr,
+                            )
+                            service_proto_data["enabled"] = False
+                            outcome = "client_error"
+                            exit_code = ExitCode.CLIENT_ERROR
+                        except (
+                            UpdateServiceException,
+                            *_timeout_errors(),
+                        ) as ue:
+                            log("Error: %s" % (str(ue) or "Request timed out"), file=sys.stderr)
+                            outcome = "service_error"
+                            exit_code = ExitCode.SERVICE_ERROR
+                    else:
+                        outcome = "nochg"
+                        log("Address has not changed, no update needed.")
+                else:
+                    log(
+                        "Service has been disabled due to a previous client error. "
+                        "Please fix your configuration and try again.",
+                        file=sys.stderr,
+                    )
+                    outcome = "disabled"
+                    exit_code = ExitCode.CLIENT_ERROR
+            except Exception as e:
+                log("Error: %s" % e, file=sys.stderr)
+                outcome = "error"
+                exit_code = ExitCode.OTHER_ERROR
+            _metrics.inc("dnsupdate_updates_total", **labels, outcome=outcome)
+
+    return exit_code
+
+
+def _update_service(
+    i,
+    service,
+    providers,
+    service_data,
+    addresses,
+    force_enable,
+    force_update,
+    log=print,
+    batches=None,
+    verified=frozenset(),
+):
+    """Run :func:`_update_service_steps`, blocking on each step."""
+    if batches is None:
+        batches = _UpdateBatches()
+    steps = _update_service_steps(
+        i, service, providers, service_data, force_enable, force_update, log, verified
+    )
+    result = exception = None
+    with span("service", index=i, service=str(service)):
+        while True:
+            try:
+                step = steps.send(result) if exception is None else steps.throw(exception)
+            except StopIteration as e:
+                return e.value
+            try:
+                if step[0] == _LOOKUP:
+                    result = addresses.get(*step[1:])
+                else:
+                    result = batches.update(i, *step[1:])
+                exception = None
+            except Exception as e:
+                result, exception = None, e
+
+
+async def _async_update_service(
+    i,
+    service,
+    providers,
+    service_data,
+    addresses,
+    force_enable,
+    force_update,
+    log=print,
+    batches=None,
+    verified=frozenset(),
+):
+    """Run :func:`_update_service_steps`, awaiting each step."""
+    if batches is None:
+        batches = _UpdateBatches()
+    steps = _update_service_steps(
+        i, service, providers, service_data, force_enable, force_update, log, verified
+    )
+    result = exception = None
+    with span("service", index=i, service=str(service)):
+        try:
+            while True:
+                try:
+                    step = steps.send(result) if exception is None else steps.throw(exception)
+                except StopIteration as e:
+                    return e.value
+                try:
+                    if step[0] == _LOOKUP:
+                        result = await addresses.async_get(*step[1:])
+                    else:
+                        result = await batches.async_update(i, *step[1:])
+                    exception = None
+                except Exception as e:
+                    result, exception = None, e
+        finally:
+            # If the update is cancelled at the deadline, finish the spans of
+            # the steps now, rather than in whichever context garbage collects
+            # them
+            steps.close()
 
-    def update_ipv4(self, address):
-        return FreeDNS.__update("https://sync.afraid.org/u/%s/" % self.ipv4_key, address)
 
-    def update_ipv6(self, address):
-        return FreeDNS.__update("https://v6.sync.afraid.org/u/%s/" % self.ipv6_key, address)
+def _deadline_exceeded(i, service, log=print):
+    log(
+        "Error: Run deadline exceeded while updating service %d (%s)" % (i, service),
+        file=sys.stderr,
+    )
+    return ExitCode.SERVICE_ERROR
+
+
+def _update_services(
+    services,
+    service_data_list,
+    addresses,
+    force_enable,
+    force_update,
+    jobs,
+    verified=frozenset(),
+    indices=None,
+):
+    """
+    Update a list of ``(service, providers)`` pairs, using up to ``jobs``
+    worker threads, skipping the ``verified`` updates. If ``indices`` is
+    given, only those services are updated. The output of each service is
+    printed in order, and the exit code is aggregated exactly as if the
+    services were updated serially. Services that have not finished by the run
+    deadline are reported as service errors, and their cache data is left
+    unchanged.
+    """
+    exit_code = ExitCode.SUCCESS
+    if indices is None:
+        indices = range(len(services))
+    batches = _UpdateBatches.plan(
+        services, service_data_list, addresses, force_enable, force_update, verified, indices
+    )
 
+    def update(i, service, providers, service_data, log=print):
+        return _update_service(
+            i,
+            service,
+            providers,
+            service_data,
+            addresses,
+            force_enable,
+            force_update,
+            log,
+            batches,
+            verified,
+        )
 
-class StandardService(DNSService):
-    """
-    Updates a DNS service that uses the `defacto standard protocol`_ that has
-    been defined by Dyn. All the standard return codes are handled. Client
-    configuration errors will cause the service to be disabled.
+    if jobs > 1:
 
-    .. _defacto standard protocol: https://help.dyn.com/remote-access-api/
+        def update_buffered(i, service, providers, service_data):
+            output = _OutputBuffer()
+            return update(i, service, providers, service_data, output.print), output, service_data
 
-    :param service_ipv4: domain name of the IPv4 update service
-    :param service_ipv6: domain name of the IPv6 update service
-    :param username: service username (some services use the your (sub)domain
-                     name as the username)
-    :param password: service password (sometimes this is a unique password for
-                     a specific (sub)domain rather than your actual password)
-    :param hostname: fully qualified domain name to update
-    :param extra_params: other keyword arguments that will be appended to the
-                         request URL
+        # Not a ThreadPoolExecutor, so that services abandoned at the deadline
+        # do not keep the process from exiting
+        executor = _DaemonExecutor(jobs)
+        futures = list()
+        try:
+            # Each worker modifies a copy of the service's data, so services
+            # that are abandoned at the deadline cannot modify the cache
+            futures = [
+                executor.submit(
+                    _with_context(
+                        update_buffered, i, *services[i], copy.deepcopy(service_data_list[i])
+                    )
+                )
+                for i in indices
+            ]
+            for i, future in zip(indices, futures):
+                try:
+                    service_exit_code, output, service_data = future.result(_timeouts.remaining())
+                except FutureTimeoutError:
+                    future.cancel()
+                    service_exit_code = _deadline_exceeded(i, services[i][0])
+                else:
+                    service_data_list[i] = service_data
+                    output.flush()
+                if service_exit_code is not None:
+                    exit_code = service_exit_code
+        finally:
+            for future in futures:
+                future.cancel()
+            # Don't wait for abandoned services
+            executor.shutdown()
+    else:
+        for i in indices:
+            service, providers = services[i]
+            if _timeouts.remaining() == 0:
+                service_exit_code = _deadline_exceeded(i, service)
+            else:
+                service_exit_code = update(i, service, providers, service_data_list[i])
+            if service_exit_code is not None:
+                exit_code = service_exit_code
+
+    return exit_code
+
+
+async def _async_update_services(
+    services,
+    service_data_list,
+    addresses,
+    force_enable,
+    force_update,
+    jobs,
+    verified=frozenset(),
+    indices=None,
+):
+    """
+    Asynchronous version of :func:`_update_services`, which updates up to
+    ``jobs`` services concurrently on the running event loop. Blocking
+    implementations are run in an executor. Services that have not finished
+    by the run deadline are cancelled.
     """
+    import asyncio
 
-    def __init__(self, service_ipv4, service_ipv6, username, password, hostname, **extra_params):
-        self.service_ipv4 = service_ipv4
-        self.service_ipv6 = service_ipv6
-        self.username = username
-        self.password = password
-        self.hostname = hostname
-        self.extra_params = extra_params
+    exit_code = ExitCode.SUCCESS
+    if indices is None:
+        indices = range(len(services))
+    semaphore = asyncio.Semaphore(jobs)
+    batches = _UpdateBatches.plan(
+        services, service_data_list, addresses, force_enable, force_update, verified, indices
+    )
 
-    def __update(self, service_host, address):
-        r = session.get(
-            "https://%s/nic/update" % service_host,
-            auth=(self.username, self.password),
-            params={**{"myip": address, "hostname": self.hostname}, **self.extra_params},
-        )
-        status = r.text.split(" ", 1)[0]
-        if status == "good":
-            return True
-        elif status == "nochg":
-            return False
-        elif status == "badauth" or r.status_code == 401:
-            raise UpdateClientException("Incorrect login credentials")
-        elif status == "!donator":
-            raise UpdateClientException("Feature is only available to paying users")
-        elif status == "notfqdn":
-            raise UpdateClientException("Incorrect hostname format")
-        elif status == "nohost":
-            raise UpdateClientException("Hostname does not belong to this account")
-        elif status == "abuse":
-            raise UpdateClientException("Hostname has been blocked for abuse")
-        elif status == "badagent":
-            raise UpdateClientException("User agent or HTTP method was rejected")
-        elif status == "dnserr":
-            raise UpdateServiceException("Server DNS error encountered")
-        elif status == "911":
-            raise UpdateServiceException("Server is not currently functioning correctly")
-        else:
-            raise UpdateException("Unknown response")
+    async def update(i, service, providers, log):
+        async with semaphore:
+            return await _async_update_service(
+                i,
+                service,
+                providers,
+                service_data_list[i],
+                addresses,
+                force_enable,
+                force_update,
+                log,
+                batches,
+                verified,
+            )
 
-    def update_ipv4(self, address):
-        return self.__update(self.service_ipv4, address)
+    async def update_buffered(i, service, providers):
+        output = _OutputBuffer()
+        try:
+            service_exit_code = await asyncio.wait_for(
+                update(i, service, providers, output.print), _timeouts.remaining()
+            )
+        except asyncio.TimeoutError:
+            service_exit_code = _deadline_exceeded(i, service, output.print)
+        return service_exit_code, output
 
-    def update_ipv6(self, address):
-        return self.__update(self.service_ipv6, address)
+    tasks = [asyncio.ensure_future(update_buffered(i, *services[i])) for i in indices]
+    for task in tasks:
+        service_exit_code, output = await task
+        output.flush()
+        if service_exit_code is not None:
+            exit_code = service_exit_code
 
-    def __str__(self):
-        return "%s [%s]" % (self.__class__.__name__, self.hostname)
+    return exit_code
 
 
-class NSUpdate(StandardService):
+class _StreamRecorder:
+    """
+    File-like object recording the text written to a standard stream, so that
+    the output of a worker process can be written out by its parent.
     """
-    Updates a domain on nsupdate.info_. nsupdate.info
-    uses the Dyn protocol.
 
-    .. _nsupdate.info: http://nsupdate.info
+    def __init__(self, name, writes):
+        self._name = name
+        self._writes = writes
 
-    :param hostname: fqdn to update
-    :param secret_key: update key
-    """
+    def write(self, text):
+        self._writes.append((self._name, text))
+        return len(text)
 
-    def __init__(self, hostname, secret_key):
-        super().__init__("ipv4.nsupdate.info", "ipv6.nsupdate.info", hostname, secret_key, hostname)
+    def flush(self):
+        pass
 
 
-class OVHDynDNS(StandardService):
-    """
-    Updates a domain using `OVH's DynDNS`_ service. This service uses the
-    standard Dyn protocol, with an extra ``system`` parameter. This service
-    only supports IPv4.
+class _SpanRecorder(SpanHook):
+    """Records the spans finished in a worker process, to be passed on to the parent's hooks."""
 
-    .. _OVH's DynDNS: http://help.ovh.com/DynDNS
+    def __init__(self):
+        self.spans = list()
 
-    :param username: account username
-    :param password: account password
-    :param hostname: the hostname to update
-    :param system: the type of update (default: ``dyndns``)
+    def span_finished(self, span):
+        self.spans.append(span)
+
+
+def _reinit_after_fork():
     """
+    Make the state inherited by a forked worker process usable, in case
+    another thread of the parent was using it when the process forked.
+    Locks are re-created, and the connection pools of the HTTP sessions are
+    replaced, so the worker does not share keep-alive connections with the
+    parent. The old pools are dropped without being closed, because closing
+    them would need their locks.
+    """
+    global _http_sessions_lock
+    _http_sessions_lock = threading.Lock()
+    Web._latencies_lock = threading.Lock()
+    for obj in list(_fork_safe):
+        obj._after_fork()
+    if _http_sessions is not None:
+        for session in _http_sessions.values():
+            for adapter in set(session.adapters.values()):
+                adapter.proxy_manager = dict()
+                adapter.init_poolmanager(
+                    adapter._pool_connections, adapter._pool_maxsize, block=adapter._pool_block
+                )
 
-    def __init__(self, username, password, hostname, system="dyndns"):
-        super().__init__("www.ovh.com", None, username, password, hostname, system=system)
 
-    def update_ipv6(self, address):
-        # OVH DynDNS does not support IPv6
-        return DNSService.update_ipv6(self, address)
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_reinit_after_fork)
 
+# Arguments of the update being sharded by _update_services_sharded(), which
+# are inherited by the forked worker processes instead of being pickled
+_shard_update = None
 
-class GoogleDomains(StandardService):
+
+def _update_shard(shard, start, stop):
+    """
+    Update services ``start`` to ``stop`` of ``_shard_update``, which is shard
+    number ``shard``, in a worker process. Returns the exit code, the output,
+    the new data of the services and the metrics and spans that were recorded.
+    """
+    global _rate_limits
+    update, parent_span, deadline, rate_limits, shards = _shard_update
+    _rate_limits = rate_limits.share(shard, shards)
+    _current_span.set(parent_span)
+    _timeouts.deadline = deadline
+    _metrics.clear()
+    spans = _SpanRecorder()
+    _span_hooks[:] = [spans]
+    writes = list()
+    with contextlib.redirect_stdout(_StreamRecorder("stdout", writes)), contextlib.redirect_stderr(
+        _StreamRecorder("stderr", writes)
+    ):
+        exit_code, service_data_list = update(range(start, stop))
+    return exit_code, writes, service_data_list[start:stop], _metrics.series(), spans.spans
+
+
+def _update_services_sharded(
+    services,
+    service_data_list,
+    addresses,
+    force_enable,
+    force_update,
+    jobs,
+    verified=frozenset(),
+    processes=1,
+    engine="threads",
+):
+    """
+    Update services like :func:`_update_services`, split into contiguous
+    shards that are updated by up to ``processes`` forked worker processes,
+    each using ``engine`` with up to ``jobs`` concurrent updates. Addresses
+    must already have been resolved, so the workers share the parent's
+    lookups. The output, cache data, metrics and spans of each shard are
+    passed back to the parent in order, so the output and exit code are the
+    same as if the services were updated serially.
     """
-    Updates a domain registered through `Google Domains`_. This service uses
-    the standard Dyn protocol. This service only supports IPv4.
 
-    .. _Google Domains: https://support.google.com/domains/answer/6147083
+    def update(indices):
+        args = (services, service_data_list, addresses, force_enable, force_update, jobs)
+        if engine == "asyncio":
+            import asyncio
 
-    :param username: account username
-    :param password: account password
-    :param hostname: the hostname to update
-    """
+            async def run():
+                async with _async_http_context(jobs):
+                    return await _async_update_services(*args, verified, indices)
 
-    def __init__(self, username, password, hostname):
-        super().__init__("domains.google.com", None, username, password, hostname)
+            return asyncio.run(run()), service_data_list
+        return _update_services(*args, verified, indices), service_data_list
 
-    def update_ipv6(self, address):
-        # Google Domains does not support IPv6
-        return DNSService.update_ipv6(self, address)
+    return _run_shards(update, len(services), service_data_list, processes)
 
 
-def _load_config(arg_file):
-    config_files = [arg_file, "~/.config/dnsupdate.conf", "/etc/dnsupdate.conf"]
-    for config_file in config_files:
-        if config_file is not None:
-            config_file = os.path.expanduser(config_file)
-            try:
-                with open(config_file, "r") as fd:
-                    return yaml.load(fd, _ConfigLoader), config_file
-            except FileNotFoundError:
-                # All other exceptions should be propagated up so badly
-                # formatted config files are not silently ignored
-                pass
-    raise FileNotFoundError("Config file not found")
+def _run_shards(update, count, service_data_list, processes):
+    """
+    Split ``count`` services into contiguous shards, and call ``update`` with
+    the range of indices of each shard in up to ``processes`` forked worker
+    processes, which each apply their share of the rate limits. ``update``
+    returns the exit code and the list of service data, whose entries for the
+    shard are copied into ``service_data_list``. The services are updated in
+    this process instead if any other non-daemon threads are running, since
+    they could be in the middle of changing the state that the workers would
+    inherit.
+    """
+    import multiprocessing
+    from concurrent.futures import ProcessPoolExecutor
+
+    global _shard_update
+
+    current = threading.current_thread()
+    if any(t is not current and not t.daemon for t in threading.enumerate()):
+        print(
+            "Warning: not using worker processes while other threads are running",
+            file=sys.stderr,
+        )
+        return update(range(count))[0]
 
+    # Each process needs a share of the concurrency limits
+    processes = min(processes, count, _rate_limits.max_shards() or processes)
+    bounds = [count * k // processes for k in range(processes + 1)]
+    exit_code = ExitCode.SUCCESS
+    # Buffered output would be written again by every worker
+    sys.stdout.flush()
+    sys.stderr.flush()
+    _shard_update = (update, _current_span.get(), _timeouts.deadline, _rate_limits, processes)
+    try:
+        with ProcessPoolExecutor(processes, multiprocessing.get_context("fork")) as executor:
+            futures = [
+                executor.submit(_update_shard, shard, start, stop)
+                for shard, (start, stop) in enumerate(zip(bounds, bounds[1:]))
+            ]
+            for (start, stop), future in zip(zip(bounds, bounds[1:]), futures):
+                try:
+                    shard_exit_code, writes, shard_data, series, spans = future.result()
+                except Exception as e:
+                    print(
+                        "Error: worker process updating services %d to %d failed: %s"
+                        % (start, stop - 1, e),
+                        file=sys.stderr,
+                    )
+                    exit_code = ExitCode.OTHER_ERROR
+                    continue
+                for name, text in writes:
+                    getattr(sys, name).write(text)
+                service_data_list[start:stop] = shard_data
+                _metrics.merge(series)
+                for span in spans:
+                    _call_span_hooks("span_started", span)
+                    _call_span_hooks("span_finished", span)
+                if shard_exit_code != ExitCode.SUCCESS:
+                    exit_code = shard_exit_code
+    finally:
+        _shard_update = None
+    return exit_code
 
-def _save_cache(cache_file, cache):
-    with open(cache_file, "w") as fd:
-        yaml.dump(cache, fd)
 
+@contextlib.asynccontextmanager
+async def _async_http_context(limit):
+    """
+    Use aiohttp for :func:`async_request` within the context, if it is
+    installed, with at most ``limit`` connections per address family.
+    """
+    try:
+        import aiohttp
+    except ImportError:
+        yield
+        return
 
-def _load_cache(cache_file):
+    http = _AsyncHTTP(aiohttp, limit)
+    token = _async_http.set(http)
     try:
-        with open(cache_file, "r") as fd:
-            return yaml.load(fd, Loader=yaml.SafeLoader)
-    except IOError:
-        return dict()
+        yield
+    finally:
+        _async_http.reset(token)
+        await http.close()
 
 
-def _parse_dns_service(service_root):
-    if not isinstance(service_root, str):
-        class_name = service_root["type"]
-        service_class = globals()[class_name]
-        if "address_provider" in service_root:
-            providers = _parse_address_provider_protos(service_root["address_provider"])
+class _Runner:
+    """
+    Performs update runs. In daemon mode, the same runner is used for every
+    run, so the settings, address providers and cache are kept in memory, and
+    are only reloaded when the config file changes. The services themselves
+    are built from the compiled config during each run, a window at a time,
+    so memory use depends on ``jobs`` rather than the number of services. If
+    the compiled config cannot be written, the parsed services are kept in
+    memory instead.
+    """
+
+    #: Number of services built at once for each concurrent update
+    SERVICES_PER_JOB = 100
+
+    def __init__(self, args):
+        self.args = args
+        self.config_file = None
+        self.config_mtime = None
+        self.config_files = dict()
+        self.cache_file = None
+        self.service_state = None
+        self.address_store = None
+        self.trace_writer = None
+        # Duration in seconds of each phase of the last load and run
+        self.timings = dict()
+        self.identities = list()
+        # Services of the config, if they could not be stored in the compiled
+        # config
+        self._service_roots = None
+        self._provider_registry = dict()
+        self._global_providers = dict()
+        # Only applies to the first run
+        self.force_update = args.force_update
+
+    @contextlib.contextmanager
+    def _timed(self, phase):
+        start = time.perf_counter()
+        try:
+            with span(phase):
+                yield
+        finally:
+            # Phases of a run are repeated for each window of services
+            self.timings[phase] = self.timings.get(phase, 0) + time.perf_counter() - start
+
+    def load(self):
+        """(Re)load the config file, and the cache if its location changed."""
+        # The trace file is only known once the config has been parsed, so the
+        # spans of loading it are recorded and written once the writer exists
+        trace_writer = self.trace_writer
+        recorder = _SpanRecorder()
+        add_span_hook(recorder)
+        self.timings.pop("load", None)
+        try:
+            with self._timed("load"):
+                self._load()
+        finally:
+            remove_span_hook(recorder)
+        if self.trace_writer is not None and self.trace_writer is not trace_writer:
+            for finished in recorder.spans:
+                self.trace_writer.span_finished(finished)
+            add_span_hook(self.trace_writer)
+
+    def _load(self):
+        # Providers with identical configurations are shared between services
+        provider_registry = dict()
+        identities = list()
+        identity_counts = dict()
+
+        # Check that each service can be built as soon as it has been parsed.
+        # The services are built again by each run.
+        def add_service(service_root):
+            identities.append(_service_identity(service_root, identity_counts))
+            _parse_dns_service(service_root, provider_registry)
+
+        def discard_services():
+            identities.clear()
+            identity_counts.clear()
+
+        config, config_file, config_files, has_services, service_roots = _stream_config(
+            self.args.config, add_service, discard_services
+        )
+        if not isinstance(config, dict):
+            raise ConfigException("Config file must contain a mapping")
+        if not has_services:
+            raise ConfigException("dns_services must be specified")
+        # Editing an included file (such as a password) counts as changing
+        # the config
+        config_mtime = max(mtime for mtime, _, _ in config_files.values())
+        cache_backend = config.get("cache_backend", "yaml")
+        if cache_backend not in _CACHE_BACKENDS:
+            raise ConfigException("cache_backend must be one of: %s" % ", ".join(_CACHE_BACKENDS))
+        cache_file = os.path.expanduser(
+            config.get("cache_file", _CACHE_BACKENDS[cache_backend].DEFAULT_FILE)
+        )
+        address_cache_file = os.path.expanduser(
+            config.get(
+                "address_cache_file",
+                os.path.join(os.path.dirname(cache_file), "dnsupdate-addresses.cache"),
+            )
+        )
+
+        jobs = self.args.jobs if self.args.jobs is not None else config.get("jobs", 1)
+        if not isinstance(jobs, int) or jobs < 1:
+            raise ConfigException("jobs must be a positive integer")
+        processes = (
+            self.args.processes if self.args.processes is not None else config.get("processes", 1)
+        )
+        if not isinstance(processes, int) or processes < 1:
+            raise ConfigException("processes must be a positive integer")
+        if processes > 1 and not hasattr(os, "fork"):
+            raise ConfigException("processes is not supported on this platform")
+        engine = (
+            self.args.engine if self.args.engine is not None else config.get("engine", "threads")
+        )
+        if engine not in _ENGINES:
+            raise ConfigException("engine must be one of: %s" % ", ".join(_ENGINES))
+        interval = config.get("interval", 600)
+        if not isinstance(interval, (int, float)) or interval <= 0:
+            raise ConfigException("interval must be a positive number")
+        resolve_timeout = _optional_positive_number(config, "resolve_timeout")
+        run_deadline = _optional_positive_number(config, "run_deadline")
+        timeout = config.get("timeout", dict())
+        if not isinstance(timeout, dict):
+            timeout = {"connect": timeout, "read": timeout}
+        connect_timeout = _optional_positive_number(timeout, "connect", _Timeouts.DEFAULT_CONNECT)
+        read_timeout = _optional_positive_number(timeout, "read", _Timeouts.DEFAULT_READ)
+        metrics_file = config.get("metrics_file", None)
+        if metrics_file is not None:
+            metrics_file = os.path.expanduser(metrics_file)
+        metrics_port = config.get("metrics_port", None)
+        if metrics_port is not None and (
+            not isinstance(metrics_port, int) or not 0 < metrics_port < 65536
+        ):
+            raise ConfigException("metrics_port must be a port number")
+        metrics_address = config.get("metrics_address", "localhost")
+        trace_file = config.get("trace_file", None)
+        if trace_file is not None:
+            trace_file = os.path.expanduser(trace_file)
+        verify_server = config.get("verify_server", None)
+        verify_port = config.get("verify_port", 53)
+        if not isinstance(verify_port, int) or not 0 < verify_port < 65536:
+            raise ConfigException("verify_port must be a port number")
+        verify_timeout = _optional_positive_number(config, "verify_timeout", 2)
+        rate_limit = config.get("rate_limit", dict())
+        default_rate_limit = _parse_rate_limit(rate_limit)
+        host_rate_limits = rate_limit.get("hosts", dict())
+        if not isinstance(host_rate_limits, dict):
+            raise ConfigException("rate_limit hosts must be a mapping")
+        host_rate_limits = {
+            host: _parse_rate_limit(limit, rate_limit) for host, limit in host_rate_limits.items()
+        }
+
+        # Read global address provider from config, and use Web by default
+        global_providers = _parse_address_provider_protos(
+            config.get("address_provider", {"type": "Web"}), provider_registry
+        )
+
+        # Only replace the current configuration once the new one has been
+        # parsed successfully, so the daemon can keep running if it is invalid
+        self.config_file = config_file
+        self.config_mtime = config_mtime
+        self.config_files = config_files
+        self.jobs = jobs
+        self.processes = processes
+        self.engine = engine
+        self.interval = interval
+        self.resolve_timeout = resolve_timeout
+        self.run_deadline = run_deadline
+        _timeouts.connect = connect_timeout
+        _timeouts.read = read_timeout
+        _rate_limits.configure(default_rate_limit, host_rate_limits)
+        self.metrics_file = metrics_file
+        self.metrics_port = metrics_port
+        self.metrics_address = metrics_address
+        self.verify_server = verify_server
+        self.verify_port = verify_port
+        self.verify_timeout = verify_timeout
+        self.identities = identities
+        self._service_roots = service_roots
+        self._provider_registry = provider_registry
+        self._global_providers = global_providers
+        if cache_file != self.cache_file or not isinstance(
+            self.service_state, _CACHE_BACKENDS[cache_backend]
+        ):
+            if self.service_state is not None:
+                self.service_state.close()
+            self.cache_file = cache_file
+            self.service_state = _CACHE_BACKENDS[cache_backend](cache_file)
+        if self.address_store is None or address_cache_file != self.address_store.store_file:
+            self.address_store = _AddressStore(address_cache_file)
+        if trace_file != (self.trace_writer and self.trace_writer.trace_file):
+            if self.trace_writer is not None:
+                remove_span_hook(self.trace_writer)
+                self.trace_writer.close()
+                self.trace_writer = None
+            if trace_file is not None:
+                # Registered by load(), after the spans of loading are written
+                self.trace_writer = _JSONLinesSpanWriter(trace_file)
+
+    def providers(self):
+        """Get the set of address providers of the configuration."""
+        return {provider for provider in self._provider_registry.values() if provider is not None}
+
+    def _stream_services(self, on_window, start=0, stop=None):
+        """
+        Build services ``start`` to ``stop`` from the config file in turn,
+        calling ``on_window`` with each :class:`_ServiceWindow` of up to
+        ``jobs * SERVICES_PER_JOB`` of them, so only that many services are
+        held in memory at once. The compiled config is used if it is up to
+        date, so the config file is usually not parsed again, and the chunks
+        of other services are skipped. If it could not be written, the
+        services kept by :meth:`load` are used instead.
+        """
+        if stop is None:
+            stop = len(self.identities)
+        size = self.jobs * self.SERVICES_PER_JOB
+        window = _ServiceWindow(start)
+        # Position of the next service in the config
+        position = start
+        identity_counts = dict()
+
+        def add_service(service_root):
+            nonlocal window, position
+            i = position
+            position += 1
+            if i >= len(self.identities):
+                raise ConfigException("Config file changed while updating services")
+            expected = self.identities[i]
+            if start == 0:
+                identity = _service_identity(service_root, identity_counts)
+            else:
+                # The services before the range are not read, so services with
+                # the same identity can only be told apart by their position
+                identity = _service_identity(service_root, dict())
+                expected = expected.split("#")[0]
+            if identity != expected:
+                raise ConfigException("Config file changed while updating services")
+            # Skip services outside the range, or already built before the
+            # compiled config turned out to be corrupted
+            if not window.stop <= i < stop:
+                return
+            service, providers = _parse_dns_service(service_root, self._provider_registry)
+            window.append((service, {**self._global_providers, **providers}))
+            if len(window) == size:
+                on_window(window)
+                window = _ServiceWindow(i + 1)
+
+        def discard_services():
+            nonlocal position
+            position = start
+            identity_counts.clear()
+
+        if self._service_roots is not None:
+            for service_root in self._service_roots[start:stop]:
+                add_service(service_root)
         else:
-            providers = dict()
-        return service_class(**service_root.get("args", {})), providers
-    else:
-        return eval(service_root), dict()
+            _stream_config(self.config_file, add_service, discard_services, start, stop)
+        if position != stop:
+            raise ConfigException("Config file changed while updating services")
+        if len(window) > 0:
+            on_window(window)
 
+    def _update_windows(self, service_data_list, addresses, force_enable, indices, resolve=True):
+        """
+        Resolve, verify and update each window of the services in ``indices``
+        (a range) in turn (see :meth:`_stream_services`). If ``resolve`` is
+        false, the addresses must have been resolved already.
+        """
+        verify = self.verify_server is not None and not self.force_update
+        exit_codes = list()
+
+        def prepare(window):
+            lookups = list()
+            if resolve:
+                lookups = _address_lookups(window, service_data_list, force_enable, window.indices)
+            verify_args = (
+                window,
+                service_data_list,
+                addresses,
+                force_enable,
+                self.verify_server,
+                self.verify_port,
+                self.verify_timeout,
+                window.indices,
+            )
+            return lookups, verify_args
+
+        if self.engine == "asyncio":
+            import asyncio
+
+            async def update_window(window):
+                lookups, verify_args = prepare(window)
+                if resolve:
+                    with self._timed("resolve"):
+                        await addresses.async_resolve(lookups, self._resolve_timeout())
+                verified = frozenset()
+                if verify:
+                    with self._timed("verify"):
+                        verified = await _run_blocking(_verify_updates, *verify_args)
+                with self._timed("update"):
+                    return await _async_update_services(
+                        window,
+                        service_data_list,
+                        addresses,
+                        force_enable,
+                        self.force_update,
+                        self.jobs,
+                        verified,
+                        window.indices,
+                    )
+
+            async def run():
+                loop = asyncio.get_running_loop()
+
+                # Services are built in an executor thread, and each window
+                # is updated on the event loop
+                def on_window(window):
+                    future = asyncio.run_coroutine_threadsafe(update_window(window), loop)
+                    exit_codes.append(future.result())
+
+                async with _async_http_context(self.jobs):
+                    await _run_blocking(
+                        self._stream_services, on_window, indices.start, indices.stop
+                    )
+
+            asyncio.run(run())
+        else:
 
-def _parse_address_provider(provider_root):
-    if not isinstance(provider_root, str):
-        class_name = provider_root["type"]
-        provider_class = globals()[class_name]
-        return provider_class(**provider_root.get("args", {}))
-    else:
-        return eval(provider_root)
+            def on_window(window):
+                lookups, verify_args = prepare(window)
+                if resolve:
+                    with self._timed("resolve"):
+                        addresses.resolve(lookups, self._resolve_timeout(), max(self.jobs, 32))
+                verified = frozenset()
+                if verify:
+                    with self._timed("verify"):
+                        verified = _verify_updates(*verify_args)
+                with self._timed("update"):
+                    exit_codes.append(
+                        _update_services(
+                            window,
+                            service_data_list,
+                            addresses,
+                            force_enable,
+                            self.force_update,
+                            self.jobs,
+                            verified,
+                            window.indices,
+                        )
+                    )
 
+            self._stream_services(on_window, indices.start, indices.stop)
 
-def _parse_address_provider_protos(provider_root):
-    providers = dict()
-    for proto in ("ipv4", "ipv6"):
-        if proto in provider_root:
-            providers[proto] = _parse_address_provider(provider_root[proto])
-    if not ("ipv4" in providers or "ipv6" in providers):
-        providers["ipv4"] = providers["ipv6"] = _parse_address_provider(provider_root)
-    return providers
+        exit_code = ExitCode.SUCCESS
+        for window_exit_code in exit_codes:
+            if window_exit_code != ExitCode.SUCCESS:
+                exit_code = window_exit_code
+        return exit_code
+
+    def config_changed(self):
+        """Check whether the config file or any file it includes has changed."""
+        if self.config_file is None or self.config_mtime is None:
+            return True
+        for filename, (mtime, _, _) in self.config_files.items():
+            try:
+                if os.path.getmtime(filename) != mtime:
+                    return True
+            except OSError:
+                return True
+        return False
+
+    def run(self):
+        with span("run"):
+            if self.config_changed():
+                self.load()
+
+            start = time.perf_counter()
+            if self.run_deadline is not None:
+                _timeouts.deadline = time.monotonic() + self.run_deadline
+            try:
+                exit_code = self._run()
+            finally:
+                _timeouts.deadline = None
+
+        _metrics.set("dnsupdate_last_run_duration_seconds", time.perf_counter() - start)
+        _metrics.set("dnsupdate_last_run_timestamp_seconds", time.time())
+        _metrics.set("dnsupdate_last_run_exit_code", exit_code)
+        if self.metrics_file is not None:
+            try:
+                _metrics.write(self.metrics_file)
+            except OSError as e:
+                print("Warning: cannot write metrics file: %s" % e, file=sys.stderr)
+        return exit_code
+
+    def _resolve_timeout(self):
+        """Get the time allowed for resolving addresses."""
+        timeouts = [t for t in (self.resolve_timeout, _timeouts.remaining()) if t is not None]
+        return min(timeouts) if timeouts else None
+
+    def _run(self):
+        for phase in ("resolve", "verify", "update", "save"):
+            self.timings.pop(phase, None)
+        mtime, service_data_list = self.service_state.load(self.identities)
+
+        # Enable all services if the config file has been updated
+        force_enable = mtime != self.config_mtime or self.force_update
+
+        # Table of addresses from providers to prevent duplicate lookups.
+        # Stored addresses are ignored when forcing an update.
+        addresses = _AddressCache(self.address_store, refresh=self.force_update)
+        Web._import_latencies(self.address_store.latencies())
+        update_args = (service_data_list, addresses, force_enable)
+        count = len(self.identities)
+        if self.processes > 1 and count > 1:
+            # Addresses are resolved once, and shared with the worker
+            # processes. This builds the services an extra time, to find the
+            # address providers they use.
+            lookups = dict()
+
+            def add_lookups(window):
+                window_lookups = _address_lookups(
+                    window, service_data_list, force_enable, window.indices
+                )
+                lookups.update(dict.fromkeys(window_lookups))
 
+            self._stream_services(add_lookups)
+            with self._timed("resolve"):
+                addresses.resolve(list(lookups), self._resolve_timeout(), max(self.jobs, 32))
 
-def _get_arg_parser():
-    parser = argparse.ArgumentParser(description="Dynamic DNS update client")
-    parser.add_argument("config", help="the config file to use", nargs="?")
-    parser.add_argument(
-        "-f",
-        "--force-update",
-        help="""force an update to occur even if the address has not changed
-                                 or a service has been disabled""",
-        action="store_true",
-        dest="force_update",
-    )
-    parser.add_argument("-V", "--version", action="version", version="%(prog)s " + __version__)
-    return parser
+            def update(indices):
+                exit_code = self._update_windows(*update_args, indices, resolve=False)
+                return exit_code, service_data_list
 
+            with self._timed("update"):
+                exit_code = _run_shards(update, count, service_data_list, self.processes)
+        else:
+            exit_code = self._update_windows(*update_args, range(count))
 
-def _parse_args():
-    return _get_arg_parser().parse_args()
+        with self._timed("save"):
+            self.service_state.save(self.config_mtime, self.identities, service_data_list)
+            self.address_store.put_latencies(Web._export_latencies())
+            self.address_store.save()
+        self.force_update = False
 
+        return exit_code
 
-def main():
-    exit_code = ExitCode.SUCCESS
 
-    # Parse command line arguments
-    args = _parse_args()
+def _sd_notify(message):
+    """
+    Send a notification to systemd, if running as a ``Type=notify`` service.
+    See sd_notify(3).
+    """
+    address = os.environ.get("NOTIFY_SOCKET", None)
+    if not address:
+        return
+    if address[0] == "@":
+        # Abstract namespace socket
+        address = "\0" + address[1:]
+    with socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM) as sock:
+        sock.connect(address)
+        sock.sendall(message.encode())
+
+
+def _watchdog_interval():
+    """
+    Get the interval at which the systemd watchdog must be pinged, or ``None``
+    if it is disabled. Pings are sent at twice the required rate.
+    """
+    usec = os.environ.get("WATCHDOG_USEC", None)
+    pid = os.environ.get("WATCHDOG_PID", None)
+    if not usec or (pid and int(pid) != os.getpid()):
+        return None
+    return int(usec) / 2e6
+
+
+@contextlib.contextmanager
+def _watchdog_pings(interval):
+    """
+    Ping the systemd watchdog every ``interval`` seconds from a background
+    thread for the duration of a ``with`` statement, so that update runs
+    longer than the watchdog timeout do not get the daemon killed. Nothing is
+    done if ``interval`` is ``None``.
+    """
+    if interval is None:
+        yield
+        return
+    stop = threading.Event()
 
-    config, config_file = _load_config(args.config)
-    cache_file = os.path.expanduser(config.get("cache_file", "~/.cache/dnsupdate.cache"))
-    service_data_cache = _load_cache(cache_file)
+    def ping():
+        while not stop.wait(interval):
+            _sd_notify("WATCHDOG=1")
 
-    # Check and fix cache data format
+    thread = threading.Thread(target=ping, daemon=True)
+    thread.start()
     try:
-        service_data_list = service_data_cache["dns_services"]
-    except KeyError:
-        service_data_list = list()
-        service_data_cache = dict()
-        service_data_cache["dns_services"] = service_data_list
-
-    # Enable all services if the config file has been updated
-    new_mtime = os.path.getmtime(config_file)
-    force_enable = service_data_cache.get("mtime", None) != new_mtime or args.force_update
-    service_data_cache["mtime"] = new_mtime
-
-    # Read global address provider from config, and use Web by default
-    global_providers = _parse_address_provider_protos(
-        config.get("address_provider", {"type": "Web"})
-    )
+        yield
+    finally:
+        stop.set()
+        thread.join()
 
-    # Cache of addresses from providers to prevent duplicate lookups
-    new_addresses = dict()
 
-    services = config["dns_services"]
-    for i, service_root in enumerate(services):
-        service, providers = _parse_dns_service(service_root)
-        # Merge global and local providers
-        providers = {**global_providers, **providers}
+def _watch_providers(selector, runner):
+    """
+    Register the change notification objects of the runner's address providers
+    with a selector, replacing those of any previous configuration.
+    """
+    for key in list(selector.get_map().values()):
+        if key.data is not None:
+            selector.unregister(key.fileobj)
+    for provider in runner.providers():
+        try:
+            watch = provider.watch()
+        except OSError as e:
+            print("Warning: cannot watch %s for changes: %s" % (provider, e), file=sys.stderr)
+            continue
+        if watch is not None:
+            selector.register(watch, selectors.EVENT_READ, provider)
 
-        # Get data for service from saved data, or create it
-        if i < len(service_data_list):
-            service_data = service_data_list[i]
-        else:
-            service_data = dict()
-            service_data_list.append(service_data)
 
-        for proto, provider in providers.items():
-            if provider is not None:
-                print(
-                    "Updating %s address of service %d (%s)..."
-                    % ("IP" + proto[2:], i, str(service))
-                )
+def _daemon(runner):
+    """
+    Repeatedly perform update runs every ``interval`` seconds until
+    terminated, or sooner if an address provider reports that its addresses
+    have changed. SIGHUP reloads the config file and starts a run immediately.
+    """
+    # Signal handlers wake up the main loop by writing to this socket
+    wake_reader, wake_writer = socket.socketpair()
+    wake_reader.setblocking(False)
+    stopping = False
 
-                try:
-                    service_proto_data = service_data.setdefault(proto, dict())
-                    if force_enable or service_proto_data.setdefault("enabled", True):
-                        # Get updated address
-                        if provider in new_addresses and proto in new_addresses[provider]:
-                            new_address = new_addresses[provider][proto]
-                        else:
-                            # Call ipv4() or ipv6() method
-                            new_address = getattr(provider, proto)()
-                            if provider not in new_addresses:
-                                new_addresses[provider] = {proto: new_address}
-                            else:
-                                new_addresses[provider][proto] = new_address
-                        # Get old address
-                        old_address = service_proto_data.get("address", None)
-                        if str(new_address) != old_address or args.force_update:
-                            try:
-                                getattr(service, "update_%s" % proto)(new_address)
-                                service_proto_data["address"] = str(new_address)
-                                service_proto_data["enabled"] = True
-                                print("Update successful.")
-                            except UpdateClientException as e:
-                                print("Error: %s" % e, file=sys.stderr)
-                                print(
-                                    "Update failed due to a configuration error. "
-                                    "Service will be disabled until the configuration "
-                                    "has been fixed.",
-                                    file=sys.stderr,
-                                )
-                                service_proto_data["enabled"] = False
-                                exit_code = ExitCode.CLIENT_ERROR
-                            except UpdateServiceException as ue:
-                                print("Error: %s" % ue, file=sys.stderr)
-                                exit_code = ExitCode.SERVICE_ERROR
-                        else:
-                            print("Address has not changed, no update needed.")
-                    else:
-                        print(
-                            "Service has been disabled due to a previous client error. "
-                            "Please fix your configuration and try again.",
-                            file=sys.stderr,
-                        )
-                        exit_code = ExitCode.CLIENT_ERROR
-                except Exception as e:
-                    print("Error: %s" % e, file=sys.stderr)
-                    exit_code = ExitCode.OTHER_ERROR
+    def handle_stop(signum, frame):
+        nonlocal stopping
+        stopping = True
+        wake_writer.send(b"\0")
+
+    def handle_reload(signum, frame):
+        runner.config_mtime = None
+        wake_writer.send(b"\0")
+
+    signal.signal(signal.SIGTERM, handle_stop)
+    signal.signal(signal.SIGINT, handle_stop)
+    signal.signal(signal.SIGHUP, handle_reload)
+
+    selector = selectors.DefaultSelector()
+    selector.register(wake_reader, selectors.EVENT_READ)
 
-    # Delete any extra services from the cache
-    del service_data_list[len(services) :]
+    watchdog_interval = _watchdog_interval()
+    exit_code = ExitCode.SUCCESS
+
+    metrics_server = None
+    metrics_listen = None
+
+    def update_metrics_server():
+        """(Re)start the metrics server if its configuration has changed."""
+        nonlocal metrics_server, metrics_listen
+        listen = (runner.metrics_address, runner.metrics_port)
+        if listen == metrics_listen:
+            return
+        if metrics_server is not None:
+            metrics_server.shutdown()
+            metrics_server.server_close()
+            metrics_server = None
+        metrics_listen = listen
+        if runner.metrics_port is not None:
+            try:
+                metrics_server = _serve_metrics(*listen)
+            except OSError as e:
+                print("Warning: cannot serve metrics: %s" % e, file=sys.stderr)
 
-    _save_cache(cache_file, service_data_cache)
+    update_metrics_server()
 
+    _sd_notify("READY=1")
+    while not stopping:
+        try:
+            with _watchdog_pings(watchdog_interval):
+                exit_code = runner.run()
+        except Exception as e:
+            print("Error: %s" % e, file=sys.stderr)
+            exit_code = ExitCode.OTHER_ERROR
+        sys.stdout.flush()
+        sys.stderr.flush()
+        _sd_notify(
+            "STATUS=Last run finished at %s (%s)"
+            % (time.strftime("%Y-%m-%d %H:%M:%S"), exit_code.name.lower())
+        )
+        _watch_providers(selector, runner)
+        update_metrics_server()
+
+        next_run = time.monotonic() + runner.interval
+        run_now = False
+        while not (stopping or run_now):
+            if watchdog_interval is not None:
+                _sd_notify("WATCHDOG=1")
+            remaining = next_run - time.monotonic()
+            if remaining <= 0:
+                break
+            if watchdog_interval is not None:
+                remaining = min(remaining, watchdog_interval)
+            for key, _ in selector.select(remaining):
+                if key.fileobj is wake_reader:
+                    try:
+                        while wake_reader.recv(4096):
+                            pass
+                    except BlockingIOError:
+                        pass
+                    run_now = True
+                elif key.data.changed():
+                    run_now = True
+
+    if metrics_server is not None:
+        metrics_server.shutdown()
+        metrics_server.server_close()
+    selector.close()
+    wake_reader.close()
+    wake_writer.close()
+    _sd_notify("STOPPING=1")
     return exit_code
 
 
+def main():
+    # Parse command line arguments
+    args = _parse_args()
+
+    runner = _Runner(args)
+    runner.load()
+
+    if args.daemon:
+        return _daemon(runner)
+    return runner.run()
+
+
 if __name__ == "__main__":
     sys.exit(main())
 
@@ -1,9 +1,55 @@
+import asyncio
+import base64
+import contextlib
+import datetime
+import hashlib
+import hmac
+import http.server
+import importlib.util
+import io
+import ipaddress
+import json
+import os
+import select
+import shutil
+import signal
+import socket
+import socketserver
+import sqlite3
+import struct
+import subprocess
+import sys
+import tempfile
+import threading
+import time
 import unittest
+from concurrent.futures import ThreadPoolExecutor
+from ipaddress import IPv4Address, IPv6Address
+from urllib.parse import parse_qs, urlsplit, urlunsplit
 
+import requests
+import yaml
 from yaml import load
 
 import dnsupdate
 
+_cache_home = None
+_environ = None
+
+
+def setUpModule():
+    # Keep compiled configs out of the user's cache directory
+    global _cache_home, _environ
+    _cache_home = tempfile.TemporaryDirectory()
+    _environ = os.environ.copy()
+    os.environ["XDG_CACHE_HOME"] = _cache_home.name
+
+
+def tearDownModule():
+    os.environ.clear()
+    os.environ.update(_environ)
+    _cache_home.cleanup()
+
 
 class ConfigTest(unittest.TestCase):
     def _parse_address_provider_web(self, config):
@@ -57,6 +103,19 @@ class ConfigTest(unittest.TestCase):
         )
         self.assertRaises(TypeError, dnsupdate._parse_address_provider, config)
 
+    def test_parse_address_provider_cache_ttl(self):
+        config = load(
+            """
+            type: Web
+            cache_ttl: 300
+        """,
+            dnsupdate._ConfigLoader,
+        )
+        provider = dnsupdate._parse_address_provider(config)
+        self.assertEqual(provider.cache_ttl, 300)
+        self.assertEqual(provider._config_key, '{"args": {}, "type": "Web"}')
+        self.assertEqual(dnsupdate.Web().cache_ttl, 0)
+
     def test_parse_address_provider_invalid_class(self):
         config = load(
             """
@@ -125,6 +184,39 @@ class ConfigTest(unittest.TestCase):
         self.assertIsInstance(providers["ipv4"], dnsupdate.Web)
         self.assertEqual(providers["ipv4"], providers["ipv6"])
 
+    def test_parse_dns_service_shared_address_provider(self):
+        config = load(
+            """
+            - type: StaticURL
+              address_provider:
+                  ipv6:
+                      type: Web
+              args:
+                  ipv4_url: ipv4_test_url
+            - type: StaticURL
+              address_provider:
+                  ipv6:
+                      type: Web
+                      args: {}
+              args:
+                  ipv4_url: ipv4_test_url
+            - type: StaticURL
+              address_provider:
+                  ipv6:
+                      type: Web
+                      args:
+                          ipv6_url: ipv6_test_url
+              args:
+                  ipv4_url: ipv4_test_url
+        """,
+            dnsupdate._ConfigLoader,
+        )
+        registry = dict()
+        providers = [dnsupdate._parse_dns_service(s, registry)[1]["ipv6"] for s in config]
+        self.assertIs(providers[0], providers[1])
+        self.assertIsNot(providers[0], providers[2])
+        self.assertEqual(providers[2].ipv6_url, "ipv6_test_url")
+
     def test_parse_include(self):
         config = """
            test_key: !include tests/include.yml
@@ -143,10 +235,2070 @@ class ConfigTest(unittest.TestCase):
         self.assertEqual(data["test_key"], "test string\nline two")
 
 
+class PluginTest(unittest.TestCase):
+    def setUp(self):
+        # A distribution providing a DNS service through an entry point
+        self.dir = tempfile.TemporaryDirectory()
+        with open(os.path.join(self.dir.name, "dnsupdate_test_plugin.py"), "w") as f:
+            f.write(
+                "import dnsupdate\n"
+                "class PluginService(dnsupdate.DNSService):\n"
+                "    def __init__(self, hostname):\n"
+                "        self.hostname = hostname\n"
+                "NotAService = object\n"
+            )
+        dist_info = os.path.join(self.dir.name, "dnsupdate_test_plugin-1.0.dist-info")
+        os.mkdir(dist_info)
+        with open(os.path.join(dist_info, "METADATA"), "w") as f:
+            f.write("Metadata-Version: 2.1\nName: dnsupdate-test-plugin\nVersion: 1.0\n")
+        with open(os.path.join(dist_info, "entry_points.txt"), "w") as f:
+            f.write(
+                "[dnsupdate.dns_services]\n"
+                "PluginService = dnsupdate_test_plugin:PluginService\n"
+                "NotAService = dnsupdate_test_plugin:NotAService\n"
+            )
+        sys.path.insert(0, self.dir.name)
+
+    def tearDown(self):
+        sys.path.remove(self.dir.name)
+        sys.modules.pop("dnsupdate_test_plugin", None)
+        dnsupdate._plugins.clear()
+        self.dir.cleanup()
+
+    def test_entry_point(self):
+        self.assertNotIn("dnsupdate_test_plugin", sys.modules)
+        # Built in classes don't load plugins
+        dnsupdate._parse_dns_service({"type": "StaticURL", "args": {"ipv4_url": "url"}})
+        self.assertNotIn("dnsupdate_test_plugin", sys.modules)
+
+        service, _ = dnsupdate._parse_dns_service(
+            {"type": "PluginService", "args": {"hostname": "example.com"}}
+        )
+        self.assertEqual(type(service).__module__, "dnsupdate_test_plugin")
+        self.assertEqual(service.hostname, "example.com")
+
+    def test_shorthand(self):
+        service, _ = dnsupdate._parse_dns_service("PluginService(str('example.com'))")
+        self.assertEqual(service.hostname, "example.com")
+
+    def test_invalid(self):
+        self.assertRaises(KeyError, dnsupdate._parse_dns_service, {"type": "Missing"})
+        self.assertRaises(
+            dnsupdate.ConfigException, dnsupdate._parse_dns_service, {"type": "NotAService"}
+        )
+        # Only address providers can be used as address providers
+        self.assertRaises(KeyError, dnsupdate._parse_address_provider, {"type": "PluginService"})
+
+
+class CompiledConfigTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.config_file = os.path.join(self.dir.name, "dnsupdate.conf")
+        self.include_file = os.path.join(self.dir.name, "password.txt")
+        with open(self.config_file, "w") as f:
+            f.write("password: !include_text password.txt\n")
+        self._write_include("first", 1000000000)
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    def _write_include(self, text, mtime):
+        with open(self.include_file, "w") as f:
+            f.write(text)
+        os.utime(self.include_file, (mtime, mtime))
+
+    def test_compiled_config(self):
+        config, config_file, files = dnsupdate._load_config(self.config_file)
+        self.assertEqual(config, {"password": "first"})
+        self.assertEqual(set(files), {self.config_file, self.include_file})
+        self.assertEqual(files[self.include_file][:2], (1000000000, 5))
+
+        # Unchanged mtime and size, so the config is not parsed again
+        self._write_include("other", 1000000000)
+        self.assertEqual(dnsupdate._load_config(self.config_file)[0], {"password": "first"})
+
+        # Touched, but the contents are the same
+        self._write_include("first", 1000000001)
+        self.assertEqual(dnsupdate._load_config(self.config_file)[0], {"password": "first"})
+
+        self._write_include("second", 1000000002)
+        config, _, files = dnsupdate._load_config(self.config_file)
+        self.assertEqual(config, {"password": "second"})
+        self.assertEqual(files[self.include_file][:2], (1000000002, 6))
+
+    def test_compiled_config_invalid(self):
+        dnsupdate._load_config(self.config_file)
+        with open(dnsupdate._compiled_config_file(self.config_file), "wb") as f:
+            f.write(b"invalid")
+        self.assertEqual(dnsupdate._load_config(self.config_file)[0], {"password": "first"})
+
+    def test_compiled_config_json(self):
+        dnsupdate._load_config(self.config_file)
+        with open(dnsupdate._compiled_config_file(self.config_file), "rb") as f:
+            header = f.read()[: -dnsupdate._COMPILED_CONFIG_TRAILER.size]
+        self.assertEqual(json.loads(header)[2], {"password": "first"})
+
+        # Configs that JSON cannot represent are parsed every time
+        compiled_config_file = dnsupdate._compiled_config_file(self.config_file)
+        os.remove(compiled_config_file)
+        with open(self.config_file, "a") as f:
+            f.write("extra: {1: 2001-02-03}\n")
+        for _ in range(2):
+            config = dnsupdate._load_config(self.config_file)[0]
+            self.assertEqual(config["extra"], {1: datetime.date(2001, 2, 3)})
+        self.assertFalse(os.path.exists(compiled_config_file))
+
+    def test_stream_config(self):
+        count = dnsupdate._CompiledConfigWriter.CHUNK_SIZE * 2 + 1
+        lines = ["dns_services:", "  - &first {type: NoIP, args: {hostname: a}}"]
+        lines += ["  - {type: NoIP, args: {hostname: host%d}}" % i for i in range(count)]
+        lines += ["  - *first", "jobs: 4", "password: !include_text password.txt"]
+        with open(self.config_file, "w") as f:
+            f.write("\n".join(lines) + "\n")
+        expected = yaml.safe_load("\n".join(lines[:-1]))
+        expected["password"] = "first"
+
+        def stream():
+            service_roots = list()
+            config, _, _, has_services, uncached = dnsupdate._stream_config(
+                self.config_file, service_roots.append, service_roots.clear
+            )
+            self.assertTrue(has_services)
+            self.assertIsNone(uncached)
+            return config, service_roots
+
+        # Parsed, then loaded from the compiled config
+        for _ in range(2):
+            config, service_roots = stream()
+            self.assertEqual(config, {"jobs": 4, "password": "first"})
+            self.assertEqual(service_roots, expected["dns_services"])
+        # The header is rewritten when a file is touched
+        self._write_include("first", 1000000001)
+        self.assertEqual(stream()[1], expected["dns_services"])
+        self.assertEqual(dnsupdate._load_config(self.config_file)[0], expected)
+
+        # Corrupt the second chunk, after the first has been delivered
+        with open(dnsupdate._compiled_config_file(self.config_file), "r+b") as f:
+            f.seek(len(f.readline()) + 10)
+            f.write(b"\xff")
+        self.assertEqual(stream()[1], expected["dns_services"])
+        # Parsed again, so the cache is valid again
+        self.assertEqual(stream()[1], expected["dns_services"])
+
+    def test_stream_config_range(self):
+        count = dnsupdate._CompiledConfigWriter.CHUNK_SIZE * 3
+        lines = ["dns_services:"]
+        lines += ["  - {type: NoIP, args: {hostname: host%d}}" % i for i in range(count)]
+        with open(self.config_file, "w") as f:
+            f.write("\n".join(lines) + "\n")
+        expected = yaml.safe_load("\n".join(lines))["dns_services"]
+
+        def stream(start, stop):
+            service_roots = list()
+            uncached = dnsupdate._stream_config(
+                self.config_file, service_roots.append, service_roots.clear, start, stop
+            )[4]
+            self.assertIsNone(uncached)
+            return service_roots
+
+        # Parsed, then loaded from the compiled config
+        self.assertEqual(stream(600, 700), expected[600:700])
+        self.assertEqual(stream(600, 700), expected[600:700])
+        self.assertEqual(stream(999, None), expected[999:])
+        # Chunks outside the range are not decoded
+        with open(dnsupdate._compiled_config_file(self.config_file), "r+b") as f:
+            f.seek(10)
+            f.write(b"\xff")
+        self.assertEqual(stream(500, 1000), expected[500:1000])
+
+    def test_stream_yaml_merge(self):
+        documents = [
+            "base: &b {jobs: 2, interval: 5}\n<<: *b\ninterval: 10\ndns_services: []\n",
+            "jobs: 1\n<<: [{jobs: 2, cache_file: a}, {cache_file: b, interval: 3}]\n",
+            "services: &s {dns_services: [{type: NoIP}]}\n<<: *s\n",
+            "<<: {dns_services: [{type: NoIP}]}\ndns_services: [{type: StaticURL}]\n",
+        ]
+        for document in documents:
+            with self.subTest(document=document):
+                service_roots = list()
+                config, has_services = dnsupdate._stream_yaml(
+                    document, self.dir.name, service_roots.append
+                )
+                expected = yaml.safe_load(document)
+                self.assertEqual(has_services, "dns_services" in expected)
+                self.assertEqual(service_roots, expected.pop("dns_services", []))
+                self.assertEqual(config, expected)
+
+    def test_stream_config_include(self):
+        with open(self.config_file, "w") as f:
+            f.write("dns_services: !include services.yaml\n")
+        with open(os.path.join(self.dir.name, "services.yaml"), "w") as f:
+            f.write("- {type: NoIP, args: {hostname: a}}\n")
+        self.assertEqual(
+            dnsupdate._load_config(self.config_file)[0],
+            {"dns_services": [{"type": "NoIP", "args": {"hostname": "a"}}]},
+        )
+
+    def test_config_changed_include(self):
+        with open(self.config_file, "a") as f:
+            f.write("dns_services: []\n")
+        runner = dnsupdate._Runner(dnsupdate._get_arg_parser().parse_args([self.config_file]))
+        runner.load()
+        self.assertEqual(runner.config_mtime, os.path.getmtime(self.config_file))
+        self.assertFalse(runner.config_changed())
+        self._write_include("second", 2000000000)
+        self.assertTrue(runner.config_changed())
+        runner.load()
+        self.assertEqual(runner.config_mtime, 2000000000)
+
+
 class CacheTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.cache_file = os.path.join(self.dir.name, "dnsupdate.cache")
+
+    def tearDown(self):
+        self.dir.cleanup()
+
     def test_load_empty_cache(self):
         cache = dnsupdate._load_cache("/invalid_dir/invalid_file.cache")
         self.assertDictEqual(cache, dict())
 
+    def test_load_yaml_cache(self):
+        with open(self.cache_file, "w") as f:
+            yaml.dump({"mtime": 1.5, "dns_services": [{"ipv4": {"enabled": False}}]}, f)
+        state = dnsupdate._YAMLServiceState(self.cache_file)
+        self.assertEqual(state.load(["a"]), (1.5, [{"ipv4": {"enabled": False}}]))
+
+    def test_save_unchanged(self):
+        state = dnsupdate._YAMLServiceState(self.cache_file)
+        mtime, service_data_list = state.load(["a"])
+        state.save(1.5, ["a"], service_data_list)
+        inode = os.stat(self.cache_file).st_ino
+        state = dnsupdate._YAMLServiceState(self.cache_file)
+        mtime, service_data_list = state.load(["a"])
+        self.assertEqual(mtime, 1.5)
+        state.save(1.5, ["a"], service_data_list)
+        self.assertEqual(os.stat(self.cache_file).st_ino, inode)
+        service_data_list[0]["ipv4"] = {"address": "192.0.2.1"}
+        state.save(1.5, ["a"], service_data_list)
+        self.assertNotEqual(os.stat(self.cache_file).st_ino, inode)
+        self.assertEqual(dnsupdate._load_cache(self.cache_file)["dns_services"], service_data_list)
+
+    def test_atomic_write(self):
+        with open(self.cache_file, "w") as f:
+            f.write("old")
+        os.chmod(self.cache_file, 0o600)
+        dnsupdate._atomic_write(self.cache_file, "new")
+        with open(self.cache_file) as f:
+            self.assertEqual(f.read(), "new")
+        self.assertEqual(os.stat(self.cache_file).st_mode & 0o777, 0o600)
+        self.assertEqual(os.listdir(self.dir.name), ["dnsupdate.cache"])
+
+    def test_atomic_write_umask(self):
+        umask = os.umask(0o027)
+        try:
+            dnsupdate._atomic_write(self.cache_file, "new")
+        finally:
+            os.umask(umask)
+        self.assertEqual(os.stat(self.cache_file).st_mode & 0o777, 0o640)
+
+    def test_save_private(self):
+        for backend, cls in dnsupdate._CACHE_BACKENDS.items():
+            with self.subTest(backend=backend):
+                state = cls(self.cache_file)
+                state.save(1.5, ["a"], [{"ipv4": {"address": "192.0.2.1"}}])
+                state.close()
+                self.assertEqual(os.stat(self.cache_file).st_mode & 0o777, 0o600)
+                os.remove(self.cache_file)
+
+    def test_change_backend(self):
+        service_data_list = [{"ipv4": {"address": "192.0.2.1"}}, {"ipv4": {"enabled": False}}]
+        state = dnsupdate._YAMLServiceState(self.cache_file)
+        state.save(1.5, ["a", "b"], service_data_list)
+
+        # The JSON cache is converted, keeping the data at each position
+        stderr = io.StringIO()
+        with contextlib.redirect_stderr(stderr):
+            state = dnsupdate._SQLiteServiceState(self.cache_file)
+        self.assertIn("converting cache file", stderr.getvalue())
+        self.assertEqual(state.load(["b", "a"]), (1.5, service_data_list))
+        state.save(1.5, ["b", "a"], service_data_list)
+        state.close()
+        state = dnsupdate._SQLiteServiceState(self.cache_file)
+        self.assertEqual(state.load(["a", "b"]), (1.5, service_data_list[::-1]))
+        state.close()
+
+        # The database is ignored, and replaced when the cache is saved
+        stderr = io.StringIO()
+        with contextlib.redirect_stderr(stderr):
+            state = dnsupdate._YAMLServiceState(self.cache_file)
+        self.assertIn("ignoring unreadable cache file", stderr.getvalue())
+        self.assertEqual(state.load(["a"]), (None, [dict()]))
+        state.save(1.5, ["a"], [dict()])
+        self.assertEqual(dnsupdate._load_cache(self.cache_file)["dns_services"], [dict()])
+
+
+class _CountingProvider(dnsupdate.AddressProvider):
+    def __init__(self):
+        self.lookups = 0
+        self._lock = threading.Lock()
+
+    def ipv4(self):
+        with self._lock:
+            self.lookups += 1
+        return IPv4Address("192.0.2.1")
+
+
+class _RecordingService(dnsupdate.DNSService):
+    def __init__(self, error=None, result=None):
+        self.error = error
+        self.result = result
+        self.addresses = list()
+
+    def update_ipv4(self, address):
+        if self.error is not None:
+            raise self.error
+        self.addresses.append(address)
+        return self.result
+
+
+class AddressStoreTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.store_file = os.path.join(self.dir.name, "addresses.cache")
+        self.provider = _CountingProvider()
+        self.provider.cache_ttl = 60
+        self.provider._config_key = "provider"
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    def _lookup(self, refresh=False):
+        store = dnsupdate._AddressStore(self.store_file)
+        address = dnsupdate._AddressCache(store, refresh).get(self.provider, "ipv4")
+        store.save()
+        return address
+
+    def test_reuse(self):
+        self.assertEqual(self._lookup(), IPv4Address("192.0.2.1"))
+        self.assertEqual(self._lookup(), IPv4Address("192.0.2.1"))
+        self.assertEqual(self.provider.lookups, 1)
+
+    def test_refresh(self):
+        self._lookup()
+        self._lookup(refresh=True)
+        self.assertEqual(self.provider.lookups, 2)
+
+    def test_expired(self):
+        self._lookup()
+        self.provider.cache_ttl = 0.01
+        time.sleep(0.02)
+        self._lookup()
+        self.assertEqual(self.provider.lookups, 2)
+
+    def test_no_credentials(self):
+        self.provider._config_key = '{"args": {"password": "hunter2"}, "type": "Router"}'
+        with open(self.store_file, "w") as f:
+            json.dump({"old": {"ipv4": {"address": "192.0.2.9", "time": time.time()}}}, f)
+        self._lookup()
+        with open(self.store_file) as f:
+            text = f.read()
+        self.assertNotIn("hunter2", text)
+        self.assertNotIn("old", text)
+        self.assertEqual(os.stat(self.store_file).st_mode & 0o777, 0o600)
+        self._lookup()
+        self.assertEqual(self.provider.lookups, 1)
+
+    def test_disabled(self):
+        self.provider.cache_ttl = 0
+        self._lookup()
+        self._lookup()
+        self.assertEqual(self.provider.lookups, 2)
+        self.assertFalse(os.path.exists(self.store_file))
+
+
+class _SlowProvider(dnsupdate.AddressProvider):
+    def __init__(self, delay):
+        self.delay = delay
+
+    def ipv4(self):
+        time.sleep(self.delay)
+        return IPv4Address("192.0.2.2")
+
+    async def async_ipv4(self):
+        await asyncio.sleep(self.delay)
+        return IPv4Address("192.0.2.2")
+
+
+class ResolveTest(unittest.TestCase):
+    def _resolve(self, engine):
+        fast, slow = _CountingProvider(), _SlowProvider(2)
+        lookups = [(fast, "ipv4"), (slow, "ipv4"), (_SlowProvider(0.1), "ipv4")]
+        addresses = dnsupdate._AddressCache()
+        start = time.monotonic()
+        if engine == "asyncio":
+            asyncio.run(addresses.async_resolve(lookups, 0.5))
+        else:
+            addresses.resolve(lookups, 0.5)
+        self.assertLess(time.monotonic() - start, 2)
+        self.assertEqual(addresses.get(fast, "ipv4"), IPv4Address("192.0.2.1"))
+        self.assertEqual(addresses.get(*lookups[2]), IPv4Address("192.0.2.2"))
+        with self.assertRaises(dnsupdate.AddressProviderException):
+            addresses.get(slow, "ipv4")
+
+    def test_resolve(self):
+        self._resolve("threads")
+
+    def test_async_resolve(self):
+        self._resolve("asyncio")
+
+    def test_resolve_max_workers(self):
+        active = list()
+        peak = list()
+
+        class Provider(dnsupdate.AddressProvider):
+            def ipv4(self):
+                active.append(None)
+                peak.append(len(active))
+                time.sleep(0.05)
+                active.pop()
+                return IPv4Address("192.0.2.1")
+
+        addresses = dnsupdate._AddressCache()
+        addresses.resolve([(Provider(), "ipv4") for _ in range(6)], max_workers=2)
+        self.assertEqual(len(peak), 6)
+        self.assertEqual(max(peak), 2)
+
+    def test_resolve_abandoned_exit(self):
+        code = """if True:
+            import time
+            import dnsupdate
+
+            class Provider(dnsupdate.AddressProvider):
+                def ipv4(self):
+                    time.sleep(30)
+
+            dnsupdate._AddressCache().resolve([(Provider(), "ipv4")], 0.1)
+        """
+        start = time.monotonic()
+        subprocess.run(
+            [sys.executable, "-c", code], check=True, cwd=os.path.dirname(dnsupdate.__file__)
+        )
+        self.assertLess(time.monotonic() - start, 10)
+
+    def test_async_get_cancelled(self):
+        provider = _SlowProvider(10)
+        addresses = dnsupdate._AddressCache()
+
+        async def run():
+            owner = asyncio.ensure_future(addresses.async_get(provider, "ipv4"))
+            await asyncio.sleep(0.05)
+            waiter = asyncio.ensure_future(addresses.async_get(provider, "ipv4"))
+            await asyncio.sleep(0.05)
+            owner.cancel()
+            with self.assertRaises(dnsupdate.AddressProviderException):
+                await asyncio.wait_for(waiter, 1)
+
+        asyncio.run(run())
+
+    def test_address_lookups(self):
+        web, fast = dnsupdate.Web(), _CountingProvider()
+        services = [
+            (None, {"ipv4": web, "ipv6": web}),
+            (None, {"ipv4": fast, "ipv6": web}),
+            (None, {"ipv4": fast, "ipv6": None}),
+        ]
+        service_data_list = [dict(), {"ipv4": {"enabled": False}}, dict()]
+        self.assertEqual(
+            dnsupdate._address_lookups(services, service_data_list, False),
+            [(web, "ipv4"), (web, "ipv6"), (fast, "ipv4")],
+        )
+        self.assertEqual(
+            dnsupdate._address_lookups(services, [dict()] * 3, False),
+            dnsupdate._address_lookups(services, service_data_list, True),
+        )
+
+
+def _join_threads():
+    """
+    Wait for the threads left running by earlier tests, which would stop the
+    services from being updated by worker processes.
+    """
+    for thread in threading.enumerate():
+        if thread is not threading.current_thread() and not thread.daemon:
+            thread.join()
+
+
+class UpdateTest(unittest.TestCase):
+    def _update(self, jobs, engine="threads", processes=None):
+        provider = _CountingProvider()
+        services = [
+            _RecordingService(),
+            _RecordingService(dnsupdate.UpdateServiceException("down")),
+            _RecordingService(dnsupdate.UpdateClientException("bad password")),
+            _RecordingService(),
+        ] * 5
+        service_data_list = [dict() for _ in services]
+        stdout, stderr = io.StringIO(), io.StringIO()
+        with contextlib.redirect_stdout(stdout), contextlib.redirect_stderr(stderr):
+            update_args = (
+                [(s, {"ipv4": provider}) for s in services],
+                service_data_list,
+                dnsupdate._AddressCache(),
+                True,
+                False,
+                jobs,
+            )
+            if processes is not None:
+                update_args[2].resolve([(provider, "ipv4")])
+                exit_code = dnsupdate._update_services_sharded(
+                    *update_args, processes=processes, engine=engine
+                )
+            elif engine == "asyncio":
+                exit_code = asyncio.run(dnsupdate._async_update_services(*update_args))
+            else:
+                exit_code = dnsupdate._update_services(*update_args)
+        return exit_code, service_data_list, provider.lookups, stdout.getvalue(), stderr.getvalue()
+
+    def test_update_services_parallel_matches_serial(self):
+        serial = self._update(1)
+        parallel = self._update(8)
+        self.assertEqual(serial, parallel)
+
+    def test_update_services_asyncio_matches_serial(self):
+        serial = self._update(1)
+        self.assertEqual(serial, self._update(1, "asyncio"))
+        self.assertEqual(serial, self._update(8, "asyncio"))
+
+    def test_update_services_sharded_matches_serial(self):
+        serial = self._update(1)
+        _join_threads()
+        self.assertEqual(serial, self._update(1, processes=3))
+        self.assertEqual(serial, self._update(4, "asyncio", processes=3))
+
+    def test_update_services_sharded_threads_running(self):
+        serial = self._update(1)
+        stop = threading.Event()
+        thread = threading.Thread(target=stop.wait)
+        thread.start()
+        try:
+            *sharded, stderr = self._update(1, processes=3)
+        finally:
+            stop.set()
+            thread.join()
+        self.assertEqual(serial[:-1], tuple(sharded))
+        self.assertIn("not using worker processes while other threads are running", stderr)
+
+    def test_reinit_after_fork(self):
+        limit = dnsupdate._HostLimit("example.com", concurrency=1)
+        adapter = dnsupdate._http_session().get_adapter("http://localhost")
+        adapter.poolmanager.connection_from_url("http://localhost:1")
+        rate_limits = dnsupdate._rate_limits
+
+        def locks():
+            return [dnsupdate._metrics._lock, rate_limits._lock, limit._lock, limit._semaphore]
+
+        # Locks held by other threads of the parent must not be held in the child
+        held = locks()
+        for lock in held:
+            lock.acquire()
+        try:
+            pid = os.fork()
+            if pid == 0:
+                usable = all(lock.acquire(timeout=1) for lock in locks())
+                os._exit(0 if usable and not adapter.poolmanager.pools else 1)
+            _, status = os.waitpid(pid, 0)
+        finally:
+            for lock in held:
+                lock.release()
+        self.assertEqual(os.waitstatus_to_exitcode(status), 0)
+        self.assertTrue(adapter.poolmanager.pools)
+
+    def test_async_method_blocking_override(self):
+        # OVHDynDNS overrides update_ipv6() but inherits async_update_ipv6()
+        service = dnsupdate.OVHDynDNS("username", "password", "example.com")
+        method = dnsupdate._async_method(service, "update_ipv6")
+        self.assertNotEqual(method, service.async_update_ipv6)
+        with self.assertRaises(NotImplementedError):
+            asyncio.run(method(IPv4Address("192.0.2.1")))
+
+    def test_async_method_native(self):
+        service = dnsupdate.NSUpdate("example.com", "secret")
+        self.assertEqual(dnsupdate._async_method(service, "update_ipv4"), service.async_update_ipv4)
+
+    def test_update_services_results(self):
+        exit_code, service_data_list, lookups, stdout, _ = self._update(4)
+        self.assertEqual(exit_code, dnsupdate.ExitCode.CLIENT_ERROR)
+        self.assertEqual(lookups, 1)
+        self.assertEqual(service_data_list[0]["ipv4"], {"address": "192.0.2.1", "enabled": True})
+        self.assertEqual(service_data_list[1]["ipv4"], dict())
+        self.assertEqual(service_data_list[2]["ipv4"], {"enabled": False})
+        self.assertEqual(stdout.count("Updating IPv4 address of service"), 20)
+
+
+class _DynHandler(http.server.BaseHTTPRequestHandler):
+    def do_GET(self):
+        query = parse_qs(urlsplit(self.path).query)
+        hostnames = query["hostname"][0].split(",")
+        _, password = base64.b64decode(self.headers["Authorization"].split()[1]).split(b":")
+        with self.server.lock:
+            self.server.hostnames.append(hostnames)
+        if password == b"wrong":
+            body = "badauth"
+        else:
+            # No line is returned for truncated hostnames
+            body = "\n".join(
+                "nohost" if hostname.startswith("missing") else "good " + query["myip"][0]
+                for hostname in hostnames
+                if not hostname.startswith("truncated")
+            )
+        body = body.encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class BatchTest(unittest.TestCase):
+    def setUp(self):
+        self.server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), _DynHandler)
+        self.server.lock = threading.Lock()
+        self.server.hostnames = list()
+        threading.Thread(target=self.server.serve_forever, args=(0.05,), daemon=True).start()
+
+        origin = "127.0.0.1:%d" % self.server.server_port
+
+        class RedirectAdapter(dnsupdate._HTTPAdapter):
+            def send(self, request, **kwargs):
+                url = urlsplit(request.url)
+                request.url = urlunsplit(("http", origin, url.path, url.query, ""))
+                return super().send(request, **kwargs)
+
+        self.adapter = dnsupdate.session.get_adapter("https://")
+        dnsupdate.session.mount("https://", RedirectAdapter())
+
+    def tearDown(self):
+        dnsupdate.session.mount("https://", self.adapter)
+        _stop_server(self.server)
+
+    def _update(self, services, service_data_list, jobs=1, engine="threads"):
+        provider = _CountingProvider()
+        services = [(s, {"ipv4": provider}) for s in services]
+        addresses = dnsupdate._AddressCache()
+        # Batches are planned from the addresses that have been looked up
+        addresses.resolve(dnsupdate._address_lookups(services, service_data_list, False))
+        update_args = (services, service_data_list, addresses, False, False, jobs)
+        with contextlib.redirect_stdout(io.StringIO()), contextlib.redirect_stderr(io.StringIO()):
+            if engine == "asyncio":
+                return asyncio.run(dnsupdate._async_update_services(*update_args))
+            return dnsupdate._update_services(*update_args)
+
+    def test_batch_key(self):
+        service = dnsupdate.StandardService("dyn.example", None, "user", "pass", "a.example")
+        self.assertEqual(service.batch_key("ipv4"), ("dyn.example", "user", "pass", ()))
+        self.assertIsNone(service.batch_key("ipv6"))
+        # GoogleDomains only overrides the IPv6 update
+        service = dnsupdate.GoogleDomains("user", "pass", "a.example")
+        self.assertIsNotNone(service.batch_key("ipv4"))
+        self.assertIsNone(service.batch_key("ipv6"))
+
+    def test_update(self):
+        for jobs, engine in ((1, "threads"), (4, "threads"), (4, "asyncio")):
+            with self.subTest(jobs=jobs, engine=engine):
+                self.server.hostnames.clear()
+                services = [
+                    dnsupdate.StandardService("dyn.example", None, "user", "pass", "a.example"),
+                    dnsupdate.StandardService("dyn.example", None, "user", "wrong", "b.example"),
+                    dnsupdate.StandardService("dyn.example", None, "user", "pass", "missing.c"),
+                    dnsupdate.StandardService("dyn.example", None, "user", "wrong", "d.example"),
+                    dnsupdate.StandardService("dyn.example", None, "user", "pass", "e.example"),
+                    dnsupdate.StandardService("dyn.example", None, "user", "pass", "f.example"),
+                ]
+                service_data_list = [dict() for _ in services]
+                # Already up to date
+                service_data_list[5]["ipv4"] = {"address": "192.0.2.1", "enabled": True}
+
+                exit_code = self._update(services, service_data_list, jobs, engine)
+                self.assertEqual(exit_code, dnsupdate.ExitCode.CLIENT_ERROR)
+                self.assertEqual(
+                    sorted(self.server.hostnames),
+                    [["a.example", "missing.c", "e.example"], ["b.example", "d.example"]],
+                )
+                self.assertEqual(
+                    [data["ipv4"] for data in service_data_list],
+                    [
+                        {"address": "192.0.2.1", "enabled": True},
+                        {"enabled": False},
+                        {"enabled": False},
+                        {"enabled": False},
+                        {"address": "192.0.2.1", "enabled": True},
+                        {"address": "192.0.2.1", "enabled": True},
+                    ],
+                )
+
+    def test_line_count_mismatch(self):
+        services = [
+            dnsupdate.StandardService("dyn.example", None, "user", "pass", "a.example"),
+            dnsupdate.StandardService("dyn.example", None, "user", "pass", "missing.b"),
+            dnsupdate.StandardService("dyn.example", None, "user", "pass", "truncated.c"),
+        ]
+        service_data_list = [dict() for _ in services]
+        # "good 192.0.2.1\nnohost" can't be matched up with the hostnames
+        exit_code = self._update(services, service_data_list)
+        self.assertEqual(exit_code, dnsupdate.ExitCode.SERVICE_ERROR)
+        self.assertEqual(self.server.hostnames, [["a.example", "missing.b", "truncated.c"]])
+        self.assertEqual([data["ipv4"] for data in service_data_list], [{"enabled": True}] * 3)
+
+    def test_max_batch_size(self):
+        services = [
+            dnsupdate.StandardService("dyn.example", None, "user", "pass", "%d.example" % i)
+            for i in range(45)
+        ]
+        service_data_list = [dict() for _ in services]
+        self.assertEqual(self._update(services, service_data_list), dnsupdate.ExitCode.SUCCESS)
+        self.assertEqual([len(hostnames) for hostnames in self.server.hostnames], [20, 20, 5])
+
+
+class _AddressHandler(http.server.BaseHTTPRequestHandler):
+    def do_GET(self):
+        body = ("%s\n" % self.client_address[0]).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class _IPv6HTTPServer(http.server.ThreadingHTTPServer):
+    address_family = socket.AF_INET6
+
+
+def _start_server(server_class=http.server.ThreadingHTTPServer, address=("127.0.0.1", 0)):
+    server = server_class(address, _AddressHandler)
+    threading.Thread(target=server.serve_forever, args=(0.05,), daemon=True).start()
+    return server
+
+
+def _stop_server(server):
+    server.shutdown()
+    server.server_close()
+
+
+class WebTest(unittest.TestCase):
+    def setUp(self):
+        self.server = _start_server()
+        self.url = "http://127.0.0.1:%d/" % self.server.server_port
+        self.provider = dnsupdate.Web(self.url, self.url)
+
+    def tearDown(self):
+        _stop_server(self.server)
+
+    def test_ipv4(self):
+        self.assertEqual(self.provider.ipv4(), IPv4Address("127.0.0.1"))
+
+    def test_ipv6_wrong_family(self):
+        with self.assertRaises(requests.ConnectionError):
+            self.provider.ipv6()
+
+    def test_concurrent_families(self):
+        server6 = _start_server(_IPv6HTTPServer, ("::1", 0))
+        try:
+            url6 = "http://[::1]:%d/" % server6.server_port
+            provider = dnsupdate.Web(self.url, url6)
+            with ThreadPoolExecutor(max_workers=8) as executor:
+                results = list(
+                    executor.map(lambda proto: getattr(provider, proto)(), ["ipv4", "ipv6"] * 20)
+                )
+            self.assertEqual(results, [IPv4Address("127.0.0.1"), IPv6Address("::1")] * 20)
+        finally:
+            _stop_server(server6)
+
+    def test_async_ipv4_executor(self):
+        self.assertEqual(asyncio.run(self.provider.async_ipv4()), IPv4Address("127.0.0.1"))
+
+    def test_async_ipv4_aiohttp(self):
+        if importlib.util.find_spec("aiohttp") is None:
+            self.skipTest("aiohttp is not installed")
+
+        async def lookup():
+            async with dnsupdate._async_http_context(1):
+                self.assertIsNotNone(dnsupdate._async_http.get())
+                return await self.provider.async_ipv4()
+
+        self.assertEqual(asyncio.run(lookup()), IPv4Address("127.0.0.1"))
+
+
+_TSIG_KEY = ("update-key", base64.b64encode(b"secret").decode())
+
+
+def _read_dns_name(data, offset):
+    labels = list()
+    while data[offset]:
+        labels.append(data[offset + 1 : offset + 1 + data[offset]].decode())
+        offset += data[offset] + 1
+    return ".".join(labels), offset + 1
+
+
+class _DNSStub:
+    """Minimal authoritative server that applies UPDATE messages to a dict of records."""
+
+    def __init__(self):
+        self.records = dict()
+        self.transports = list()
+        self.rcode = 0
+        self.tsig_error = 0
+        self.sign = True
+        self.udp = socketserver.ThreadingUDPServer(("127.0.0.1", 0), self._udp_handler())
+        self.port = self.udp.server_address[1]
+        self.tcp = socketserver.ThreadingTCPServer(("127.0.0.1", self.port), self._tcp_handler())
+        for server in (self.udp, self.tcp):
+            threading.Thread(target=server.serve_forever, args=(0.05,), daemon=True).start()
+
+    def close(self):
+        for server in (self.udp, self.tcp):
+            server.shutdown()
+            server.server_close()
+
+    def _udp_handler(self):
+        stub = self
+
+        class Handler(socketserver.BaseRequestHandler):
+            def handle(self):
+                data, sock = self.request
+                stub.transports.append("udp")
+                sock.sendto(stub.respond(data), self.client_address)
+
+        return Handler
+
+    def _tcp_handler(self):
+        stub = self
+
+        class Handler(socketserver.StreamRequestHandler):
+            def handle(self):
+                (size,) = struct.unpack("!H", self.rfile.read(2))
+                stub.transports.append("tcp")
+                response = stub.respond(self.rfile.read(size))
+                self.wfile.write(struct.pack("!H", len(response)) + response)
+
+        return Handler
+
+    def respond(self, data):
+        message_id, flags, zone_count, _, update_count, additional = struct.unpack_from(
+            "!HHHHHH", data
+        )
+        _, offset = _read_dns_name(data, 12)
+        zone_end = offset + 4
+        updates = list()
+        offset = zone_end
+        for _ in range(update_count):
+            name, offset = _read_dns_name(data, offset)
+            record_type, record_class, ttl, size = struct.unpack_from("!HHIH", data, offset)
+            offset += 10
+            updates.append((name, record_type, record_class, data[offset : offset + size]))
+            offset += size
+
+        # Check the TSIG record
+        tsig_start = offset
+        _, offset = _read_dns_name(data, offset)
+        tsig_name = data[tsig_start:offset]
+        offset += 10
+        algorithm_start = offset
+        _, offset = _read_dns_name(data, offset)
+        algorithm = data[algorithm_start:offset]
+        time_fudge = data[offset : offset + 8]
+        (mac_size,) = struct.unpack_from("!H", data, offset + 8)
+        request_mac = data[offset + 10 : offset + 10 + mac_size]
+        unsigned = data[:10] + struct.pack("!H", additional - 1) + data[12:tsig_start]
+        variables = tsig_name + struct.pack("!HI", 255, 0) + algorithm + time_fudge + b"\0" * 4
+        assert hmac.compare_digest(
+            request_mac, hmac.new(b"secret", unsigned + variables, "sha256").digest()
+        )
+
+        rcode = 9 if self.tsig_error else self.rcode
+        if rcode == 0:
+            for name, record_type, record_class, rdata in updates:
+                if record_class == 255:
+                    self.records.pop((name, record_type), None)
+                else:
+                    self.records[(name, record_type)] = rdata
+
+        response = struct.pack("!HHHHHH", message_id, 0x8000 | (flags & 0x7800) | rcode, 1, 0, 0, 0)
+        response += data[12:zone_end]
+        if not self.sign:
+            return response
+        time_fudge = struct.pack("!HIH", 0, int(time.time()), 300)
+        if self.tsig_error:
+            mac = b""
+        else:
+            variables = tsig_name + struct.pack("!HI", 255, 0) + algorithm + time_fudge
+            variables += struct.pack("!HH", 0, 0)
+            signed = struct.pack("!H", len(request_mac)) + request_mac + response + variables
+            mac = hmac.new(b"secret", signed, "sha256").digest()
+        rdata = algorithm + time_fudge + struct.pack("!H", len(mac)) + mac
+        rdata += struct.pack("!HHH", message_id, self.tsig_error, 0)
+        tsig = tsig_name + struct.pack("!HHIH", 250, 255, 0, len(rdata)) + rdata
+        return response[:10] + struct.pack("!H", 1) + response[12:] + tsig
+
+
+class RFC2136Test(unittest.TestCase):
+    def setUp(self):
+        self.stub = _DNSStub()
+
+    def tearDown(self):
+        self.stub.close()
+
+    def _service(self, hostname="host.example.com", key=_TSIG_KEY):
+        return dnsupdate.RFC2136("127.0.0.1", "example.com", hostname, *key, port=self.stub.port)
+
+    def test_update(self):
+        self.assertTrue(self._service().update_ipv4(IPv4Address("192.0.2.1")))
+        self.assertTrue(self._service().update_ipv6(IPv6Address("2001:db8::1")))
+        self.assertEqual(
+            self.stub.records,
+            {
+                ("host.example.com", 1): IPv4Address("192.0.2.1").packed,
+                ("host.example.com", 28): IPv6Address("2001:db8::1").packed,
+            },
+        )
+        self.assertEqual(self.stub.transports, ["udp", "udp"])
+
+    def test_batch(self):
+        services = [self._service("host%d.example.com" % i) for i in range(30)]
+        self.assertEqual(len({s.batch_key("ipv4") for s in services}), 1)
+        results = services[0].update_batch("ipv4", IPv4Address("192.0.2.1"), services)
+        self.assertEqual(results, [True] * 30)
+        self.assertEqual(len(self.stub.records), 30)
+        # Too large for UDP
+        self.assertEqual(self.stub.transports, ["tcp"])
+
+    def test_large_zone(self):
+        # Names close to the maximum length
+        label = "x" * 63
+        services = [
+            self._service("%s.%s.%s.%d.example.com" % (label, label, label, i)) for i in range(250)
+        ]
+        provider = _CountingProvider()
+        services = [(s, {"ipv4": provider}) for s in services]
+        service_data_list = [dict() for _ in services]
+        addresses = dnsupdate._AddressCache()
+        addresses.resolve(dnsupdate._address_lookups(services, service_data_list, False))
+        with contextlib.redirect_stdout(io.StringIO()):
+            exit_code = dnsupdate._update_services(
+                services, service_data_list, addresses, False, False, 1
+            )
+        self.assertEqual(exit_code, dnsupdate.ExitCode.SUCCESS)
+        self.assertEqual(len(self.stub.records), 250)
+        self.assertEqual(self.stub.transports, ["tcp"] * 3)
+
+    def test_errors(self):
+        address = IPv4Address("192.0.2.1")
+        self.stub.rcode = 10
+        self.assertRaises(dnsupdate.UpdateClientException, self._service().update_ipv4, address)
+        self.stub.rcode = 2
+        self.assertRaises(dnsupdate.UpdateServiceException, self._service().update_ipv4, address)
+        self.stub.rcode = 0
+        self.stub.tsig_error = 16
+        with self.assertRaisesRegex(dnsupdate.UpdateClientException, "BADSIG"):
+            self._service().update_ipv4(address)
+        self.stub.tsig_error = 0
+        self.stub.sign = False
+        with self.assertRaisesRegex(dnsupdate.UpdateServiceException, "not signed"):
+            self._service().update_ipv4(address)
+
+    def test_invalid_key(self):
+        self.assertRaises(ValueError, self._service, key=("update-key", None))
+        self.assertRaises(ValueError, self._service, key=("update-key", "not base64!"))
+
+
+class _ResolverHandler(socketserver.BaseRequestHandler):
+    """Answers A, AAAA and TXT queries with the address of the client."""
+
+    def handle(self):
+        data, sock = self.request
+        message_id = struct.unpack_from("!H", data)[0]
+        name, offset = _read_dns_name(data, 12)
+        record_type = struct.unpack_from("!H", data, offset)[0]
+        client = ipaddress.ip_address(self.client_address[0])
+        if name != "myip.example":
+            answers = list()
+            rcode = 3
+        elif record_type == 16:
+            text = str(client).encode()
+            answers = [b"\x05other" + bytes((len(text),)) + text]
+            rcode = 0
+        else:
+            answers = [client.packed]
+            rcode = 0
+        response = struct.pack("!HHHHHH", message_id, 0x8180 | rcode, 1, len(answers), 0, 0)
+        response += data[12 : offset + 4]
+        for answer in answers:
+            # Name compressed as a pointer to the question
+            response += struct.pack("!HHHIH", 0xC00C, record_type, 1, 0, len(answer)) + answer
+        sock.sendto(response, self.client_address)
+
+
+class _UDPServer6(socketserver.ThreadingUDPServer):
+    address_family = socket.AF_INET6
+
+
+class DNSQueryTest(unittest.TestCase):
+    def setUp(self):
+        self.server = socketserver.ThreadingUDPServer(("127.0.0.1", 0), _ResolverHandler)
+        self.server6 = _UDPServer6(("::1", self.server.server_address[1]), _ResolverHandler)
+        for server in (self.server, self.server6):
+            threading.Thread(target=server.serve_forever, args=(0.05,), daemon=True).start()
+        self.port = self.server.server_address[1]
+
+    def tearDown(self):
+        for server in (self.server, self.server6):
+            server.shutdown()
+            server.server_close()
+
+    def _provider(self, **kwargs):
+        return dnsupdate.DNSQuery(
+            "127.0.0.1", "::1", "myip.example", port=self.port, timeout=0.2, **kwargs
+        )
+
+    def test_address(self):
+        self.assertEqual(self._provider().ipv4(), IPv4Address("127.0.0.1"))
+        self.assertEqual(self._provider().ipv6(), IPv6Address("::1"))
+
+    def test_txt(self):
+        provider = self._provider(record_type="TXT")
+        self.assertEqual(provider.ipv4(), IPv4Address("127.0.0.1"))
+        self.assertEqual(provider.ipv6(), IPv6Address("::1"))
+
+    def test_retry(self):
+        # A resolver that never answers
+        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as silent:
+            silent.bind(("127.0.0.2", self.port))
+            provider = self._provider(retries=1)
+            provider.ipv4_resolver = ["127.0.0.2", "127.0.0.1"]
+            self.assertEqual(provider.ipv4(), IPv4Address("127.0.0.1"))
+            provider.ipv4_resolver = "127.0.0.2"
+            with self.assertRaisesRegex(dnsupdate.AddressProviderException, "No response"):
+                provider.ipv4()
+
+    def test_error(self):
+        provider = self._provider()
+        provider.name = "other.example"
+        self.assertRaises(dnsupdate.AddressProviderException, provider.ipv4)
+        self.assertRaises(ValueError, self._provider, record_type="MX")
+
+
+class _RecordsHandler(socketserver.BaseRequestHandler):
+    """Answers A and AAAA queries from the records of the server."""
+
+    def handle(self):
+        data, sock = self.request
+        name, offset = _read_dns_name(data, 12)
+        record_type = struct.unpack_from("!H", data, offset)[0]
+        answers = [
+            ipaddress.ip_address(address).packed
+            for address in self.server.records.get(name, [])
+            if ipaddress.ip_address(address).version == (4 if record_type == 1 else 6)
+        ]
+        rcode = 0 if name in self.server.records else 3
+        response = data[:2] + struct.pack("!HHHHH", 0x8180 | rcode, 1, len(answers), 0, 0)
+        response += data[12 : offset + 4]
+        for answer in answers:
+            response += struct.pack("!HHHIH", 0xC00C, record_type, 1, 0, len(answer)) + answer
+        sock.sendto(response, self.client_address)
+
+
+class _HostnameService(_RecordingService):
+    def __init__(self, hostname):
+        super().__init__()
+        self.hostname = hostname
+
+    def hostnames(self):
+        return [self.hostname]
+
+
+class VerifyTest(unittest.TestCase):
+    def setUp(self):
+        self.server = socketserver.ThreadingUDPServer(("127.0.0.1", 0), _RecordsHandler)
+        self.server.records = {
+            "current.example": ["192.0.2.1"],
+            "old.example": ["192.0.2.9"],
+            "multiple.example": ["192.0.2.1", "192.0.2.2"],
+            "ipv6.example": ["2001:db8::1"],
+        }
+        threading.Thread(target=self.server.serve_forever, args=(0.05,), daemon=True).start()
+        self.port = self.server.server_address[1]
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_query_many(self):
+        questions = [("current.example", 1), ("ipv6.example", 28), ("missing.example", 1)]
+        results = dnsupdate._dns_query_many("127.0.0.1", self.port, questions, 1, window=2)
+        self.assertEqual(
+            results,
+            {
+                ("current.example", 1): (0, [IPv4Address("192.0.2.1").packed]),
+                ("ipv6.example", 28): (0, [IPv6Address("2001:db8::1").packed]),
+                ("missing.example", 1): (3, []),
+            },
+        )
+
+    def test_query_many_timeout(self):
+        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as silent:
+            silent.bind(("127.0.0.1", 0))
+            port = silent.getsockname()[1]
+            start = time.monotonic()
+            self.assertEqual(
+                dnsupdate._dns_query_many("127.0.0.1", port, [("a.example", 1)], 0.2), dict()
+            )
+            self.assertLess(time.monotonic() - start, 1)
+
+    def test_verify(self):
+        provider = _CountingProvider()
+        services = [
+            _HostnameService("current.example"),
+            _HostnameService("old.example"),
+            _HostnameService("multiple.example"),
+            _RecordingService(),
+        ]
+        services = [(s, {"ipv4": provider}) for s in services]
+        service_data_list = [dict() for _ in services]
+        addresses = dnsupdate._AddressCache()
+        addresses.resolve(dnsupdate._address_lookups(services, service_data_list, False))
+        verified = dnsupdate._verify_updates(
+            services, service_data_list, addresses, False, "127.0.0.1", self.port, 1
+        )
+        self.assertEqual(verified, {(0, "ipv4", "192.0.2.1")})
+
+        with contextlib.redirect_stdout(io.StringIO()) as stdout:
+            exit_code = dnsupdate._update_services(
+                services, service_data_list, addresses, False, False, 1, verified
+            )
+        self.assertEqual(exit_code, dnsupdate.ExitCode.SUCCESS)
+        self.assertIn("DNS already holds the address", stdout.getvalue())
+        self.assertEqual([len(s.addresses) for s, _ in services], [0, 1, 1, 1])
+        # The skipped address is not stored, so it is verified again next run
+        self.assertEqual(service_data_list[0]["ipv4"], {"enabled": True})
+        for service_data in service_data_list[1:]:
+            self.assertEqual(service_data["ipv4"], {"address": "192.0.2.1", "enabled": True})
+        self.assertEqual(
+            dnsupdate._verify_updates(
+                services, service_data_list, addresses, False, "127.0.0.1", self.port, 1
+            ),
+            verified,
+        )
+
+
+class LocalTest(unittest.TestCase):
+    def test_parse_rtnetlink_addr_events(self):
+        def message(msg_type, flags, index, attributes=b""):
+            body = struct.pack("=BBBBI", socket.AF_INET6, 64, flags, 0, index) + attributes
+            return struct.pack("=IHHII", 16 + len(body), msg_type, 0, 0, 0) + body
+
+        data = b"".join(
+            [
+                message(dnsupdate._RTM_NEWADDR, dnsupdate._IFA_F_TENTATIVE, 3, b"\1\2"),
+                # Padding
+                b"\0\0",
+                message(dnsupdate._RTM_DELADDR, 0, 4),
+                # RTM_NEWLINK
+                message(16, 0, 5),
+            ]
+        )
+        self.assertEqual(
+            list(dnsupdate._parse_rtnetlink_addr_events(data)),
+            [
+                (dnsupdate._RTM_NEWADDR, socket.AF_INET6, dnsupdate._IFA_F_TENTATIVE, 3),
+                (dnsupdate._RTM_DELADDR, socket.AF_INET6, 0, 4),
+            ],
+        )
+
+    def test_changed_without_watch(self):
+        try:
+            provider = dnsupdate.Local("lo")
+        except ImportError:
+            self.skipTest("netifaces is not installed")
+        self.assertTrue(provider.changed())
+
+    @unittest.skipUnless(shutil.which("ip") and os.geteuid() == 0, "requires root and iproute2")
+    def test_watch(self):
+        try:
+            provider = dnsupdate.Local("lo", allow_private=True)
+            watch = provider.watch()
+        except ImportError:
+            self.skipTest("netifaces is not installed")
+        if watch is None:
+            self.skipTest("rtnetlink is not supported")
+
+        address = "192.0.2.77/32"
+        subprocess.run(["ip", "addr", "add", address, "dev", "lo"], check=True)
+        try:
+            self.assertTrue(select.select([watch], [], [], 5)[0])
+            self.assertTrue(provider.changed())
+            # All notifications have been consumed
+            self.assertFalse(provider.changed())
+            provider.ipv4()
+            self.assertIn("192.0.2.77", [a["addr"] for a in provider.addresses[socket.AF_INET]])
+        finally:
+            subprocess.run(["ip", "addr", "del", address, "dev", "lo"], check=True)
+
+
+class _EndpointHandler(http.server.BaseHTTPRequestHandler):
+    # Response body and delay for each path
+    endpoints = {
+        "/a": ("192.0.2.1", 0),
+        "/a2": ("192.0.2.1", 0),
+        "/b": ("192.0.2.2", 0),
+        "/slow": ("192.0.2.3", 1),
+        "/invalid": ("<html></html>", 0),
+    }
+
+    def do_GET(self):
+        body, delay = self.endpoints[self.path]
+        time.sleep(delay)
+        body = body.encode()
+        try:
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; charset=utf-8")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+        except ConnectionError:
+            # The client gave up waiting
+            pass
+
+    def log_message(self, *args):
+        pass
+
+
+def _sha256(text):
+    return hashlib.sha256(text.encode()).hexdigest()
+
+
+class MultiWebTest(unittest.TestCase):
+    def setUp(self):
+        self.server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), _EndpointHandler)
+        self.server.daemon_threads = True
+        threading.Thread(target=self.server.serve_forever, args=(0.05,), daemon=True).start()
+
+    def tearDown(self):
+        _stop_server(self.server)
+        dnsupdate.Web._latencies.clear()
+
+    def _urls(self, *paths):
+        return ["http://127.0.0.1:%d%s" % (self.server.server_port, path) for path in paths]
+
+    def _lookup(self, paths, mode="first", parallel=None, engine="threads"):
+        provider = dnsupdate.Web(self._urls(*paths), mode=mode, parallel=parallel)
+        if engine == "asyncio":
+
+            async def lookup():
+                # Measure time inside the event loop, since asyncio.run()
+                # waits for abandoned requests running in the executor
+                start = time.monotonic()
+                return await provider.async_ipv4(), time.monotonic() - start
+
+            return asyncio.run(lookup())
+        start = time.monotonic()
+        return provider.ipv4(), time.monotonic() - start
+
+    def test_first(self):
+        for engine in ("threads", "asyncio"):
+            address, duration = self._lookup(["/slow", "/invalid", "/b"], engine=engine)
+            self.assertEqual(address, IPv4Address("192.0.2.2"))
+            self.assertLess(duration, 0.9)
+
+    def test_first_abandons_requests(self):
+        before = set(threading.enumerate())
+        self._lookup(["/slow", "/b"])
+        # The slow request is still running, but does not keep the process
+        # from exiting
+        threads = set(threading.enumerate()) - before
+        self.assertTrue(threads)
+        self.assertTrue(all(thread.daemon for thread in threads))
+        # Don't let it record its latency during another test
+        for thread in threads:
+            thread.join()
+
+    def test_quorum(self):
+        for engine in ("threads", "asyncio"):
+            address, _ = self._lookup(["/a", "/b", "/invalid", "/a2"], "quorum:2", 1, engine)
+            self.assertEqual(address, IPv4Address("192.0.2.1"))
+
+    def test_no_quorum(self):
+        for engine in ("threads", "asyncio"):
+            with self.assertRaisesRegex(dnsupdate.AddressProviderException, "agreed"):
+                self._lookup(["/a", "/b", "/invalid"], "quorum:2", engine=engine)
+
+    def test_all_failed(self):
+        for engine in ("threads", "asyncio"):
+            with self.assertRaisesRegex(dnsupdate.AddressProviderException, "failed"):
+                self._lookup(["/invalid", "/invalid"], engine=engine)
+
+    def test_fastest_first(self):
+        fast, invalid = self._urls("/a", "/invalid")
+        # Only one request is in flight at once, so the invalid endpoint is
+        # tried first, and then moved to the end of the list
+        provider = dnsupdate.Web([invalid, fast], parallel=1)
+        self.assertEqual(provider.ipv4(), IPv4Address("192.0.2.1"))
+        latencies = dnsupdate.Web._export_latencies()
+        self.assertLess(latencies[_sha256(fast)], latencies[_sha256(invalid)])
+
+    def test_persisted_latencies(self):
+        fast, invalid = self._urls("/a", "/invalid")
+        store_file = os.path.join(tempfile.mkdtemp(), "addresses.cache")
+        store = dnsupdate._AddressStore(store_file)
+        store.put_latencies({_sha256(fast): 0.01, _sha256(invalid): 5})
+        store.save()
+        with open(store_file) as f:
+            self.assertNotIn(fast, f.read())
+        shutil.rmtree(os.path.dirname(store_file))
+
+        # Loaded by a later run, so the invalid endpoint is never queried
+        dnsupdate.Web._import_latencies(store.latencies())
+        provider = dnsupdate.Web([invalid, fast], parallel=1)
+        self.assertEqual(provider.ipv4(), IPv4Address("192.0.2.1"))
+        self.assertEqual(dnsupdate.Web._export_latencies()[_sha256(invalid)], 5)
+
+    def test_invalid_mode(self):
+        for mode in ("quorum:0", "last", 1):
+            self.assertRaises(dnsupdate.ConfigException, dnsupdate.Web, mode=mode)
+
+    def test_invalid_parallel(self):
+        for parallel in (0, -1, 1.5):
+            self.assertRaises(dnsupdate.ConfigException, dnsupdate.Web, parallel=parallel)
+
+
+class _SlowService(dnsupdate.DNSService):
+    def update_ipv4(self, address):
+        time.sleep(2)
+
+    async def async_update_ipv4(self, address):
+        await asyncio.sleep(2)
+
+
+class TimeoutTest(unittest.TestCase):
+    def tearDown(self):
+        dnsupdate._timeouts = dnsupdate._Timeouts()
+
+    def test_for_request(self):
+        timeouts = dnsupdate._Timeouts()
+        self.assertEqual(timeouts.for_request(), (10, 30))
+        self.assertEqual(timeouts.for_request(5), (5, 5))
+        timeouts.deadline = time.monotonic() + 20
+        connect, read = timeouts.for_request()
+        self.assertEqual(connect, 10)
+        self.assertLessEqual(read, 20)
+        timeouts.deadline = time.monotonic() - 1
+        self.assertRaises(dnsupdate._DeadlineExceeded, timeouts.for_request)
+
+    def test_session_timeout(self):
+        server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), _EndpointHandler)
+        server.daemon_threads = True
+        threading.Thread(target=server.serve_forever, args=(0.05,), daemon=True).start()
+        try:
+            dnsupdate._timeouts.read = 0.2
+            url = "http://127.0.0.1:%d/slow" % server.server_port
+            self.assertRaises(requests.Timeout, dnsupdate.session.get, url)
+            self.assertRaises(requests.Timeout, dnsupdate._request, "GET", url, socket.AF_INET)
+        finally:
+            _stop_server(server)
+
+    def _update(self, engine):
+        services = [_RecordingService(), _SlowService(), _RecordingService()]
+        service_data_list = [dict(), {"ipv4": {"address": "192.0.2.9"}}, dict()]
+        update_args = (
+            [(s, {"ipv4": _CountingProvider()}) for s in services],
+            service_data_list,
+            dnsupdate._AddressCache(),
+            False,
+            False,
+            2,
+        )
+        stderr = io.StringIO()
+        dnsupdate._timeouts.deadline = time.monotonic() + 0.5
+        start = time.monotonic()
+        with contextlib.redirect_stdout(io.StringIO()), contextlib.redirect_stderr(stderr):
+            if engine == "asyncio":
+                exit_code = asyncio.run(dnsupdate._async_update_services(*update_args))
+            else:
+                exit_code = dnsupdate._update_services(*update_args)
+        self.assertLess(time.monotonic() - start, 1.5)
+        self.assertEqual(exit_code, dnsupdate.ExitCode.SERVICE_ERROR)
+        self.assertIn("deadline exceeded while updating service 1", stderr.getvalue())
+        self.assertEqual(service_data_list[0]["ipv4"]["address"], "192.0.2.1")
+        self.assertEqual(service_data_list[1]["ipv4"]["address"], "192.0.2.9")
+        self.assertEqual(service_data_list[2]["ipv4"]["address"], "192.0.2.1")
+
+    def test_run_deadline(self):
+        self._update("threads")
+
+    def test_async_run_deadline(self):
+        self._update("asyncio")
+
+    def test_run_deadline_exit(self):
+        code = """if True:
+            import asyncio
+            import sys
+            import time
+            from ipaddress import IPv4Address
+            import dnsupdate
+
+            class Provider(dnsupdate.AddressProvider):
+                def ipv4(self):
+                    return IPv4Address("192.0.2.1")
+
+            class Service(dnsupdate.DNSService):
+                def update_ipv4(self, address):
+                    time.sleep(30)
+
+            services = [(Service(), {"ipv4": Provider()}) for _ in range(2)]
+            update_args = (services, [dict(), dict()], dnsupdate._AddressCache(), True, False, 2)
+            dnsupdate._timeouts.deadline = time.monotonic() + 0.2
+            if sys.argv[1] == "asyncio":
+                asyncio.run(dnsupdate._async_update_services(*update_args))
+            else:
+                dnsupdate._update_services(*update_args)
+        """
+        for engine in ("threads", "asyncio"):
+            with self.subTest(engine=engine):
+                start = time.monotonic()
+                subprocess.run(
+                    [sys.executable, "-c", code, engine],
+                    check=True,
+                    stdout=subprocess.DEVNULL,
+                    stderr=subprocess.DEVNULL,
+                    cwd=os.path.dirname(dnsupdate.__file__),
+                )
+                # Services abandoned at the deadline must not keep the process
+                # from exiting
+                self.assertLess(time.monotonic() - start, 10)
+
+
+class RateLimitTest(unittest.TestCase):
+    def tearDown(self):
+        dnsupdate._rate_limits.configure()
+        dnsupdate._timeouts = dnsupdate._Timeouts()
+
+    def test_reserve(self):
+        limit = dnsupdate._HostLimit("example.com", rate=10, burst=3)
+        delays = [limit._reserve() for _ in range(5)]
+        self.assertEqual(delays[:3], [0, 0, 0])
+        self.assertAlmostEqual(delays[3], 0.1, delta=0.02)
+        self.assertAlmostEqual(delays[4], 0.2, delta=0.02)
+
+    def test_reserve_deadline(self):
+        limit = dnsupdate._HostLimit("example.com", rate=1)
+        dnsupdate._timeouts.deadline = time.monotonic() + 0.5
+        limit._reserve()
+        self.assertRaises(dnsupdate._DeadlineExceeded, limit._reserve)
+
+    def _concurrency(self, engine):
+        limit = dnsupdate._HostLimit("example.com", concurrency=2)
+        active = list()
+        peak = list()
+
+        async def async_request():
+            async with limit.async_acquire():
+                active.append(None)
+                peak.append(len(active))
+                await asyncio.sleep(0.05)
+                active.pop()
+
+        def request():
+            with limit.acquire():
+                active.append(None)
+                peak.append(len(active))
+                time.sleep(0.05)
+                active.pop()
+
+        if engine == "asyncio":
+
+            async def run():
+                await asyncio.gather(*(async_request() for _ in range(6)))
+
+            asyncio.run(run())
+        else:
+            with ThreadPoolExecutor(6) as executor:
+                list(executor.map(lambda _: request(), range(6)))
+        self.assertEqual(max(peak), 2)
+        self.assertEqual(len(peak), 6)
+
+    def test_concurrency(self):
+        self._concurrency("threads")
+
+    def test_async_concurrency(self):
+        self._concurrency("asyncio")
+
+    def test_configure(self):
+        self.assertIsNone(dnsupdate._rate_limits.get("example.com"))
+        dnsupdate._rate_limits.configure(
+            {"rate": 5, "burst": 1, "concurrency": None},
+            {"Slow.example.com": {"rate": 1, "burst": 1, "concurrency": 1}, "fast": None},
+        )
+        self.assertEqual(dnsupdate._rate_limits.get("example.com").rate, 5)
+        self.assertIs(
+            dnsupdate._rate_limits.get("example.com"), dnsupdate._rate_limits.get("EXAMPLE.com")
+        )
+        self.assertEqual(dnsupdate._rate_limits.get("slow.example.com").concurrency, 1)
+        self.assertIsNone(dnsupdate._rate_limits.get("fast"))
+
+    def test_share(self):
+        limits = dnsupdate._RateLimits()
+        limits.configure(
+            {"rate": 6, "burst": 2, "concurrency": None},
+            {"slow": {"rate": None, "burst": 1, "concurrency": 4}, "fast": None},
+        )
+        self.assertEqual(limits.max_shards(), 4)
+        shares = [limits.share(shard, 3) for shard in range(3)]
+        self.assertEqual([share.get("example.com").rate for share in shares], [2, 2, 2])
+        self.assertEqual([share.get("example.com").burst for share in shares], [0, 1, 1])
+        self.assertEqual([share.get("slow").concurrency for share in shares], [1, 1, 2])
+        self.assertIsNone(shares[0].get("fast"))
+        self.assertIsNone(dnsupdate._RateLimits().max_shards())
+
+    def test_sharded_rate_limits(self):
+        dnsupdate._rate_limits.configure({"rate": 6, "burst": 4, "concurrency": 2})
+        service_data_list = [None] * 4
+        _join_threads()
+
+        def update(indices):
+            limit = dnsupdate._rate_limits.get("example.com")
+            for i in indices:
+                service_data_list[i] = (limit.rate, limit.burst, limit.concurrency)
+            return dnsupdate.ExitCode.SUCCESS, service_data_list
+
+        # Only two processes can share the concurrency limit
+        self.assertEqual(dnsupdate._run_shards(update, 4, service_data_list, 3), 0)
+        self.assertEqual(service_data_list, [(3, 2, 1)] * 4)
+        self.assertEqual(dnsupdate._rate_limits.get("example.com").rate, 6)
+
+    def test_parse_rate_limit(self):
+        default = {"rate": 2, "burst": 4, "hosts": dict()}
+        self.assertEqual(
+            dnsupdate._parse_rate_limit({"concurrency": 3}, default),
+            {"rate": 2, "burst": 4, "concurrency": 3},
+        )
+        self.assertIsNone(dnsupdate._parse_rate_limit(dict()))
+        self.assertIsNone(dnsupdate._parse_rate_limit({"rate": None}, default))
+        for limit in ({"burst": 0}, {"rate": -1}, {"concurrency": 1.5}, [1]):
+            with self.subTest(limit=limit):
+                self.assertRaises(dnsupdate.ConfigException, dnsupdate._parse_rate_limit, limit)
+
+    def test_session_rate_limit(self):
+        server = _start_server()
+        try:
+            url = "http://127.0.0.1:%d/" % server.server_port
+            dnsupdate._rate_limits.configure(hosts={"127.0.0.1": {"rate": 20}})
+
+            async def async_requests():
+                async with dnsupdate._async_http_context(4):
+                    for _ in range(3):
+                        await dnsupdate.async_request("GET", url)
+
+            for engine in ("threads", "asyncio"):
+                with self.subTest(engine=engine):
+                    time.sleep(0.1)
+                    start = time.monotonic()
+                    if engine == "asyncio":
+                        asyncio.run(async_requests())
+                    else:
+                        for _ in range(3):
+                            dnsupdate.session.get(url)
+                    # The first request is not delayed
+                    self.assertGreaterEqual(time.monotonic() - start, 0.09)
+        finally:
+            _stop_server(server)
+
+
+class MetricsTest(unittest.TestCase):
+    def setUp(self):
+        dnsupdate._metrics.clear()
+
+    def tearDown(self):
+        dnsupdate._metrics.clear()
+
+    def test_render(self):
+        metrics = dnsupdate._Metrics()
+        metrics.inc("dnsupdate_updates_total", name='Service ["a"]', outcome="good")
+        metrics.inc("dnsupdate_updates_total", name='Service ["a"]', outcome="good")
+        metrics.observe("dnsupdate_lookup_duration_seconds", 0.3, provider="Web")
+        metrics.set("dnsupdate_last_run_exit_code", dnsupdate.ExitCode.SERVICE_ERROR)
+        lines = metrics.render().splitlines()
+        self.assertIn("# TYPE dnsupdate_updates_total counter", lines)
+        self.assertIn('dnsupdate_updates_total{name="Service [\\"a\\"]",outcome="good"} 2', lines)
+        self.assertIn('dnsupdate_lookup_duration_seconds_bucket{provider="Web",le="0.25"} 0', lines)
+        self.assertIn('dnsupdate_lookup_duration_seconds_bucket{provider="Web",le="0.5"} 1', lines)
+        self.assertIn('dnsupdate_lookup_duration_seconds_bucket{provider="Web",le="+Inf"} 1', lines)
+        self.assertIn('dnsupdate_lookup_duration_seconds_sum{provider="Web"} 0.3', lines)
+        self.assertIn('dnsupdate_lookup_duration_seconds_count{provider="Web"} 1', lines)
+        self.assertIn("dnsupdate_last_run_exit_code 1", lines)
+        self.assertNotIn("# TYPE dnsupdate_address_cache_misses_total counter", lines)
+
+    def test_update_outcomes(self):
+        provider = _CountingProvider()
+        services = [
+            _RecordingService(),
+            _RecordingService(dnsupdate.UpdateServiceException("down")),
+            _RecordingService(dnsupdate.UpdateClientException("bad password")),
+            _RecordingService(result=False),
+        ]
+        service_data_list = [
+            {"ipv4": {"address": "192.0.2.1", "enabled": True}},
+            dict(),
+            {"ipv4": {"enabled": False}},
+            dict(),
+        ]
+        with contextlib.redirect_stdout(io.StringIO()), contextlib.redirect_stderr(io.StringIO()):
+            dnsupdate._update_services(
+                [(s, {"ipv4": provider}) for s in services],
+                service_data_list,
+                dnsupdate._AddressCache(),
+                False,
+                False,
+                1,
+            )
+        text = dnsupdate._metrics.render()
+        self.assertIn('service="0",name="_RecordingService",proto="ipv4",outcome="nochg"} 1', text)
+        self.assertIn(
+            'service="1",name="_RecordingService",proto="ipv4",outcome="service_error"', text
+        )
+        self.assertIn('service="2",name="_RecordingService",proto="ipv4",outcome="disabled"', text)
+        # The server reported that it already had the address
+        self.assertIn('service="3",name="_RecordingService",proto="ipv4",outcome="nochg"} 1', text)
+        self.assertIn('dnsupdate_update_duration_seconds_count{service="1"', text)
+        self.assertIn("dnsupdate_address_cache_misses_total 1", text)
+        self.assertIn('dnsupdate_address_cache_hits_total{cache="run"} 2', text)
+
+    def test_serve(self):
+        dnsupdate._metrics.inc("dnsupdate_address_cache_misses_total")
+        server = dnsupdate._serve_metrics("127.0.0.1", 0)
+        try:
+            r = requests.get("http://127.0.0.1:%d/metrics" % server.server_port)
+        finally:
+            server.shutdown()
+            server.server_close()
+        self.assertEqual(r.status_code, 200)
+        self.assertIn("dnsupdate_address_cache_misses_total 1", r.text)
+
+
+class ImportTest(unittest.TestCase):
+    def test_lazy_imports(self):
+        script = "import json, sys, dnsupdate; print(json.dumps(sorted(sys.modules)))"
+        output = subprocess.run(
+            [sys.executable, "-c", script],
+            check=True,
+            stdout=subprocess.PIPE,
+            cwd=os.path.dirname(dnsupdate.__file__),
+        ).stdout
+        modules = json.loads(output)
+        # These made up most of the import time when imported eagerly
+        for module in ("requests", "urllib3", "yaml", "asyncio", "aiohttp", "bs4", "netifaces"):
+            self.assertNotIn(module, modules)
+
+    def test_deferred_classes(self):
+        self.assertIn("!include", dnsupdate._ConfigLoader.yaml_constructors)
+        self.assertTrue(issubclass(dnsupdate._FamilyHTTPAdapter, dnsupdate._HTTPAdapter))
+        self.assertRaises(AttributeError, getattr, dnsupdate, "_missing")
+
+
+class RunnerTest(unittest.TestCase):
+    def setUp(self):
+        self.server = _start_server()
+        self.url = "http://127.0.0.1:%d/" % self.server.server_port
+        self.dir = tempfile.TemporaryDirectory()
+        self.config_file = os.path.join(self.dir.name, "dnsupdate.conf")
+        self.cache_file = os.path.join(self.dir.name, "dnsupdate.cache")
+        self._write_config()
+        dnsupdate._metrics.clear()
+
+    def tearDown(self):
+        _stop_server(self.server)
+        self.dir.cleanup()
+        dnsupdate._metrics.clear()
+
+    def _write_config(self, **options):
+        config = {
+            "cache_file": self.cache_file,
+            "interval": 0.2,
+            "address_provider": {"ipv4": {"type": "Web", "args": {"ipv4_url": self.url}}},
+            "dns_services": [{"type": "StaticURL", "args": {"ipv4_url": self.url}}],
+            **options,
+        }
+        with open(self.config_file, "w") as f:
+            yaml.dump(config, f)
+
+    def _runner(self, *args):
+        return dnsupdate._Runner(dnsupdate._get_arg_parser().parse_args([self.config_file, *args]))
+
+    def test_run(self):
+        runner = self._runner()
+        with contextlib.redirect_stdout(io.StringIO()):
+            self.assertEqual(runner.run(), dnsupdate.ExitCode.SUCCESS)
+        cache = dnsupdate._load_cache(self.cache_file)
+        self.assertEqual(cache["dns_services"][0]["ipv4"]["address"], "127.0.0.1")
+
+    def test_run_timings(self):
+        runner = self._runner()
+        with contextlib.redirect_stdout(io.StringIO()):
+            runner.run()
+        self.assertEqual(set(runner.timings), {"load", "resolve", "update", "save"})
+
+    def test_run_verify(self):
+        self._write_config(verify_server="127.0.0.1", verify_port=0)
+        self.assertRaises(dnsupdate.ConfigException, self._runner().load)
+        self._write_config(verify_server="127.0.0.1", verify_timeout=0.1)
+        runner = self._runner()
+        with contextlib.redirect_stdout(io.StringIO()):
+            self.assertEqual(runner.run(), dnsupdate.ExitCode.SUCCESS)
+        self.assertIn("verify", runner.timings)
+
+    def test_run_processes(self):
+        services = [{"type": "StaticURL", "args": {"ipv4_url": self.url}}] * 5
+        services.append({"type": "StaticURL", "args": {"ipv4_url": self.url + "?last"}})
+        self._write_config(
+            dns_services=services, metrics_file=os.path.join(self.dir.name, "dnsupdate.prom")
+        )
+        self.assertRaises(SystemExit, self._runner, "--processes", "0")
+        _join_threads()
+        with contextlib.redirect_stdout(io.StringIO()) as stdout:
+            self.assertEqual(self._runner("--processes", "4").run(), dnsupdate.ExitCode.SUCCESS)
+        self.assertEqual(stdout.getvalue().count("Update successful."), 6)
+        self.assertIn("service 5 (StaticURL)", stdout.getvalue().splitlines()[-2])
+        cache = dnsupdate._load_cache(self.cache_file)
+        self.assertEqual(
+            [data["ipv4"]["address"] for data in cache["dns_services"]], ["127.0.0.1"] * 6
+        )
+        with open(os.path.join(self.dir.name, "dnsupdate.prom")) as f:
+            self.assertEqual(f.read().count('outcome="good"} 1'), 6)
+
+    def test_load_rate_limit(self):
+        self._write_config(rate_limit={"rate": 10, "hosts": {"127.0.0.1": {"concurrency": 2}}})
+        try:
+            self._runner().load()
+            limit = dnsupdate._rate_limits.get("127.0.0.1")
+            self.assertEqual((limit.rate, limit.burst, limit.concurrency), (10, 1, 2))
+            self.assertEqual(dnsupdate._rate_limits.get("localhost").concurrency, None)
+            self._write_config(rate_limit={"hosts": ["127.0.0.1"]})
+            self.assertRaises(dnsupdate.ConfigException, self._runner().load)
+        finally:
+            dnsupdate._rate_limits.configure()
+
+    def test_run_metrics_file(self):
+        metrics_file = os.path.join(self.dir.name, "dnsupdate.prom")
+        self._write_config(metrics_file=metrics_file)
+        with contextlib.redirect_stdout(io.StringIO()):
+            self._runner().run()
+        with open(metrics_file) as f:
+            text = f.read()
+        self.assertIn('outcome="good"} 1', text)
+        self.assertIn("dnsupdate_last_run_exit_code 0", text)
+        self.assertEqual(
+            sorted(os.listdir(self.dir.name)),
+            ["dnsupdate.cache", "dnsupdate.conf", "dnsupdate.prom"],
+        )
+
+    def test_reload_keeps_metrics(self):
+        runner = self._runner()
+        with contextlib.redirect_stdout(io.StringIO()):
+            runner.run()
+        runner.load()
+        self.assertIn('outcome="good"} 1', dnsupdate._metrics.render())
+
+    def _trace(self, *args):
+        trace_file = os.path.join(self.dir.name, "trace.jsonl")
+        self._write_config(trace_file=trace_file)
+        runner = self._runner(*args)
+        try:
+            with contextlib.redirect_stdout(io.StringIO()):
+                runner.run()
+        finally:
+            dnsupdate.remove_span_hook(runner.trace_writer)
+            runner.trace_writer.close()
+        with open(trace_file) as f:
+            spans = [json.loads(line) for line in f]
+        os.remove(trace_file)
+        return spans, {span["span_id"]: span for span in spans}
+
+    def test_run_trace_load(self):
+        trace_file = os.path.join(self.dir.name, "trace.jsonl")
+        with open(os.path.join(self.dir.name, "trace_file.txt"), "w") as f:
+            f.write(trace_file)
+        with open(self.config_file, "a") as f:
+            f.write("trace_file: !include_text trace_file.txt\n")
+        runner = self._runner()
+        try:
+            runner.load()
+        finally:
+            dnsupdate.remove_span_hook(runner.trace_writer)
+            runner.trace_writer.close()
+        with open(trace_file) as f:
+            spans = [json.loads(line) for line in f]
+        # Spans of loading the config that enabled tracing are written
+        self.assertEqual([span["name"] for span in spans], ["include", "load"])
+        self.assertEqual(spans[0]["parent_id"], spans[1]["span_id"])
+
+    def test_run_trace(self):
+        for args in (["--jobs", "2"], ["--engine", "asyncio", "--jobs", "2"]):
+            with self.subTest(args=args):
+                spans, by_id = self._trace(*args)
+                run = spans[-1]
+                self.assertEqual(run["name"], "run")
+                self.assertIsNone(run["parent_id"])
+                self.assertEqual({span["trace_id"] for span in spans}, {run["trace_id"]})
+
+                def parent(name):
+                    span = next(span for span in spans if span["name"] == name)
+                    return by_id[span["parent_id"]]["name"]
+
+                self.assertEqual(parent("load"), "run")
+                self.assertEqual(parent("lookup"), "resolve")
+                self.assertEqual(parent("service"), "update")
+                self.assertEqual(parent("save"), "run")
+                service = next(span for span in spans if span["name"] == "service")
+                self.assertEqual(service["attributes"], {"index": 0, "service": "StaticURL"})
+                # HTTP requests of the lookup and the update
+                http_parents = sorted(
+                    by_id[s["parent_id"]]["name"] for s in spans if s["name"] == "http"
+                )
+                self.assertEqual(http_parents, ["lookup", "update"])
+                os.remove(self.cache_file)
+
+    def test_span_hook(self):
+        class Hook(dnsupdate.SpanHook):
+            def __init__(self):
+                self.started = list()
+                self.finished = list()
+
+            def span_started(self, span):
+                self.started.append(span.name)
+
+            def span_finished(self, span):
+                self.finished.append(span)
+
+        hook = Hook()
+        dnsupdate.add_span_hook(hook)
+        try:
+            with self.assertRaises(ValueError):
+                with dnsupdate.span("outer", key="value"):
+                    with dnsupdate.span("inner"):
+                        raise ValueError("failed")
+        finally:
+            dnsupdate.remove_span_hook(hook)
+        self.assertEqual(hook.started, ["outer", "inner"])
+        inner, outer = hook.finished
+        self.assertEqual(inner.parent_id, outer.span_id)
+        self.assertEqual(inner.trace_id, outer.trace_id)
+        self.assertEqual(outer.attributes, {"key": "value"})
+        self.assertEqual(inner.error, "ValueError: failed")
+        self.assertGreaterEqual(outer.duration, inner.duration)
+
+    def test_run_sqlite_reorder(self):
+        services = [
+            {"type": "StaticURL", "args": {"ipv4_url": self.url + "a"}},
+            {"type": "StaticURL", "args": {"ipv4_url": self.url + "b"}},
+        ]
+        self._write_config(cache_backend="sqlite", dns_services=services)
+        stdout = io.StringIO()
+        with contextlib.redirect_stdout(stdout):
+            self._runner().run()
+        self.assertEqual(stdout.getvalue().count("Update successful."), 2)
+
+        # Only the new service is updated, regardless of position
+        services = [
+            {"type": "StaticURL", "args": {"ipv4_url": self.url + "c"}},
+            services[1],
+            services[0],
+        ]
+        self._write_config(cache_backend="sqlite", dns_services=services)
+        stdout = io.StringIO()
+        with contextlib.redirect_stdout(stdout):
+            runner = self._runner()
+            runner.run()
+            runner.run()
+        self.assertEqual(stdout.getvalue().count("Update successful."), 1)
+        self.assertEqual(stdout.getvalue().count("Address has not changed"), 5)
+
+        # Removed services are deleted
+        self._write_config(cache_backend="sqlite", dns_services=services[:1])
+        with contextlib.redirect_stdout(io.StringIO()):
+            self._runner().run()
+        runner.service_state.close()
+        with contextlib.closing(sqlite3.connect(self.cache_file)) as db:
+            self.assertEqual(db.execute("SELECT COUNT(*) FROM services").fetchone(), (1,))
+
+    def test_service_identities(self):
+        google = {"username": "user", "password": "secret", "hostname": "a.example.com"}
+        roots = [
+            {"type": "GoogleDomains", "args": google},
+            'GoogleDomains("user", "other", "b.example.com")',
+            {"type": "GoogleDomains", "args": {**google, "password": "changed"}},
+            'GoogleDomains("user", "secret", hostname="a.example.com")',
+            {"type": "StaticURL", "args": {"ipv4_url": "https://example.com/?key=secret"}},
+        ]
+        identities = dnsupdate._service_identities(roots)
+        self.assertEqual(len(set(identities)), 5)
+        self.assertTrue(all(i.startswith("GoogleDomains:") for i in identities[:4]))
+        # Secret arguments are not part of the identity
+        self.assertEqual(identities[2], identities[0] + "#2")
+        self.assertEqual(identities[3], identities[0] + "#3")
+        self.assertEqual(dnsupdate._service_identities(roots[:1]), identities[:1])
+        key = json.dumps({"type": "StaticURL", "args": {}}, sort_keys=True)
+        self.assertEqual(identities[4], "StaticURL:" + hashlib.sha256(key.encode()).hexdigest())
+
+    def test_run_unchanged_imports(self):
+        # Nothing has changed since the last run, so neither the config nor
+        # any addresses need to be parsed or looked up again
+        self._write_config(
+            address_provider={
+                "ipv4": {"type": "Web", "args": {"ipv4_url": self.url}, "cache_ttl": 300}
+            }
+        )
+        with contextlib.redirect_stdout(io.StringIO()):
+            self.assertEqual(self._runner().run(), dnsupdate.ExitCode.SUCCESS)
+        script = """
+import json, sys
+import dnsupdate
+args = dnsupdate._get_arg_parser().parse_args([sys.argv[1]])
+exit_code = dnsupdate._Runner(args).run()
+print(json.dumps([exit_code, sorted(set(sys.modules) & set(sys.argv[2:]))]))
+"""
+        output = subprocess.run(
+            [sys.executable, "-c", script, self.config_file, "requests", "urllib3", "yaml"],
+            check=True,
+            stdout=subprocess.PIPE,
+            cwd=os.path.dirname(dnsupdate.__file__),
+        ).stdout
+        exit_code, modules = json.loads(output.decode().splitlines()[-1])
+        self.assertEqual(exit_code, dnsupdate.ExitCode.SUCCESS)
+        self.assertEqual(modules, [])
+
+    def test_run_keeps_config(self):
+        runner = self._runner()
+        with contextlib.redirect_stdout(io.StringIO()):
+            runner.run()
+            identities = runner.identities
+            runner.run()
+            self.assertIs(runner.identities, identities)
+            os.utime(self.config_file, (0, 0))
+            runner.run()
+            self.assertIsNot(runner.identities, identities)
+
+    def test_run_windows(self):
+        services = [
+            {"type": "StaticURL", "args": {"ipv4_url": self.url + "?%d" % i}} for i in range(5)
+        ]
+        self._write_config(dns_services=services)
+        # Parent of each service span
+        windows = list()
+
+        class WindowHook(dnsupdate.SpanHook):
+            def span_finished(self, span):
+                if span.name == "service":
+                    windows.append(span.parent_id)
+
+        hook = WindowHook()
+        dnsupdate.add_span_hook(hook)
+        self.addCleanup(dnsupdate.remove_span_hook, hook)
+        self.addCleanup(setattr, dnsupdate._Runner, "SERVICES_PER_JOB", 100)
+        dnsupdate._Runner.SERVICES_PER_JOB = 2
+        for args in (["--jobs", "1"], ["--engine", "asyncio", "--jobs", "1"]):
+            with self.subTest(args=args):
+                windows.clear()
+                with contextlib.redirect_stdout(io.StringIO()) as stdout:
+                    runner = self._runner("--force-update", *args)
+                    self.assertEqual(runner.run(), dnsupdate.ExitCode.SUCCESS)
+                # Services are built and updated two at a time, in order
+                self.assertEqual(
+                    [windows.count(window) for window in dict.fromkeys(windows)], [2, 2, 1]
+                )
+                self.assertEqual(stdout.getvalue().count("Update successful."), 5)
+                self.assertIn("service 4 (StaticURL)", stdout.getvalue().splitlines()[-2])
+
+    def test_run_uncached_config(self):
+        # The compiled config cannot be written
+        cache_home = os.path.join(self.dir.name, "cache")
+        open(cache_home, "w").close()
+        parses = list()
+        stream_yaml = dnsupdate._stream_yaml
+
+        def count_parses(*args):
+            parses.append(None)
+            return stream_yaml(*args)
+
+        os.environ["XDG_CACHE_HOME"] = cache_home
+        dnsupdate._stream_yaml = count_parses
+        try:
+            runner = self._runner()
+            with contextlib.redirect_stdout(io.StringIO()):
+                for _ in range(3):
+                    self.assertEqual(runner.run(), dnsupdate.ExitCode.SUCCESS)
+        finally:
+            os.environ["XDG_CACHE_HOME"] = _cache_home.name
+            dnsupdate._stream_yaml = stream_yaml
+        self.assertEqual(len(parses), 1)
+
+    def test_run_config_changed(self):
+        runner = self._runner()
+        runner.load()
+        self._write_config(dns_services=[])
+        with contextlib.redirect_stdout(io.StringIO()):
+            self.assertRaises(dnsupdate.ConfigException, runner._run)
+
+    def test_reload_invalid_config(self):
+        runner = self._runner()
+        runner.load()
+        identities = runner.identities
+        self._write_config(jobs=0)
+        self.assertRaises(dnsupdate.ConfigException, runner.load)
+        self.assertIs(runner.identities, identities)
+
+    def test_daemon(self):
+        with socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM) as notify_socket:
+            notify_path = os.path.join(self.dir.name, "notify")
+            notify_socket.bind(notify_path)
+            notify_socket.settimeout(10)
+            env = {**os.environ, "NOTIFY_SOCKET": notify_path, "WATCHDOG_USEC": "100000"}
+            daemon = subprocess.Popen(
+                [sys.executable, dnsupdate.__file__, "--daemon", self.config_file],
+                env=env,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.PIPE,
+            )
+            try:
+                messages = [notify_socket.recv(4096).decode() for _ in range(8)]
+                daemon.send_signal(signal.SIGTERM)
+                self.assertEqual(daemon.wait(10), dnsupdate.ExitCode.SUCCESS)
+                while not messages[-1] == "STOPPING=1":
+                    messages.append(notify_socket.recv(4096).decode())
+            finally:
+                daemon.kill()
+                daemon.communicate()
+        self.assertEqual(messages[0], "READY=1")
+        self.assertIn("WATCHDOG=1", messages)
+        self.assertTrue(any(m.startswith("STATUS=Last run finished") for m in messages))
+
+    def test_watchdog_pings(self):
+        with socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM) as notify_socket:
+            notify_path = os.path.join(self.dir.name, "notify")
+            notify_socket.bind(notify_path)
+            notify_socket.settimeout(10)
+            os.environ["NOTIFY_SOCKET"] = notify_path
+            try:
+                # Pinged while a long run is in progress
+                with dnsupdate._watchdog_pings(0.05):
+                    messages = [notify_socket.recv(4096).decode() for _ in range(3)]
+            finally:
+                del os.environ["NOTIFY_SOCKET"]
+        self.assertEqual(messages, ["WATCHDOG=1"] * 3)
+
 
 # vim: ts=4:ps=4:et